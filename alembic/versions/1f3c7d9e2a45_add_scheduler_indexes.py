@@ -0,0 +1,35 @@
+"""Add indexes for the scheduler and progress queries
+
+Revision ID: 1f3c7d9e2a45
+Revises: 4b6a3e9c1f02
+Create Date: 2015-03-05 11:27:52.860413
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3c7d9e2a45'
+down_revision = '4b6a3e9c1f02'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('task_run_task_id_idx', 'task_run', ['task_id'])
+    op.create_index('task_run_app_id_user_id_task_id_idx', 'task_run',
+                    ['app_id', 'user_id', 'task_id'])
+    op.create_index('task_run_app_id_user_ip_task_id_idx', 'task_run',
+                    ['app_id', 'user_ip', 'task_id'])
+    op.execute('''CREATE INDEX task_app_id_state_priority_idx
+               ON task (app_id, state, priority_0 DESC, id)''')
+    op.execute('''CREATE INDEX task_ongoing_app_id_priority_idx
+               ON task (app_id, priority_0 DESC, id)
+               WHERE state != 'completed' ''')
+
+
+def downgrade():
+    op.drop_index('task_ongoing_app_id_priority_idx', 'task')
+    op.drop_index('task_app_id_state_priority_idx', 'task')
+    op.drop_index('task_run_app_id_user_ip_task_id_idx', 'task_run')
+    op.drop_index('task_run_app_id_user_id_task_id_idx', 'task_run')
+    op.drop_index('task_run_task_id_idx', 'task_run')
@@ -0,0 +1,65 @@
+"""Add project stats table
+
+Revision ID: 3a8e5a1c2d70
+Revises: 4e435ff8ba74
+Create Date: 2015-03-02 10:12:31.504210
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a8e5a1c2d70'
+down_revision = '4e435ff8ba74'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('project_stats',
+                    sa.Column('app_id', sa.Integer, primary_key=True,
+                              autoincrement=False),
+                    sa.Column('n_tasks', sa.Integer, nullable=False,
+                              server_default='0'),
+                    sa.Column('n_completed_tasks', sa.Integer, nullable=False,
+                              server_default='0'),
+                    sa.Column('n_answers', sa.Integer, nullable=False,
+                              server_default='0'),
+                    sa.Column('n_task_runs', sa.Integer, nullable=False,
+                              server_default='0'),
+                    sa.Column('n_registered_volunteers', sa.Integer,
+                              nullable=False, server_default='0'),
+                    sa.Column('n_anonymous_volunteers', sa.Integer,
+                              nullable=False, server_default='0'),
+                    sa.Column('last_activity', sa.Text))
+    # Fill it with the current counters of every project, and of the site
+    query = '''INSERT INTO project_stats
+               SELECT app.id,
+               (SELECT COUNT(id) FROM task WHERE app_id=app.id),
+               (SELECT COUNT(id) FROM task
+                WHERE app_id=app.id AND state='completed'),
+               (SELECT COALESCE(SUM(n_answers), 0) FROM task
+                WHERE app_id=app.id),
+               (SELECT COUNT(id) FROM task_run WHERE app_id=app.id),
+               (SELECT COUNT(DISTINCT user_id) FROM task_run
+                WHERE app_id=app.id AND user_ip IS NULL),
+               (SELECT COUNT(DISTINCT user_ip) FROM task_run
+                WHERE app_id=app.id AND user_id IS NULL),
+               (SELECT MAX(finish_time) FROM task_run WHERE app_id=app.id)
+               FROM app;'''
+    op.execute(query)
+    query = '''INSERT INTO project_stats
+               SELECT 0,
+               (SELECT COUNT(id) FROM task),
+               (SELECT COUNT(id) FROM task WHERE state='completed'),
+               (SELECT COALESCE(SUM(n_answers), 0) FROM task),
+               (SELECT COUNT(id) FROM task_run),
+               (SELECT COUNT(DISTINCT user_id) FROM task_run
+                WHERE user_ip IS NULL),
+               (SELECT COUNT(DISTINCT user_ip) FROM task_run
+                WHERE user_id IS NULL),
+               (SELECT MAX(finish_time) FROM task_run);'''
+    op.execute(query)
+
+
+def downgrade():
+    op.drop_table('project_stats')
@@ -0,0 +1,27 @@
+"""Add indexes to the timestamps used in range queries
+
+Revision ID: 4b6a3e9c1f02
+Revises: 3a8e5a1c2d70
+Create Date: 2015-03-04 16:41:07.318524
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b6a3e9c1f02'
+down_revision = '3a8e5a1c2d70'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('task_run_app_id_finish_time_idx', 'task_run',
+                    ['app_id', 'finish_time'])
+    op.create_index('task_run_finish_time_idx', 'task_run', ['finish_time'])
+    op.create_index('ix_app_updated', 'app', ['updated'])
+
+
+def downgrade():
+    op.drop_index('ix_app_updated', 'app')
+    op.drop_index('task_run_finish_time_idx', 'task_run')
+    op.drop_index('task_run_app_id_finish_time_idx', 'task_run')
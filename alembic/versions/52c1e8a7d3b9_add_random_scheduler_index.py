@@ -0,0 +1,24 @@
+"""Add an index of the ongoing tasks by id for the random scheduler
+
+Revision ID: 52c1e8a7d3b9
+Revises: 1f3c7d9e2a45
+Create Date: 2015-03-09 10:14:36.207518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52c1e8a7d3b9'
+down_revision = '1f3c7d9e2a45'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('''CREATE INDEX task_ongoing_app_id_id_idx
+               ON task (app_id, id)
+               WHERE state != 'completed' ''')
+
+
+def downgrade():
+    op.drop_index('task_ongoing_app_id_id_idx', 'task')
@@ -0,0 +1,115 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python
+"""
+Benchmark of the single scan project stats against the previous
+implementation, which ran a query per histogram, series and top-list (each of
+them parsing finish_time with TO_TIMESTAMP/TO_DATE for every task_run).
+
+Usage (from the root of the repository, with a configured settings_local.py):
+
+    python contrib/benchmark_project_stats.py <app_id> [<iterations>]
+
+The cache is disabled while it runs, and the aggregates of the app are reset
+before every call, so every call computes the stats from scratch.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
+
+from sqlalchemy.sql import text
+from pybossa.core import create_app, db
+from pybossa.cache.project_stats import scan_task_runs, reset_stats
+
+
+HOURS = '''SELECT to_char(DATE_TRUNC('hour',
+           TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')), 'HH24')
+           AS h, COUNT(id) FROM task_run WHERE app_id=:app_id %s GROUP BY h'''
+DATES = '''SELECT TO_DATE(finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') AS d,
+           COUNT(id) FROM task_run WHERE app_id=:app_id %s GROUP BY d'''
+COMPLETED = '''
+    WITH answers AS (
+     SELECT TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') AS day,
+     task.id, task.n_answers AS n_answers, COUNT(task_run.id) AS day_answers
+     FROM task_run, task WHERE task_run.app_id=:app_id
+     AND task.id=task_run.task_id AND
+     TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') >= NOW()
+       - '2 week':: INTERVAL GROUP BY day, task.id)
+    SELECT to_char(day_of_completion, 'YYYY-MM-DD') AS day,
+       COUNT(task_id) AS completed_tasks FROM (
+        SELECT MIN(day) AS day_of_completion, task_id FROM (
+            SELECT ans1.day, ans1.id as task_id,
+            floor(avg(ans1.n_answers)) AS n_answers,
+            sum(ans2.day_answers) AS accum_answers
+            FROM answers AS ans1 INNER JOIN answers AS ans2
+            ON ans1.id=ans2.id WHERE ans1.day >= ans2.day
+            GROUP BY ans1.id, ans1.day) AS answers_day_task
+        WHERE n_answers <= accum_answers
+        GROUP BY task_id) AS completed_tasks_by_day
+    GROUP BY day'''
+USERS = '''SELECT %s, COUNT(id) AS n_tasks FROM task_run
+           WHERE app_id=:app_id AND user_id IS %s NULL
+           AND user_ip IS %s NULL GROUP BY 1 ORDER BY n_tasks DESC'''
+N_USERS = '''SELECT COUNT(DISTINCT(%s)) FROM task_run
+             WHERE app_id=:app_id AND user_id IS %s NULL
+             AND user_ip IS %s NULL'''
+
+AUTH = 'AND user_ip IS NULL'
+ANON = 'AND user_id IS NULL'
+
+#: The queries of the previous implementation, in the order they were run
+PREVIOUS = ([HOURS % '', 'SELECT MAX(count) FROM (%s) AS q' % (HOURS % ''),
+             HOURS % ANON, 'SELECT MAX(count) FROM (%s) AS q' % (HOURS % ANON),
+             HOURS % AUTH, 'SELECT MAX(count) FROM (%s) AS q' % (HOURS % AUTH),
+             USERS % ('user_id', 'NOT', '') + ' LIMIT 5',
+             N_USERS % ('user_id', 'NOT', ''),
+             USERS % ('user_ip', '', 'NOT'),
+             N_USERS % ('user_ip', '', 'NOT'),
+             COMPLETED, DATES % AUTH, DATES % ANON])
+
+
+def previous_stats(app_id):
+    """Run the queries of the previous stats implementation."""
+    for sql in PREVIOUS:
+        db.slave_session.execute(text(sql), dict(app_id=app_id)).fetchall()
+
+
+def run(app_id, iterations=3):
+    app = create_app(run_as_server=False)
+    with app.app_context():
+        for name, stats in (('scan_task_runs', scan_task_runs),
+                            ('previous', previous_stats)):
+            seconds = 0
+            for _ in range(iterations):
+                reset_stats(app_id)
+                seconds += timeit.timeit(lambda: stats(app_id), number=1)
+            print "%-16s %10.2f ms/call" % (name,
+                                             seconds * 1000 / iterations)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    run(int(sys.argv[1]), iterations)
@@ -0,0 +1,78 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python
+"""
+Benchmark of the random scheduler against the previous implementation, which
+loaded all the tasks of the project to pick one of them.
+
+Usage (from the root of the repository, with a configured settings_local.py):
+
+    python contrib/benchmark_random_sched.py <app_id> [<iterations>]
+
+For every implementation it prints the mean time per call and the peak
+resident memory of the process after running it (the previous implementation
+runs last, so its memory growth is not hidden by the new one).
+"""
+import os
+import sys
+import resource
+import timeit
+from random import choice
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from pybossa.core import create_app, db
+from pybossa.model.app import App
+from pybossa.sched import get_random_task
+
+
+def previous_random_task(app_id, user_id=None, user_ip=None):
+    """The random scheduler as it was, loading every task of the project."""
+    app = db.slave_session.query(App).get(app_id)
+    if len(app.tasks) > 0:
+        return choice(app.tasks)
+    return None
+
+
+def peak_memory():
+    """Peak resident memory of the process, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(app_id, iterations=100):
+    app = create_app(run_as_server=False)
+    with app.app_context():
+        for name, scheduler in (('get_random_task', get_random_task),
+                                ('previous', previous_random_task)):
+            def call():
+                scheduler(app_id, user_ip='127.0.0.1')
+                # Drop the identity map, as a new request would
+                db.slave_session.remove()
+            seconds = timeit.timeit(call, number=iterations)
+            print "%-16s %8.2f ms/call  peak memory %8.1f MB" % (
+                name, seconds * 1000 / iterations, peak_memory())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    run(int(sys.argv[1]), iterations)
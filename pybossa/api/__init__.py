@@ -22,7 +22,7 @@ This package adds GET, POST, PUT and DELETE methods for:
     * projects,
     * categories,
     * tasks,
-    * task_runs,
+    * task_runs (also many at once),
     * users,
     * global_stats,
     * vmcp
@@ -42,13 +42,15 @@ import pybossa.sched as sched
 from pybossa.error import ErrorStatus
 from global_stats import GlobalStatsAPI
 from task import TaskAPI
-from task_run import TaskRunAPI
+from task_run import TaskRunAPI, create_task_runs
 from app import AppAPI
 from category import CategoryAPI
 from vmcp import VmcpAPI
 from user import UserAPI
 from token import TokenAPI
 from pybossa.core import project_repo, task_repo
+from pybossa.auth import ensure_authorized_to
+from pybossa.importers import ImportProgress
 
 blueprint = Blueprint('api', __name__)
 
@@ -95,6 +97,28 @@ register_api(VmcpAPI, 'api_vmcp', '/vmcp', pk='oid', pk_type='int')
 register_api(TokenAPI, 'api_token', '/token', pk='token', pk_type='string')
 
 
+@csrf.exempt
+@blueprint.route('/taskrun/bulk', methods=['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def bulk_taskrun():
+    """API endpoint to send many task runs at once, e.g. the ones a client
+    queued while it was offline.
+
+    Take a JSON list of task runs, as the ones of POST /api/taskrun, and
+    return a JSON list with the result of every one, in the same order:
+        [{ 'status': 'ok', 'id': 21 },
+         { 'status': 'failed', 'status_code': 403, ... }]
+       The valid task runs are saved even if some others fail.
+
+    """
+    try:
+        results = create_task_runs(json.loads(request.data))
+        return Response(json.dumps(results), mimetype="application/json")
+    except Exception as e:
+        return error.format_exception(e, target='taskrun', action='POST')
+
+
 @jsonpify
 @blueprint.route('/app/<app_id>/newtask')
 @crossdomain(origin='*', headers=cors_headers)
@@ -114,7 +138,38 @@ def new_task(app_id):
     except Exception as e:
         return error.format_exception(e, target='app', action='GET')
 
+
+@jsonpify
+@blueprint.route('/app/<app_id>/newtasks')
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def new_tasks(app_id):
+    """Return up to limit new tasks for a project (at most
+    sched.MAX_CANDIDATES), so task presenters can preload them at once."""
+    try:
+        limit = min(int(request.args.get('limit', 1)), sched.MAX_CANDIDATES)
+        tasks = _retrieve_new_tasks(app_id, limit=max(limit, 1))
+        pipe = sentinel.master.pipeline()
+        for task in tasks:
+            mark_task_as_requested_by_user(task, pipe)
+        pipe.execute()
+        response = make_response(json.dumps([task.dictize()
+                                              for task in tasks]))
+        response.mimetype = "application/json"
+        return response
+    except Exception as e:
+        return error.format_exception(e, target='app', action='GET')
+
 def _retrieve_new_task(app_id):
+    if request.args.get('offset'):
+        offset = int(request.args.get('offset'))
+    else:
+        offset = 0
+    tasks = _retrieve_new_tasks(app_id, offset=offset)
+    return tasks[0] if tasks else None
+
+
+def _retrieve_new_tasks(app_id, offset=0, limit=1):
     app = project_repo.get(app_id)
     if app is None:
         raise NotFound
@@ -122,15 +177,11 @@ def _retrieve_new_task(app_id):
         info = dict(
             error="This project does not allow anonymous contributors")
         error = model.task.Task(info=info)
-        return error
-    if request.args.get('offset'):
-        offset = int(request.args.get('offset'))
-    else:
-        offset = 0
+        return [error]
     user_id = None if current_user.is_anonymous() else current_user.id
     user_ip = request.remote_addr if current_user.is_anonymous() else None
-    task = sched.new_task(app_id, app.info.get('sched'), user_id, user_ip, offset)
-    return task
+    return sched.new_tasks(app_id, app.info.get('sched'), user_id, user_ip,
+                           offset=offset, limit=limit)
 
 def mark_task_as_requested_by_user(task, redis_conn):
     usr = get_user_id_or_ip()['user_id'] or get_user_id_or_ip()['user_ip']
@@ -175,3 +226,34 @@ def user_progress(app_id=None, short_name=None):
             return abort(404)
     else:  # pragma: no cover
         return abort(404)
+
+
+@jsonpify
+@blueprint.route('/app/<int:app_id>/import')
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def import_progress(app_id):
+    """API endpoint for the progress of the last import of tasks of a project
+    that ran in the background, for the users that can update the project.
+
+    Return a JSON object like:
+        { 'state': 'running',
+          'parsed': 3000,
+          'inserted': 2500,
+          'duplicates': 500,
+          'committed': 3000,
+          'message': ''
+        }
+       where state is queued, running, finished or failed (the message has
+       the result or the error), or an empty object if there is none.
+
+    """
+    try:
+        app = project_repo.get(app_id)
+        if app is None:
+            raise NotFound
+        ensure_authorized_to('update', app)
+        progress = ImportProgress(sentinel.slave, app.id).get() or {}
+        return Response(json.dumps(progress), mimetype="application/json")
+    except Exception as e:
+        return error.format_exception(e, target='app', action='GET')
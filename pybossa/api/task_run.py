@@ -21,15 +21,24 @@ PyBossa api module for exposing domain object TaskRun via an API.
 This package adds GET, POST, PUT and DELETE methods for:
     * task_runs
 
+and create_task_runs, to POST many task_runs at once.
+
 """
 from flask import request
 from flask.ext.login import current_user
 from pybossa.model.task_run import TaskRun
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import Forbidden, Unauthorized
 
 from api_base import APIBase
 from pybossa.util import get_user_id_or_ip
-from pybossa.core import task_repo, sentinel
+from pybossa.core import task_repo, project_repo, sentinel
+from pybossa.error import ErrorStatus
+
+
+#: Task runs that can be sent at once to create_task_runs
+MAX_BULK_TASK_RUNS = 100
+
+error = ErrorStatus()
 
 
 class TaskRunAPI(APIBase):
@@ -64,3 +73,114 @@ def _check_task_requested_by_user(taskrun, redis_conn):
     if user_id_ip['user_id'] is not None:
         redis_conn.delete(key)
     return task_requested
+
+
+def create_task_runs(items):
+    """Create the task runs of the current user in items (a list of the JSON
+    objects that POST /api/taskrun takes) in one transaction.
+
+    The checks of TaskRunAPI.post are done for all the items at once, and
+    the items that fail them are left out. Return a list with the result of
+    every item, in the same order: either {"status": "ok", "id": ...} or the
+    error that POST /api/taskrun would have returned.
+
+    """
+    if not isinstance(items, list):
+        raise ValueError('Expected a list of task runs')
+    if len(items) > MAX_BULK_TASK_RUNS:
+        raise ValueError('No more than %s task runs can be sent at once'
+                         % MAX_BULK_TASK_RUNS)
+    user_id, user_ip = None, None
+    if current_user.is_anonymous():
+        user_ip = request.remote_addr
+    else:
+        user_id = current_user.id
+    results = [None] * len(items)
+    task_runs = {}
+    for i, data in enumerate(items):
+        try:
+            task_runs[i] = _task_run_data(data, user_id, user_ip)
+        except Exception as e:
+            results[i] = error.exception_dict(e, target='taskrun',
+                                              action='POST')
+    task_ids = [task_run['task_id'] for task_run in task_runs.values()]
+    tasks = task_repo.get_tasks_by_ids(task_ids)
+    projects = dict((app_id, project_repo.get(app_id)) for app_id in
+                    set(task.app_id for task in tasks.values()))
+    requested = _check_tasks_requested_by_user(tasks.keys(), sentinel.master)
+    answered = task_repo.get_answered_task_ids(task_ids, user_id, user_ip)
+    valid = []
+    for i in sorted(task_runs):
+        task_run = task_runs[i]
+        try:
+            _validate_task_run(task_run, tasks, projects, requested, answered)
+            answered.add(task_run['task_id'])
+            valid.append(i)
+        except Exception as e:
+            results[i] = error.exception_dict(e, target='taskrun',
+                                              action='POST')
+    if valid:
+        ids = task_repo.save_task_runs([task_runs[i] for i in valid])
+        for i, _id in zip(valid, ids):
+            results[i] = dict(status='ok', id=_id)
+        _forget_tasks_requested_by_user(
+            [task_runs[i]['task_id'] for i in valid], sentinel.master)
+    return results
+
+
+def _task_run_data(data, user_id, user_ip):
+    """Return the attributes of the task run of an item, as the ones of
+    TaskRunAPI.post (which refuses the same items)."""
+    data = TaskRunAPI.hateoas.remove_links(data)
+    TaskRun(**data)
+    data = dict((key, value) for key, value in data.items() if key != 'id')
+    if not isinstance(data.get('task_id'), (int, long)):
+        raise Forbidden('Invalid task_id')
+    data['user_id'], data['user_ip'] = user_id, user_ip
+    return data
+
+
+def _validate_task_run(task_run, tasks, projects, requested, answered):
+    """Check a task run like TaskRunAPI._update_object and TaskRunAuth do."""
+    task = tasks.get(task_run['task_id'])
+    if task is None:
+        raise Forbidden('Invalid task_id')
+    if task.app_id != task_run.get('app_id'):
+        raise Forbidden('Invalid app_id')
+    if task.id not in requested:
+        raise Forbidden('You must request a task first!')
+    if (current_user.is_anonymous() and
+            projects[task.app_id].allow_anonymous_contributors is False):
+        raise Unauthorized()
+    if task.id in answered:
+        raise Forbidden()
+
+
+def _check_tasks_requested_by_user(task_ids, redis_conn):
+    """Return the set of task_ids requested by the user, as
+    _check_task_requested_by_user does for one task (the requests are
+    deleted by _forget_tasks_requested_by_user, once the task runs are
+    saved)."""
+    user_id_ip = get_user_id_or_ip()
+    usr = user_id_ip['user_id'] or user_id_ip['user_ip']
+    keys = ['pybossa:task_requested:user:%s:task:%s' % (usr, task_id)
+            for task_id in task_ids]
+    if not keys:
+        return set()
+    pipe = redis_conn.pipeline()
+    for key in keys:
+        pipe.get(key)
+    values = pipe.execute()
+    return set(task_id for task_id, value in zip(task_ids, values) if value)
+
+
+def _forget_tasks_requested_by_user(task_ids, redis_conn):
+    """Delete the requests of the tasks of the saved task runs of an
+    authenticated user, as _check_task_requested_by_user does for one
+    task."""
+    user_id_ip = get_user_id_or_ip()
+    if user_id_ip['user_id'] is None or not task_ids:
+        return
+    redis_conn.delete(*['pybossa:task_requested:user:%s:task:%s'
+                        % (user_id_ip['user_id'], task_id)
+                        for task_id in task_ids])
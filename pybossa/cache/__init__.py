@@ -24,12 +24,21 @@ It exports:
     * memoize: for caching functions using its arguments as part of the key
     * delete_cached: to remove a cached value
     * delete_memoized: to remove a cached value from the memoize decorator
+    * delete_untagged_memoized: to remove, once, the values memoized before
+      they were recorded in tag sets
+    * get_local_cache_stats: hits and misses of the in process cache
+
+If CACHE_L1_ENABLED is set, every process keeps the values it gets from Redis
+in a small LRU cache for CACHE_L1_TIMEOUT seconds. The deletions are published
+in Redis so every process drops its local copies too.
 
 """
 import os
+import time
 import hashlib
 from functools import wraps
 from pybossa.core import sentinel
+from pybossa.cache.local import LocalCache, InvalidationListener
 
 try:
     import cPickle as pickle
@@ -47,6 +56,136 @@ ONE_HOUR = 60 * 60
 HALF_HOUR = 30 * 60
 FIVE_MINUTES = 5 * 60
 
+DELETE_BATCH_SIZE = 1000
+
+# Seconds a process can hold the lock for recomputing a missed key (the rest
+# wait for its value meanwhile), and seconds between their checks
+LOCK_TIMEOUT = getattr(settings, 'CACHE_LOCK_TIMEOUT', 30)
+LOCK_POLL_INTERVAL = 0.05
+
+INVALIDATION_CHANNEL = "%s:invalidate" % settings.REDIS_KEYPREFIX
+
+if getattr(settings, 'CACHE_L1_ENABLED', False):
+    local_cache = LocalCache(size=getattr(settings, 'CACHE_L1_SIZE', 1000),
+                             timeout=getattr(settings, 'CACHE_L1_TIMEOUT', 5))
+else:
+    local_cache = None
+_listener_pid = None
+
+
+def _start_listener():
+    """Start listening to the invalidations, once per process (so it also
+    works for web workers forked after this module is imported)."""
+    global _listener_pid
+    if _listener_pid != os.getpid():
+        _listener_pid = os.getpid()
+        InvalidationListener(local_cache, sentinel.master,
+                             INVALIDATION_CHANNEL).start()
+
+
+def _get(key):
+    """Return the pickled value for key from the local cache or Redis."""
+    if local_cache is None:
+        return sentinel.slave.get(key)
+    _start_listener()
+    output = local_cache.get(key)
+    if output is None:
+        output = sentinel.slave.get(key)
+        if output:
+            local_cache.set(key, output)
+    return output
+
+
+def _set(key, timeout, output, tag=None):
+    """Store the pickled value for key in Redis and the local cache, and
+    record key in the tag set (if any) so it can be deleted later.
+
+    The tag is a sorted set scored by the time each key expires, so the keys
+    already expired are pruned from it on every write.
+    """
+    pipe = sentinel.master.pipeline()
+    pipe.setex(key, timeout, output)
+    if tag is not None:
+        now = time.time()
+        pipe.zadd(tag, now + timeout, key)
+        pipe.zremrangebyscore(tag, '-inf', now)
+        # Every key of the set expires before the set itself
+        pipe.expire(tag, timeout)
+    pipe.execute()
+    if local_cache is not None:
+        local_cache.set(key, output)
+
+
+def _invalidate(key):
+    """Drop key (or keys, if it ends with '*') from the local caches of
+    every process."""
+    if local_cache is not None:
+        local_cache.delete(key)
+        sentinel.master.publish(INVALIDATION_CHANNEL, key)
+
+
+def _get_or_compute(key, timeout, f, args, kwargs, tag=None):
+    """Return the cached value for key, computing and storing it on a miss.
+
+    Only one process computes a missed key at a time (it holds a lock in
+    Redis); the rest wait for its value instead of running the same queries,
+    and only compute it themselves if the lock is gone without it (the
+    process failed, or the lock expired after LOCK_TIMEOUT seconds).
+    """
+    output = _get(key)
+    if output:
+        return pickle.loads(output)
+    lock = "%s:lock" % key
+    locked = sentinel.master.set(lock, 1, ex=LOCK_TIMEOUT, nx=True)
+    if not locked:
+        output = _wait_for(key, lock)
+        if output:
+            return pickle.loads(output)
+    try:
+        output = f(*args, **kwargs)
+        _set(key, timeout, pickle.dumps(output), tag)
+    finally:
+        if locked:
+            sentinel.master.delete(lock)
+    return output
+
+
+def _wait_for(key, lock):
+    """Wait until the value of key is stored by the process holding lock.
+
+    Returns the pickled value, or None if the lock was released (or expired)
+    without it or it did not show up within LOCK_TIMEOUT seconds. The value
+    is read from the master, and these reads are not counted as misses of
+    the local cache.
+    """
+    deadline = time.time() + LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        output = sentinel.master.get(key)
+        if output is None and not sentinel.master.exists(lock):
+            output = sentinel.master.get(key)
+            if output is None:
+                return None
+        if output:
+            if local_cache is not None:
+                local_cache.set(key, output)
+            return output
+    return None
+
+
+def get_local_cache_stats():
+    """Return the hits, misses and size of the local cache of this process,
+    or None if it is not enabled."""
+    if local_cache is None:
+        return None
+    return local_cache.stats()
+
+
+def get_tag_key(function_name):
+    """Return the key of the sorted set with the keys memoized for a
+    function."""
+    return "%s:ztag:%s_args" % (settings.REDIS_KEYPREFIX, function_name)
+
 
 def get_key_to_hash(*args, **kwargs):
     """Return key to hash for *args and **kwargs."""
@@ -81,14 +220,9 @@ def cache(key_prefix, timeout=300):
         def wrapper(*args, **kwargs):
             key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
+                return _get_or_compute(key, timeout, f, args, kwargs)
             output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
+            _set(key, timeout, pickle.dumps(output))
             return output
         return wrapper
     return decorator
@@ -104,20 +238,17 @@ def memoize(timeout=300):
     if timeout is None:
         timeout = 300
     def decorator(f):
+        prefix = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
+        tag = get_tag_key(f.__name__)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
             key_to_hash = get_key_to_hash(*args, **kwargs)
-            key = get_hash_key(key, key_to_hash)
+            key = get_hash_key(prefix, key_to_hash)
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
+                return _get_or_compute(key, timeout, f, args, kwargs, tag)
             output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
+            _set(key, timeout, pickle.dumps(output), tag)
             return output
         return wrapper
     return decorator
@@ -132,7 +263,9 @@ def delete_cached(key):
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
         key = "%s::%s" % (settings.REDIS_KEYPREFIX, key)
-        return bool(sentinel.master.delete(key))
+        deleted = bool(sentinel.master.delete(key))
+        _invalidate(key)
+        return deleted
     return True
 
 
@@ -140,17 +273,69 @@ def delete_memoized(function, *args, **kwargs):
     """
     Delete a memoized value from the cache.
 
+    If no arguments are given, it deletes the values memoized for every call
+    of the function, which are recorded in its tag set (so there is no need
+    to scan the keyspace).
+
     Returns True if success or no cache is enabled
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
         key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, function.__name__)
+        tag = get_tag_key(function.__name__)
         if args or kwargs:
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
-            return bool(sentinel.master.delete(key))
-        keys_to_delete = sentinel.slave.keys(pattern=key + '*')
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+            pipe = sentinel.master.pipeline()
+            pipe.delete(key)
+            pipe.zrem(tag, key)
+            deleted = bool(pipe.execute()[0])
+            _invalidate(key)
+            return deleted
+        # Take the tag set atomically, so keys memoized meanwhile go to a new
+        # one instead of being lost
+        pipe = sentinel.master.pipeline()
+        pipe.zrange(tag, 0, -1)
+        pipe.delete(tag)
+        keys_to_delete = pipe.execute()[0]
+        deleted = 0
+        for i in range(0, len(keys_to_delete), DELETE_BATCH_SIZE):
+            deleted += sentinel.master.delete(
+                *keys_to_delete[i:i + DELETE_BATCH_SIZE])
+        _invalidate(key + '*')
+        return bool(deleted)
     return True
+
+
+def delete_untagged_memoized():
+    """
+    Delete the values memoized before they were recorded in the (sorted) tag
+    sets, which delete_memoized cannot find. The keyspace is scanned by one
+    process at a time, and only until a scan finishes for a Redis server.
+
+    Returns the number of deleted keys
+
+    """
+    done = "%s:ztag:untagged_deleted" % settings.REDIS_KEYPREFIX
+    lock = "%s:lock" % done
+    if sentinel.master.exists(done):
+        return 0
+    # A scan takes longer than computing a value, so it gets a longer lock
+    if not sentinel.master.set(lock, 1, ex=ONE_HOUR, nx=True):
+        return 0
+    try:
+        pattern = "%s:*_args:*" % settings.REDIS_KEYPREFIX
+        keys = []
+        deleted = 0
+        for key in sentinel.master.scan_iter(match=pattern,
+                                             count=DELETE_BATCH_SIZE):
+            keys.append(key)
+            if len(keys) == DELETE_BATCH_SIZE:
+                deleted += sentinel.master.delete(*keys)
+                keys = []
+        if keys:
+            deleted += sentinel.master.delete(*keys)
+        sentinel.master.set(done, 1)
+    finally:
+        sentinel.master.delete(lock)
+    return deleted
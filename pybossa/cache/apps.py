@@ -37,19 +37,22 @@ def get_app(short_name):
        key_prefix="front_page_top_apps")
 def get_top(n=4):
     """Return top n=4 apps"""
-    sql = text('''SELECT app.id, app.name, app.short_name, app.description, app.info,
-              COUNT(app_id) AS total FROM task_run, app
-              WHERE app_id IS NOT NULL AND app.id=app_id AND app.hidden=0
-              GROUP BY app.id ORDER BY total DESC LIMIT :limit;''')
+    sql = text('''SELECT app.id, app.name, app.short_name, app.description, app.info
+              FROM project_stats, app
+              WHERE app.id=project_stats.app_id AND app.hidden=0
+              AND project_stats.n_task_runs > 0
+              ORDER BY project_stats.n_task_runs DESC LIMIT :limit;''')
     results = session.execute(sql, dict(limit=n))
     top_apps = []
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    description=row.description,
-                   info=json.loads(row.info),
-                   n_volunteers=n_volunteers(row.id),
-                   n_completed_tasks=n_completed_tasks(row.id))
+                   info=json.loads(row.info))
         top_apps.append(app)
+    for app, app_summary in zip(top_apps,
+                                summaries([app['id'] for app in top_apps])):
+        app['n_volunteers'] = app_summary['n_volunteers']
+        app['n_completed_tasks'] = app_summary['n_completed_tasks']
     return top_apps
 
 
@@ -79,95 +82,130 @@ def _pct_status(n_task_runs, n_answers):
     return float(0)
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+COUNTERS = ('n_tasks', 'n_completed_tasks', 'n_task_runs',
+            'n_registered_volunteers', 'n_anonymous_volunteers',
+            'last_activity')
+
+
+def _count_summaries(app_ids):
+    """Return the counters of the apps in app_ids computed from scratch with
+    a single query, for apps that have no row in project_stats yet."""
+    sql = text('''
+               WITH tasks AS (
+                    SELECT app_id, COUNT(id) AS n_tasks,
+                    COUNT(CASE WHEN state=\'completed\' THEN 1 END)
+                    AS n_completed_tasks
+                    FROM task WHERE app_id = ANY(:app_ids) GROUP BY app_id),
+               task_runs AS (
+                    SELECT app_id, COUNT(id) AS n_task_runs,
+                    COUNT(DISTINCT(CASE WHEN user_ip IS NULL THEN user_id END))
+                    AS n_registered_volunteers,
+                    COUNT(DISTINCT(CASE WHEN user_id IS NULL THEN user_ip END))
+                    AS n_anonymous_volunteers,
+                    MAX(finish_time) AS last_activity
+                    FROM task_run WHERE app_id = ANY(:app_ids) GROUP BY app_id)
+               SELECT COALESCE(tasks.app_id, task_runs.app_id) AS app_id,
+               tasks.n_tasks, tasks.n_completed_tasks, task_runs.n_task_runs,
+               task_runs.n_registered_volunteers,
+               task_runs.n_anonymous_volunteers, task_runs.last_activity
+               FROM tasks FULL OUTER JOIN task_runs
+               ON tasks.app_id=task_runs.app_id;
+               ''')
+    results = session.execute(sql, dict(app_ids=app_ids))
+    return dict((row.app_id, row) for row in results)
+
+
+def _summary(row):
+    app_summary = dict(n_tasks=0, n_completed_tasks=0, n_task_runs=0,
+                       n_registered_volunteers=0,
+                       n_anonymous_volunteers=0, last_activity=None)
+    if row is not None:
+        for key in COUNTERS:
+            if getattr(row, key) is not None:
+                app_summary[key] = getattr(row, key)
+    app_summary['n_volunteers'] = (
+        app_summary['n_anonymous_volunteers'] +
+        app_summary['n_registered_volunteers'])
+    if app_summary['n_tasks'] != 0:
+        app_summary['overall_progress'] = (
+            (app_summary['n_completed_tasks'] * 100) /
+            app_summary['n_tasks'])
+    else:
+        app_summary['overall_progress'] = 0
+    return app_summary
+
+
+def summaries(app_ids):
+    """Return the summaries of the apps in app_ids, read with a single query
+    from the project_stats table (which is always up to date, so they are
+    not cached)."""
+    if not app_ids:
+        return []
+    sql = text('''SELECT app_id, %s FROM project_stats
+               WHERE app_id = ANY(:app_ids);''' % ', '.join(COUNTERS))
+    results = session.execute(sql, dict(app_ids=app_ids))
+    rows = dict((row.app_id, row) for row in results)
+    missing = [app_id for app_id in app_ids if app_id not in rows]
+    if missing:
+        rows.update(_count_summaries(missing))
+    return [_summary(rows.get(app_id)) for app_id in app_ids]
+
+
+def summary(app_id):
+    """Return a dict with all the counters of an app (n_tasks,
+    n_completed_tasks, n_task_runs, n_registered_volunteers,
+    n_anonymous_volunteers, n_volunteers, overall_progress and
+    last_activity)."""
+    return summaries([app_id])[0]
+
+
 def n_tasks(app_id):
-    sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task
-                  WHERE task.app_id=:app_id''')
-    results = session.execute(sql, dict(app_id=app_id))
-    n_tasks = 0
-    for row in results:
-        n_tasks = row.n_tasks
-    return n_tasks
+    return summary(app_id)['n_tasks']
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
 def n_completed_tasks(app_id):
-    sql = text('''SELECT COUNT(task.id) AS n_completed_tasks FROM task
-                WHERE task.app_id=:app_id AND task.state=\'completed\';''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    n_completed_tasks = 0
-    for row in results:
-        n_completed_tasks = row.n_completed_tasks
-    return n_completed_tasks
+    return summary(app_id)['n_completed_tasks']
 
 
-@memoize(timeout=timeouts.get('REGISTERED_USERS_TIMEOUT'))
 def n_registered_volunteers(app_id):
-    sql = text('''SELECT COUNT(DISTINCT(task_run.user_id)) AS n_registered_volunteers FROM task_run
-           WHERE task_run.user_id IS NOT NULL AND
-           task_run.user_ip IS NULL AND
-           task_run.app_id=:app_id;''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    n_registered_volunteers = 0
-    for row in results:
-        n_registered_volunteers = row.n_registered_volunteers
-    return n_registered_volunteers
+    return summary(app_id)['n_registered_volunteers']
 
 
-@memoize(timeout=timeouts.get('ANON_USERS_TIMEOUT'))
 def n_anonymous_volunteers(app_id):
-    sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip)) AS n_anonymous_volunteers FROM task_run
-           WHERE task_run.user_ip IS NOT NULL AND
-           task_run.user_id IS NULL AND
-           task_run.app_id=:app_id;''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    n_anonymous_volunteers = 0
-    for row in results:
-        n_anonymous_volunteers = row.n_anonymous_volunteers
-    return n_anonymous_volunteers
+    return summary(app_id)['n_anonymous_volunteers']
 
 
-@memoize()
 def n_volunteers(app_id):
-    return n_anonymous_volunteers(app_id) + n_registered_volunteers(app_id)
+    return summary(app_id)['n_volunteers']
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
 def n_task_runs(app_id):
-    sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
-                  WHERE task_run.app_id=:app_id''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    n_task_runs = 0
-    for row in results:
-        n_task_runs = row.n_task_runs
-    return n_task_runs
+    return summary(app_id)['n_task_runs']
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
 def overall_progress(app_id):
     """Returns the percentage of submitted Tasks Runs done when a task is
     completed"""
-    if n_tasks(app_id) != 0:
-        return ((n_completed_tasks(app_id) * 100)/ n_tasks(app_id))
-    else:
-        return 0
+    return summary(app_id)['overall_progress']
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
 def last_activity(app_id):
-    sql = text('''SELECT finish_time FROM task_run WHERE app_id=:app_id
-               ORDER BY finish_time DESC LIMIT 1''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        if row is not None:
-            return row[0]
-        else:  # pragma: no cover
-            return None
+    return summary(app_id)['last_activity']
+
+
+def add_stats(apps, with_last_activity=True):
+    """Add the overall_progress, n_tasks, n_volunteers and (optionally)
+    last_activity of each app dict in apps, getting their summaries in a
+    batch instead of one by one."""
+    app_summaries = summaries([app['id'] for app in apps])
+    for app, app_summary in zip(apps, app_summaries):
+        app['overall_progress'] = app_summary['overall_progress']
+        app['n_tasks'] = app_summary['n_tasks']
+        app['n_volunteers'] = app_summary['n_volunteers']
+        if with_last_activity:
+            app['last_activity'] = pretty_date(app_summary['last_activity'])
+            app['last_activity_raw'] = app_summary['last_activity']
+    return apps
 
 
 # This function does not change too much, so cache it for a longer time
@@ -201,15 +239,10 @@ def get_featured(category=None, page=1, per_page=5):
     for row in results:
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    created=row.created, description=row.description,
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
                    owner=row.owner,
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=dict(json.loads(row.info)))
         apps.append(app)
-    return apps
+    return add_stats(apps)
 
 
 @cache(key_prefix="number_published_apps",
@@ -266,14 +299,9 @@ def get_draft(category=None, page=1, per_page=5):
                    created=row.created,
                    description=row.description,
                    owner=row.owner,
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=dict(json.loads(row.info)))
         apps.append(app)
-    return apps
+    return add_stats(apps)
 
 
 @memoize(timeout=timeouts.get('N_APPS_PER_CATEGORY_TIMEOUT'))
@@ -331,14 +359,9 @@ def get(category, page=1, per_page=5):
                    description=row.description,
                    owner=row.owner,
                    featured=row.featured,
-                   last_activity=pretty_date(last_activity(row.id)),
-                   last_activity_raw=last_activity(row.id),
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=dict(json.loads(row.info)))
         apps.append(app)
-    return apps
+    return add_stats(apps)
 
 
 # TODO: find a convenient cache timeout and cache, if needed
@@ -373,54 +396,6 @@ def delete_app(short_name):
     delete_memoized(get_app, short_name)
 
 
-def delete_n_tasks(app_id):
-    """Reset n_tasks value in cache"""
-    delete_memoized(n_tasks, app_id)
-
-
-def delete_n_completed_tasks(app_id):
-    """Reset n_completed_tasks value in cache"""
-    delete_memoized(n_completed_tasks, app_id)
-
-
-def delete_n_task_runs(app_id):
-    """Reset n_tasks value in cache"""
-    delete_memoized(n_task_runs, app_id)
-
-
-def delete_overall_progress(app_id):
-    """Reset overall_progress value in cache"""
-    delete_memoized(overall_progress, app_id)
-
-
-def delete_last_activity(app_id):
-    """Reset last_activity value in cache"""
-    delete_memoized(last_activity, app_id)
-
-
-def delete_n_registered_volunteers(app_id):
-    """Reset n_registered_volunteers value in cache"""
-    delete_memoized(n_registered_volunteers, app_id)
-
-
-def delete_n_anonymous_volunteers(app_id):
-    """Reset n_anonymous_volunteers value in cache"""
-    delete_memoized(n_anonymous_volunteers, app_id)
-
-
-def delete_n_volunteers(app_id):
-    """Reset n_volunteers value in cache"""
-    delete_memoized(n_volunteers, app_id)
-
-
 def clean(app_id):
     """Clean all items in cache"""
     reset()
-    delete_n_tasks(app_id)
-    delete_n_completed_tasks(app_id)
-    delete_n_task_runs(app_id)
-    delete_overall_progress(app_id)
-    delete_last_activity(app_id)
-    delete_n_registered_volunteers(app_id)
-    delete_n_anonymous_volunteers(app_id)
-    delete_n_volunteers(app_id)
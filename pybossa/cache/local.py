@@ -0,0 +1,113 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+This module exports the in process cache that sits in front of Redis.
+
+It exports:
+    * LocalCache: a bounded LRU cache with a short time to live, with hit and
+      miss counters
+    * InvalidationListener: a thread that listens to the invalidations
+      published in Redis by any process, and applies them to a LocalCache
+
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LocalCache(object):
+
+    """Bounded LRU cache with a time to live for its entries."""
+
+    def __init__(self, size=1000, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for key, or None if there is none or it
+        has expired."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            # Put it back as the most recently used
+            self._data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        """Store a value for key, evicting the least recently used entry if
+        the cache is full."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.timeout, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Delete key, or every key starting with it if it ends with '*'."""
+        with self._lock:
+            if key.endswith('*'):
+                prefix = key[:-1]
+                for k in [k for k in self._data if k.startswith(prefix)]:
+                    del self._data[k]
+            else:
+                self._data.pop(key, None)
+
+    def clear(self):
+        """Delete every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return the hits, misses and number of entries of the cache."""
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data))
+
+
+class InvalidationListener(threading.Thread):
+
+    """Thread that applies the invalidations published in a Redis channel to
+    a LocalCache."""
+
+    retry_interval = 1
+
+    def __init__(self, local_cache, redis_conn, channel):
+        super(InvalidationListener, self).__init__()
+        self.daemon = True
+        self.local_cache = local_cache
+        self.redis = redis_conn
+        self.channel = channel
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(self.channel)
+                # Invalidations may have been missed while not subscribed
+                self.local_cache.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.local_cache.delete(message['data'])
+            except Exception:
+                self.local_cache.clear()
+                time.sleep(self.retry_interval)
@@ -17,114 +17,203 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import current_app
+from redis.exceptions import WatchError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
-from pybossa.core import db
+from pybossa.core import db, sentinel
 from pybossa.cache import memoize, ONE_DAY
 
 import pygeoip
 import operator
 import time
 import datetime
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
 
 
 session = db.slave_session
 
+#: Seconds the aggregates of an app are kept in Redis since its last update
+STATS_TIMEOUT = 7 * ONE_DAY
+#: The task_runs with an id up to ID_OVERLAP lower than the high-water mark
+#: are read again, as the ids of concurrent transactions are not committed
+#: in order
+ID_OVERLAP = 1000
+
 @memoize(timeout=ONE_DAY)
 def n_tasks(app_id):
     from .apps import n_tasks
     return n_tasks(app_id)
 
 
-@memoize(timeout=ONE_DAY)
-def stats_users(app_id):
-    """Return users's stats for a given app_id"""
-    users = {}
-    auth_users = []
-    anon_users = []
-
-    # Get Authenticated Users
-    sql = text('''SELECT task_run.user_id AS user_id,
-               COUNT(task_run.id) as n_tasks FROM task_run
-               WHERE task_run.user_id IS NOT NULL AND
-               task_run.user_ip IS NULL AND
-               task_run.app_id=:app_id
-               GROUP BY task_run.user_id ORDER BY n_tasks DESC
-               LIMIT 5;''')
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        auth_users.append([row.user_id, row.n_tasks])
-
-    sql = text('''SELECT count(distinct(task_run.user_id)) AS user_id FROM task_run
-               WHERE task_run.user_id IS NOT NULL AND
-               task_run.user_ip IS NULL AND
-               task_run.app_id=:app_id;''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        users['n_auth'] = row[0]
-
-    # Get all Anonymous Users
-    sql = text('''SELECT task_run.user_ip AS user_ip,
-               COUNT(task_run.id) as n_tasks FROM task_run
-               WHERE task_run.user_ip IS NOT NULL AND
-               task_run.user_id IS NULL AND
-               task_run.app_id=:app_id
-               GROUP BY task_run.user_ip ORDER BY n_tasks DESC;''').execution_options(stream=True)
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        anon_users.append([row.user_ip, row.n_tasks])
-
-    sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip)) AS user_ip FROM task_run
-               WHERE task_run.user_ip IS NOT NULL AND
-               task_run.user_id IS NULL AND
-               task_run.app_id=:app_id;''')
-
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        users['n_anon'] = row[0]
-
-    return users, anon_users, auth_users
+def _hours():
+    return dict((str(i).zfill(2), 0) for i in range(0, 24))
+
+
+def _inc(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _max(counts):
+    """Return the maximum of the counts, or None if they are all 0 (as the
+    MAX() of no rows)."""
+    return max(counts.values()) or None
+
+
+def _stats_key(app_id):
+    return 'pybossa:stats:app:%s' % app_id
+
+
+def _empty_state():
+    return dict(last_id=0, seen=set(), hours=_hours(), hours_anon=_hours(),
+                hours_auth=_hours(), dates_anon={}, dates_auth={},
+                auth_counts={}, anon_counts={}, recent={})
+
+
+def _fold(state, app_id):
+    """Add to state the task_runs of an app with an id greater than its
+    last_id (the high-water mark), streaming them once.
+
+    The ids in the ID_OVERLAP below last_id are read again, and the ones in
+    seen (which were already added) are skipped.
+
+    finish_time is an ISO 8601 string, so the day and hour of a task_run are
+    slices of it and are not parsed.
+
+    """
+    hours = state['hours']
+    hours_anon = state['hours_anon']
+    hours_auth = state['hours_auth']
+    dates_anon = state['dates_anon']
+    dates_auth = state['dates_auth']
+    auth_counts = state['auth_counts']
+    anon_counts = state['anon_counts']
+    # Answers per day of the tasks with answers in the last 2 weeks
+    recent = state['recent']
+    since = (datetime.datetime.utcnow() -
+             datetime.timedelta(days=14)).strftime('%Y-%m-%d')
+    for task_id in recent.keys():
+        for day in [day for day in recent[task_id] if day <= since]:
+            del recent[task_id][day]
+        if not recent[task_id]:
+            del recent[task_id]
+
+    sql = text('''SELECT id, task_id, user_id, user_ip, finish_time
+               FROM task_run WHERE app_id=:app_id AND id > :since_id
+               ORDER BY id;''').execution_options(stream_results=True)
+    since_id = max(state['last_id'] - ID_OVERLAP, 0)
+    seen = state.setdefault('seen', set())
+    results = session.execute(sql, dict(app_id=app_id, since_id=since_id))
+    for _id, task_id, user_id, user_ip, finish_time in results:
+        if _id in seen:
+            continue
+        seen.add(_id)
+        state['last_id'] = max(state['last_id'], _id)
+        anon = user_id is None
+        auth = user_ip is None
+        if auth and not anon:
+            _inc(auth_counts, user_id)
+        if anon and not auth:
+            _inc(anon_counts, user_ip)
+        if finish_time is None:
+            continue
+        day = finish_time[:10]
+        hour = finish_time[11:13]
+        _inc(hours, hour)
+        if anon:
+            _inc(hours_anon, hour)
+            _inc(dates_anon, day)
+        if auth:
+            _inc(hours_auth, hour)
+            _inc(dates_auth, day)
+        if day > since:
+            _inc(recent.setdefault(task_id, {}), day)
+    state['seen'] = set(_id for _id in seen
+                        if _id > state['last_id'] - ID_OVERLAP)
+    return state
+
+
+def update_stats(app_id):
+    """Fold the task_runs sent since the last update into the aggregates of
+    an app persisted in Redis, and return them.
+
+    The cost is proportional to the new task_runs, not to the whole history
+    of the app. The aggregates are rebuilt from scratch if they have been
+    reset (see reset_stats) or have not been updated for STATS_TIMEOUT.
+
+    The aggregates are only written if they have not changed since they were
+    read (they are WATCHed), so a reset during a fold is not overwritten with
+    the old ones: they are read and folded again.
+
+    """
+    key = _stats_key(app_id)
+    with sentinel.master.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                state = pipe.get(key)
+                state = pickle.loads(state) if state else _empty_state()
+                state = _fold(state, app_id)
+                pipe.multi()
+                pipe.setex(key, STATS_TIMEOUT, pickle.dumps(state))
+                pipe.execute()
+                return state
+            except WatchError:
+                continue
+
+
+def reset_stats(app_id):
+    """Delete the aggregates of an app, so they are rebuilt from scratch the
+    next time (needed when task_runs are deleted)."""
+    sentinel.master.delete(_stats_key(app_id))
+
+
+def reset_stats_after_commit(session, app_id):
+    """Reset the aggregates of an app once session commits (the Task and
+    TaskRun after_delete listeners call this), so they are not folded again
+    from the task_runs that are still there until then."""
+    session.info.setdefault('reset_stats', set()).add(app_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _reset_committed_stats(session):
+    for app_id in session.info.pop('reset_stats', ()):
+        reset_stats(app_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back_stats(session):
+    session.info.pop('reset_stats', None)
 
 
 @memoize(timeout=ONE_DAY)
-def stats_dates(app_id):
+def scan_task_runs(app_id):
+    """Return the hours, users and dates stats of an app, from its up to
+    date aggregates."""
+    state = update_stats(app_id)
+    hours = state['hours']
+    hours_anon = state['hours_anon']
+    hours_auth = state['hours_auth']
+    recent = state['recent']
+
+    # A task is completed the first day its answers reach its n_answers
     dates = {}
-    dates_anon = {}
-    dates_auth = {}
-
-    n_tasks(app_id)
-
-    # Get all completed tasks
-    sql = text('''
-            WITH answers AS (
-             SELECT
-             TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-             AS day, task.id, task.n_answers AS n_answers,
-             COUNT(task_run.id) AS day_answers
-             FROM task_run, task WHERE task_run.app_id=:app_id
-             AND task.id=task_run.task_id AND
-             TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') >= NOW()
-               - '2 week':: INTERVAL GROUP BY day, task.id)
-            SELECT to_char(day_of_completion, 'YYYY-MM-DD') AS day,
-               COUNT(task_id) AS completed_tasks FROM (
-                SELECT MIN(day) AS day_of_completion, task_id FROM (
-                    SELECT ans1.day, ans1.id as task_id,
-                    floor(avg(ans1.n_answers)) AS n_answers,
-                    sum(ans2.day_answers) AS accum_answers
-                    FROM answers AS ans1 INNER JOIN answers AS ans2
-                    ON ans1.id=ans2.id WHERE ans1.day >= ans2.day
-                    GROUP BY ans1.id, ans1.day) AS answers_day_task
-                WHERE n_answers <= accum_answers
-                GROUP BY task_id) AS completed_tasks_by_day
-            GROUP BY day;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        dates[row.day] = row.completed_tasks
+    if recent:
+        sql = text('''SELECT id, n_answers FROM task
+                   WHERE id = ANY(:task_ids);''')
+        results = session.execute(sql, dict(task_ids=recent.keys()))
+        for task_id, n_answers in results:
+            if n_answers is None:
+                continue
+            accum_answers = 0
+            for day in sorted(recent[task_id]):
+                accum_answers += recent[task_id][day]
+                if n_answers <= accum_answers:
+                    _inc(dates, day)
+                    break
 
     # No completed tasks in the last 15 days
     if len(dates.keys()) == 0:
@@ -133,151 +222,31 @@ def stats_dates(app_id):
             tmp_date = base - datetime.timedelta(days=x)
             dates[tmp_date.strftime('%Y-%m-%d')] = 0
 
-    # Get all answers per date for auth
-    sql = text('''
-                WITH myquery AS (
-                    SELECT TO_DATE(finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') as d,
-                                   COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_ip IS NULL GROUP BY d)
-               SELECT to_char(d, 'YYYY-MM-DD') as d, count from myquery;
-               ''').execution_options(stream=True)
+    auth_counts = state['auth_counts']
+    anon_counts = state['anon_counts']
+    by_tasks = operator.itemgetter(1)
+    auth_users = sorted(auth_counts.items(), key=by_tasks, reverse=True)[:5]
+    anon_users = sorted(anon_counts.items(), key=by_tasks, reverse=True)
+    users = dict(n_auth=len(auth_counts), n_anon=len(anon_counts))
 
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        dates_auth[row.d] = row.count
+    return ((hours, hours_anon, hours_auth,
+             _max(hours), _max(hours_anon), _max(hours_auth)),
+            (users, [list(u) for u in anon_users],
+             [list(u) for u in auth_users]),
+            (dates, state['dates_anon'], state['dates_auth']))
 
-    # Get all answers per date for anon
-    sql = text('''
-                WITH myquery AS (
-                    SELECT TO_DATE(finish_time, 'YYYY-MM-DD\THH24:MI:SS.US') as d,
-                                   COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_id IS NULL GROUP BY d)
-               SELECT to_char(d, 'YYYY-MM-DD') as d, count  from myquery;
-               ''').execution_options(stream=True)
 
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        dates_anon[row.d] = row.count
+def stats_users(app_id):
+    """Return users's stats for a given app_id"""
+    return scan_task_runs(app_id)[1]
 
-    return dates, dates_anon, dates_auth
+
+def stats_dates(app_id):
+    return scan_task_runs(app_id)[2]
 
 
-@memoize(timeout=ONE_DAY)
 def stats_hours(app_id):
-    hours = {}
-    hours_anon = {}
-    hours_auth = {}
-    max_hours = 0
-    max_hours_anon = 0
-    max_hours_auth = 0
-
-    # initialize hours keys
-    for i in range(0, 24):
-        hours[str(i).zfill(2)] = 0
-        hours_anon[str(i).zfill(2)] = 0
-        hours_auth[str(i).zfill(2)] = 0
-
-    # Get hour stats for all users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        hours[row.h] = row.count
-
-    # Get maximum stats for all users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        max_hours = row.max
-
-    # Get hour stats for Anonymous users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_id IS NULL GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        hours_anon[row.h] = row.count
-
-    # Get maximum stats for Anonymous users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_id IS NULL GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        max_hours_anon = row.max
-
-
-    # Get hour stats for Auth users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_ip IS NULL GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-
-    for row in results:
-        hours_auth[row.h] = row.count
-
-    # Get hour stats for Anon users
-    sql = text('''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE app_id=:app_id AND user_ip IS NULL GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, dict(app_id=app_id))
-    for row in results:
-        max_hours_auth = row.max
-
-    return hours, hours_anon, hours_auth, max_hours, max_hours_anon, max_hours_auth
+    return scan_task_runs(app_id)[0]
 
 
 @memoize(timeout=ONE_DAY)
@@ -429,15 +398,11 @@ def stats_format_users(app_id, users, anon_users, auth_users, geo=False):
 @memoize(timeout=ONE_DAY)
 def get_stats(app_id, geo=False):
     """Return the stats of a given app"""
+    hours_stats, users_stats, dates_stats = scan_task_runs(app_id)
     hours, hours_anon, hours_auth, max_hours, \
-        max_hours_anon, max_hours_auth = stats_hours(app_id)
-    users, anon_users, auth_users = stats_users(app_id)
-    dates, dates_anon, dates_auth = stats_dates(app_id)
-
-    n_tasks(app_id)
-    sum(dates.values())
-
-    sorted(dates.iteritems(), key=operator.itemgetter(0))
+        max_hours_anon, max_hours_auth = hours_stats
+    users, anon_users, auth_users = users_stats
+    dates, dates_anon, dates_auth = dates_stats
 
     dates_stats = stats_format_dates(app_id, dates,
                                      dates_anon, dates_auth)
@@ -17,12 +17,14 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import datetime
 import pygeoip
 from sqlalchemy.sql import text
 from flask import current_app
 
 from pybossa.core import db
 from pybossa.cache import cache, ONE_DAY
+from pybossa.model.project_stats import SITE
 
 session = db.slave_session
 
@@ -35,42 +37,58 @@ def n_auth_users():
     return n_auth or 0
 
 
+def _site_stats():
+    """Return the site counters from project_stats: the sums of the project
+    rows, and the distinct anonymous volunteers of the SITE row.
+
+    The volunteers can not be added up from the project rows (the same one
+    helps in many projects), so they are the ones the reconcile_project_stats
+    job counted in its last run.
+
+    """
+    sql = text('''SELECT SUM(n_tasks) AS n_tasks,
+               SUM(n_answers) AS n_answers,
+               SUM(n_task_runs) AS n_task_runs,
+               (SELECT n_anonymous_volunteers FROM project_stats
+                WHERE app_id=:site) AS n_anonymous_volunteers
+               FROM project_stats WHERE app_id!=:site;''')
+    return session.execute(sql, dict(site=SITE)).first()
+
+
 @cache(timeout=ONE_DAY, key_prefix="site_n_anon_users")
-def n_anon_users():
-    sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip))
-               AS n_anon FROM task_run;''')
+def _n_anon_users_from_scratch():
+    """Count the distinct anonymous volunteers, while there is no SITE row
+    (reconcile_project_stats has not run yet)."""
+    sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip)) AS n_anon
+               FROM task_run WHERE task_run.user_id IS NULL;''')
+    return session.execute(sql).first().n_anon or 0
 
-    results = session.execute(sql)
-    for row in results:
-        n_anon = row.n_anon
-    return n_anon or 0
+
+def n_anon_users():
+    n_anon = _site_stats().n_anonymous_volunteers
+    if n_anon is None:
+        return _n_anon_users_from_scratch()
+    return n_anon
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_tasks")
 def n_tasks_site():
-    sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task''')
-    results = session.execute(sql)
-    for row in results:
-        n_tasks = row.n_tasks
-    return n_tasks or 0
+    return _site_stats().n_tasks or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_total_tasks")
 def n_total_tasks_site():
-    sql = text('''SELECT SUM(n_answers) AS n_tasks FROM task''')
-    results = session.execute(sql)
-    for row in results:
-        total = row.n_tasks
-    return total or 0
+    return _site_stats().n_answers or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_task_runs")
 def n_task_runs_site():
-    sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run''')
-    results = session.execute(sql)
-    for row in results:
-        n_task_runs = row.n_task_runs
-    return n_task_runs or 0
+    return _site_stats().n_task_runs or 0
+
+
+def _last_24_hours():
+    """Return the ISO 8601 bounds of the last 24 hours, to compare them with
+    the finish_time of the task runs (which sort chronologically)."""
+    now = datetime.datetime.utcnow()
+    return dict(since=(now - datetime.timedelta(hours=24)).isoformat(),
+                now=now.isoformat())
 
 
 @cache(timeout=ONE_DAY, key_prefix="site_top5_apps_24_hours")
@@ -80,12 +98,12 @@ def get_top5_apps_24_hours():
                COUNT(task_run.app_id) AS n_answers FROM app, task_run
                WHERE app.id=task_run.app_id
                AND app.hidden=0
-               AND DATE(task_run.finish_time) > NOW() - INTERVAL '24 hour'
-               AND DATE(task_run.finish_time) <= NOW()
+               AND task_run.finish_time > :since
+               AND task_run.finish_time <= :now
                GROUP BY app.id
                ORDER BY n_answers DESC LIMIT 5;''')
 
-    results = session.execute(sql, dict(limit=5))
+    results = session.execute(sql, _last_24_hours())
     top5_apps_24_hours = []
     for row in results:
         tmp = dict(id=row.id, name=row.name, short_name=row.short_name,
@@ -100,12 +118,12 @@ def get_top5_users_24_hours():
     sql = text('''SELECT "user".id, "user".fullname, "user".name,
                COUNT(task_run.app_id) AS n_answers FROM "user", task_run
                WHERE "user".id=task_run.user_id
-               AND DATE(task_run.finish_time) > NOW() - INTERVAL '24 hour'
-               AND DATE(task_run.finish_time) <= NOW()
+               AND task_run.finish_time > :since
+               AND task_run.finish_time <= :now
                GROUP BY "user".id
                ORDER BY n_answers DESC LIMIT 5;''')
 
-    results = session.execute(sql, dict(limit=5))
+    results = session.execute(sql, _last_24_hours())
     top5_users_24_hours = []
     for row in results:
         user = dict(id=row.id, fullname=row.fullname,
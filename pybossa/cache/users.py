@@ -20,7 +20,7 @@ from pybossa.core import db, timeouts
 from pybossa.cache import cache, memoize, delete_memoized
 from pybossa.util import pretty_date
 from pybossa.model.user import User
-from pybossa.cache.apps import overall_progress, n_tasks, n_volunteers
+from pybossa.cache.apps import add_stats
 import json
 
 
@@ -185,12 +185,9 @@ def apps_contributed(user_id):
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    owner_id=row.owner_id,
                    description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=json.loads(row.info))
         apps_contributed.append(app)
-    return apps_contributed
+    return add_stats(apps_contributed, with_last_activity=False)
 
 
 @memoize(timeout=timeouts.get('USER_TIMEOUT'))
@@ -215,12 +212,9 @@ def published_apps(user_id):
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    owner_id=row.owner_id,
                    description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=json.loads(row.info))
         apps_published.append(app)
-    return apps_published
+    return add_stats(apps_published, with_last_activity=False)
 
 
 @memoize(timeout=timeouts.get('USER_TIMEOUT'))
@@ -245,12 +239,9 @@ def draft_apps(user_id):
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    owner_id=row.owner_id,
                    description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=json.loads(row.info))
         apps_draft.append(app)
-    return apps_draft
+    return add_stats(apps_draft, with_last_activity=False)
 
 
 @memoize(timeout=timeouts.get('USER_TIMEOUT'))
@@ -275,12 +266,9 @@ def hidden_apps(user_id):
         app = dict(id=row.id, name=row.name, short_name=row.short_name,
                    owner_id=row.owner_id,
                    description=row.description,
-                   overall_progress=overall_progress(row.id),
-                   n_tasks=n_tasks(row.id),
-                   n_volunteers=n_volunteers(row.id),
                    info=json.loads(row.info))
         apps_published.append(app)
-    return apps_published
+    return add_stats(apps_published, with_last_activity=False)
 
 
 @memoize(timeout=timeouts.get('USER_TIMEOUT'))
@@ -109,10 +109,13 @@ def setup_uploader(app):
 def setup_exporter(app):
     global csv_exporter
     global json_exporter
+    global ndjson_exporter
     from pybossa.exporter.csv_export import CsvExporter
     from pybossa.exporter.json_export import JsonExporter
+    from pybossa.exporter.ndjson_export import NdjsonExporter
     csv_exporter = CsvExporter()
     json_exporter = JsonExporter()
+    ndjson_exporter = NdjsonExporter()
 
 def setup_markdown(app):
     misaka.init_app(app)
@@ -61,6 +61,15 @@ REDIS_DB = 0
 
 REDIS_KEYPREFIX = 'pybossa_cache'
 
+## In process cache in front of Redis: number of values kept by each process,
+## and seconds they are kept for
+CACHE_L1_ENABLED = False
+CACHE_L1_SIZE = 1000
+CACHE_L1_TIMEOUT = 5
+## Seconds a process can take to recompute a missed cache key (the rest wait
+## for it meanwhile)
+CACHE_LOCK_TIMEOUT = 30
+
 ## Default cache timeouts
 # App cache
 APP_TIMEOUT = 15 * 60
@@ -78,6 +87,15 @@ USER_TIMEOUT = 15 * 60
 USER_TOP_TIMEOUT = 24 * 60 * 60
 USER_TOTAL_TIMEOUT = 24 * 60 * 60
 
+## Scheduler
+# Serve the depth first scheduler from a Redis queue of open tasks per project
+SCHED_TASK_QUEUE = False
+# Reserve the tasks given to the users, so a task is not given to more users
+# than the answers it still needs. The reservation lasts for the project
+# time_limit or, if it has none, for SCHED_RESERVATION_TIMEOUT seconds
+SCHED_RESERVATION = False
+SCHED_RESERVATION_TIMEOUT = 10 * 60
+
 # Project Presenters
 PRESENTERS = ["basic", "image", "sound", "video", "map", "pdf"]
 # Default Google Docs spreadsheet template tasks URLs
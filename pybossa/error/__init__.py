@@ -35,6 +35,7 @@ class ErrorStatus(object):
 
     This class has the following methods:
         * format_exception: returns a Flask Response with the error.
+        * exception_dict: returns the error as a dict.
 
     """
 
@@ -55,6 +56,16 @@ class ErrorStatus(object):
 
         Returns a Flask Response with the error.
 
+        """
+        error = self.exception_dict(e, target, action)
+        return Response(json.dumps(error), status=error['status_code'],
+                        mimetype='application/json')
+
+    def exception_dict(self, e, target, action):
+        """
+        Format the exception to a dict, as in the body of the Response of
+        format_exception.
+
         """
         exception_cls = e.__class__.__name__
         if self.error_status.get(exception_cls):
@@ -69,5 +80,4 @@ class ErrorStatus(object):
                      target=target,
                      exception_cls=exception_cls,
                      exception_msg=str(e.message))
-        return Response(json.dumps(error), status=status,
-                        mimetype='application/json')
+        return error
@@ -18,20 +18,146 @@
 # Cache global variables for timeouts
 """
 Exporter module for exporting tasks and tasks results out of PyBossa
+
+This module exports:
+    * Exporter class: the base class of the JSON and CSV exporters
+    * write_zips: write the ZIPs of several exporters with one scan of the rows
+    * export_is_outdated, mark_exported and mark_export_outdated: track
+      whether the rows of a project changed since its ZIPs were pregenerated
+
 """
 
+import binascii
 import os
+import struct
+import time
 import zipfile
-from pybossa.core import uploader
+from cStringIO import StringIO
+from sqlalchemy.sql import text
+from pybossa.core import uploader, db, sentinel
+from pybossa.model.task import Task
+from pybossa.model.task_run import TaskRun
 from pybossa.uploader import local
 from unidecode import unidecode
 from flask import url_for, safe_join, send_file, redirect
 from werkzeug.utils import secure_filename
+try:
+    import zlib
+except ImportError: # pragma: no cover
+    zlib = None
+
+class ZipEntryWriter(object):
+
+    """Writable file for a new member of a ZipFile open for writing.
+
+    The data is compressed and written to the zip as it comes, instead of
+    being read back from another file. The CRC and the sizes are unknown until
+    the end, so they are written in a data descriptor after the data, with
+    ZIP64 sizes in case the member is a big one.
+
+    """
+
+    def __init__(self, zip, arcname):
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.compress_type = zip.compression
+        zinfo.external_attr = 0600 << 16
+        zinfo.flag_bits |= 0x08
+        zinfo.extract_version = zinfo.create_version = 45
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.header_offset = zip.fp.tell()
+        zip._writecheck(zinfo)
+        zip._didModify = True
+        zip.fp.write(zinfo.FileHeader(zip64=True))
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self._compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        else:
+            self._compressor = None
+        self._zip = zip
+        self._zinfo = zinfo
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        zinfo = self._zinfo
+        zinfo.file_size += len(data)
+        zinfo.CRC = binascii.crc32(data, zinfo.CRC) & 0xffffffff
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        zinfo.compress_size += len(data)
+        self._zip.fp.write(data)
+
+    def close(self):
+        """Finish the member. The zip has to be closed afterwards."""
+        zip, zinfo = self._zip, self._zinfo
+        if self._compressor is not None:
+            data = self._compressor.flush()
+            zinfo.compress_size += len(data)
+            zip.fp.write(data)
+            self._compressor = None
+        zip.fp.write(struct.pack('<4sLQQ', 'PK\x07\x08', zinfo.CRC,
+                                 zinfo.compress_size, zinfo.file_size))
+        zip.filelist.append(zinfo)
+        zip.NameToInfo[zinfo.filename] = zinfo
+
 
 class Exporter(object):
 
     """Abstract generic exporter class."""
 
+    #: Rows fetched from the server side cursor in every round trip
+    fetch_size = 2000
+
+    #: Extension of the exported file inside the ZIPs
+    export_format = None
+
+    #: Extension of the generated files
+    file_extension = 'zip'
+
+    _tables = dict(task=Task.__table__, task_run=TaskRun.__table__)
+
+    def _columns(self, table):
+        """Return the names of the columns of table (task or task_run), with
+        info as the last one."""
+        columns = [c.name for c in self._tables[table].columns
+                   if c.name != 'info']
+        return columns + ['info']
+
+    def _rows(self, table, app_id):
+        """Yield lists with the raw rows of table for an app, ordered by id,
+        from a server side cursor.
+
+        The rows have the values of the columns returned by _columns, with the
+        info column as its JSON text. No ORM object is built for them.
+
+        """
+        sql = text('''SELECT %s FROM %s WHERE app_id=:app_id ORDER BY id;'''
+                   % (', '.join(self._columns(table)), table))
+        sql = sql.execution_options(stream_results=True)
+        results = db.slave_session.execute(sql, dict(app_id=app_id))
+        while True:
+            rows = results.fetchmany(self.fetch_size)
+            if not rows:
+                break
+            yield rows
+
+    def _encoder(self, out, table, app_id):
+        """Return an encoder of the export of table for an app into the file
+        out. Its write method is called with every batch of rows from _rows,
+        and its close method after the last one."""
+        pass
+
+    def _generate(self, table, app_id):
+        """Yield the export of table for an app, in one chunk per batch of
+        rows."""
+        buf = StringIO()
+        encoder = self._encoder(buf, table, app_id)
+        for rows in self._rows(table, app_id):
+            encoder.write(rows)
+            yield _drain(buf)
+        encoder.close()
+        yield _drain(buf)
+
     def _app_name_latin_encoded(self, app):
         """app short name for later HTML header usage"""
         # name = app.short_name.encode('utf-8', 'ignore').decode('latin-1')
@@ -40,19 +166,44 @@ class Exporter(object):
 
     def _zip_factory(self, filename):
         """create a ZipFile Object with compression and allow big ZIP files (allowZip64)"""
-        try:
-            import zlib
-            assert zlib
+        if zlib is not None:
             zip_compression= zipfile.ZIP_DEFLATED
-        except Exception as ex:
-            print ex
+        else:
             zip_compression= zipfile.ZIP_STORED
         zip = zipfile.ZipFile(file=filename, mode='w', compression=zip_compression, allowZip64=True)
         return zip
 
+    def _write_zip(self, app, ty, arcname, write):
+        """Write the ZIP of a certain type straight into its destination in
+        the uploader, in one pass.
+
+        write is called with a writable file for the only member of the ZIP,
+        arcname, and writes the content to it.
+
+        """
+        with uploader.open_file(self.download_name(app, ty),
+                                self._container(app)) as out:
+            zip = self._zip_factory(out)
+            try:
+                entry = ZipEntryWriter(zip, arcname)
+                write(entry)
+                entry.close()
+            finally:
+                zip.close()
+
+    def _should_export(self, app, ty):
+        """Return False if the ZIP of a certain type is not generated for an
+        app (see write_zips)."""
+        return True
+
+    def _arcname(self, app, ty):
+        """Name of the file inside the ZIP of a certain type"""
+        name = self._app_name_latin_encoded(app)
+        return secure_filename('%s_%s.%s' % (name, ty, self.export_format))
+
     def _make_zip(self, app, ty):
         """Generate a ZIP of a certain type and upload it"""
-        pass
+        write_zips(app, ty, [self])
 
     def _container(self, app):
         return "user_%d" % app.owner_id
@@ -71,7 +222,8 @@ class Exporter(object):
            This function does not check if this filename actually exists!"""
         # TODO: Check if ty is valid
         name = self._app_name_latin_encoded(app)
-        filename = '%s_%s_%s_%s.zip' % (str(app.id), name, ty, format)  # Example: 123_feynman_tasks_json.zip
+        filename = '%s_%s_%s_%s.%s' % (str(app.id), name, ty, format,
+                                       self.file_extension)  # Example: 123_feynman_tasks_json.zip
         filename = secure_filename(filename)
         return filename
 
@@ -117,3 +269,83 @@ class Exporter(object):
 
 
 
+
+
+def _drain(buf):
+    value = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return value
+
+
+def write_zips(app, ty, exporters):
+    """Generate and upload the ZIP of a certain type of every exporter,
+    feeding each batch of rows to all of them, so the rows are read from the
+    database only once. The exporters whose _should_export returns False
+    are skipped."""
+    def write(encoders, exporters):
+        if exporters:
+            exporter = exporters[0]
+            exporter._write_zip(
+                app, ty, exporter._arcname(app, ty),
+                lambda out: write(
+                    encoders + [exporter._encoder(out, ty, app.id)],
+                    exporters[1:]))
+        else:
+            for rows in Exporter()._rows(ty, app.id):
+                for encoder in encoders:
+                    encoder.write(rows)
+            for encoder in encoders:
+                encoder.close()
+    write([], [exporter for exporter in exporters
+               if exporter._should_export(app, ty)])
+
+
+#: Time to keep the watermark of an export, after which it is regenerated
+#: anyway
+EXPORT_WATERMARK_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def _watermark_key(app_id, ty):
+    return 'pybossa:export:%s:%s' % (app_id, ty)
+
+
+def export_watermark(app_id, ty):
+    """Return a value that changes whenever rows of a certain type of a
+    project are added, deleted or completed, or None if it is unknown.
+
+    It is made of the counters of the project in project_stats and the
+    latest id of the table.
+
+    """
+    counters = dict(task=('n_tasks', 'n_completed_tasks', 'n_answers'),
+                    task_run=('n_task_runs',))[ty]
+    sql = text('''SELECT %s, (SELECT MAX(id) FROM %s WHERE app_id=:app_id)
+               FROM project_stats WHERE app_id=:app_id;'''
+               % (', '.join(counters), ty))
+    row = db.slave_session.execute(sql, dict(app_id=app_id)).first()
+    if row is None:
+        return None
+    return ':'.join(str(value) for value in row)
+
+
+def export_is_outdated(app_id, ty):
+    """Return True if the rows of a certain type of a project changed since
+    their ZIPs were last generated."""
+    watermark = export_watermark(app_id, ty)
+    return (watermark is None or
+            sentinel.slave.get(_watermark_key(app_id, ty)) != watermark)
+
+
+def mark_exported(app_id, ty, watermark):
+    """Store the watermark the ZIPs of a certain type of a project were
+    generated for."""
+    if watermark is not None:
+        sentinel.master.setex(_watermark_key(app_id, ty),
+                              EXPORT_WATERMARK_TIMEOUT, watermark)
+
+
+def mark_export_outdated(app_id, ty):
+    """Forget the watermark of the ZIPs of a certain type of a project, for
+    changes the watermark does not reflect (e.g. rows edited in place)."""
+    sentinel.master.delete(_watermark_key(app_id, ty))
@@ -21,139 +21,89 @@ CSV Exporter module for exporting tasks and tasks results out of PyBossa
 """
 
 from pybossa.exporter import Exporter
-import tempfile
-from pybossa.core import uploader, task_repo
-from pybossa.model.task import Task
-from pybossa.model.task_run import TaskRun
-from flask.ext.babel import gettext
+import json
+from sqlalchemy.sql import text
+from pybossa.core import task_repo, db
 from pybossa.util import UnicodeWriter
-import pybossa.model as model
-from werkzeug.datastructures import FileStorage
-from werkzeug.utils import secure_filename
 from flask import abort
 
 
+class CsvEncoder(object):
+
+    """Write the CSV of the rows of a table to a file, batch by batch, with
+    the header and fields returned by CsvExporter._schema."""
+
+    def __init__(self, out, columns, header, fields):
+        self.positions = dict((name, i) for i, name in enumerate(columns))
+        self.fields = fields
+        self.writer = UnicodeWriter(out)
+        self.writer.writerow(header)
+
+    def write(self, rows):
+        positions = self.positions
+        for row in rows:
+            row = list(row)
+            info = row[-1] = json.loads(row[-1]) if row[-1] else None
+            if not isinstance(info, dict):
+                info = {}
+            self.writer.writerow([info.get(name) if source == 'info'
+                                  else row[positions[name]]
+                                  for source, name in self.fields])
+
+    def close(self):
+        pass
+
+
 class CsvExporter(Exporter):
 
-    def _format_csv_properly(self, row, ty=None):
-        tmp = row.keys()
-        task_keys = []
-        for k in tmp:
-            k = "%s__%s" % (ty, k)
-            task_keys.append(k)
-        if (type(row['info']) == dict):
-            task_info_keys = []
-            tmp = row['info'].keys()
-            for k in tmp:
-                k = "%sinfo__%s" % (ty, k)
-                task_info_keys.append(k)
-        else:
-            task_info_keys = []
-
-        keys = sorted(task_keys + task_info_keys)
-        values = []
-        _prefix = "%sinfo" % ty
-        for k in keys:
-            prefix, k = k.split("__")
-            if prefix == _prefix:
-                if row['info'].get(k) is not None:
-                    values.append(row['info'][k])
-                else:
-                    values.append(None)
-            else:
-                if row.get(k) is not None:
-                    values.append(row[k])
-                else:
-                    values.append(None)
-
-        return values
-
-    def _handle_task(self, writer, t):
-        writer.writerow(self._format_csv_properly(t.dictize(), ty='task'))
-
-    def _handle_task_run(self, writer, t):
-        writer.writerow(self._format_csv_properly(t.dictize(), ty='taskrun'))
-
-    def _get_csv(self, out, writer, table, handle_row, id):
-        for tr in getattr(task_repo, 'filter_%ss_by' % table)(app_id=id,
-                                                              yielded=True):
-            handle_row(writer, tr)
-        out.seek(0)
-        yield out.read()
-
-    def _respond_csv(self, ty, id):
-        try:
-            # Export Task(/Runs) to CSV
-            types = {
-                "task": (
-                    model.task.Task, self._handle_task,
-                    (lambda x: True),
-                    gettext(
-                        "Oops, the project does not have tasks to \
-                        export, if you are the owner add some tasks")),
-                "task_run": (
-                    model.task_run.TaskRun, self._handle_task_run,
-                    (lambda x: True),
-                    gettext(
-                        "Oops, there are no Task Runs yet to export, invite \
-                         some users to participate"))}
-            try:
-                table, handle_row, test, msg = types[ty]
-            except KeyError:
-                return abort(404)  # TODO!
-
-            out = tempfile.TemporaryFile()
-            writer = UnicodeWriter(out)
-            t = getattr(task_repo, 'get_%s_by' % ty)(app_id=id)
-            if t is not None:
-                if test(t):
-                    tmp = t.dictize().keys()
-                    task_keys = []
-                    for k in tmp:
-                        k = "%s__%s" % (ty, k)
-                        task_keys.append(k)
-                    if (type(t.info) == dict):
-                        task_info_keys = []
-                        tmp = t.info.keys()
-                        for k in tmp:
-                            k = "%sinfo__%s" % (ty, k)
-                            task_info_keys.append(k)
-                    else:
-                        task_info_keys = []
-                    keys = task_keys + task_info_keys
-                    writer.writerow(sorted(keys))
-
-                return self._get_csv(out, writer, ty, handle_row, id)
-            else:
-                pass  # TODO
-        except:  # pragma: no cover
-            raise
+    export_format = 'csv'
+
+    def _info_keys(self, table, app_id):
+        """Return the union of the keys of the info of the rows of table for
+        an app, computed by the database without sending the rows (it needs
+        PostgreSQL 9.3 or newer)."""
+        sql = text('''SELECT DISTINCT json_object_keys(info::json) AS key
+                   FROM %s WHERE app_id=:app_id AND info LIKE '{%%';'''
+                   % table)
+        results = db.slave_session.execute(sql, dict(app_id=app_id))
+        return [row.key for row in results]
+
+    def _schema(self, table, app_id):
+        """Return the header of the CSV of table for an app, and the fields
+        of every column in the same order.
+
+        A field is ('column', name) for a column of the table, or
+        ('info', key) for a key of the info of the rows (which is empty for
+        the rows whose info does not have it).
+
+        """
+        columns = [("%s__%s" % (table, name), ('column', name))
+                   for name in self._columns(table)]
+        info_keys = [("%sinfo__%s" % (table, key), ('info', key))
+                     for key in self._info_keys(table, app_id)]
+        schema = sorted(columns + info_keys)
+        return [header for header, _ in schema], [field for _, field in schema]
+
+    def _encoder(self, out, table, app_id):
+        header, fields = self._schema(table, app_id)
+        return CsvEncoder(out, self._columns(table), header, fields)
+
+    def _write_csv(self, out, table, app_id):
+        """Write the CSV of table for an app to the file out, streaming the
+        rows from the database."""
+        encoder = self._encoder(out, table, app_id)
+        for rows in self._rows(table, app_id):
+            encoder.write(rows)
+        encoder.close()
+
+    def _should_export(self, app, ty):
+        """The CSV of an empty table is not generated."""
+        return getattr(task_repo, 'get_%s_by' % ty)(app_id=app.id) is not None
 
     def _make_zip(self, app, ty):
-        name = self._app_name_latin_encoded(app)
-        csv_task_generator = self._respond_csv(ty, app.id)
-        if csv_task_generator is not None:
-            # TODO: use temp file from csv generation directly
-            datafile = tempfile.NamedTemporaryFile()
-            try:
-                for line in csv_task_generator:
-                    datafile.write(str(line))
-                datafile.flush()
-                csv_task_generator.close()  # delete temp csv file
-                zipped_datafile = tempfile.NamedTemporaryFile()
-                try:
-                    zip = self._zip_factory(zipped_datafile.name)
-                    zip.write(
-                        datafile.name, secure_filename('%s_%s.csv' % (name, ty)))
-                    zip.close()
-                    container = "user_%d" % app.owner_id
-                    file = FileStorage(
-                        filename=self.download_name(app, ty), stream=zipped_datafile)
-                    uploader.upload_file(file, container=container)
-                finally:
-                    zipped_datafile.close()
-            finally:
-                datafile.close()
+        if ty not in self._tables:
+            return abort(404)
+        super(CsvExporter, self)._make_zip(app, ty)
 
     def download_name(self, app, ty):
         return super(CsvExporter, self).download_name(app, ty, 'csv')
@@ -22,49 +22,58 @@ JSON Exporter module for exporting tasks and tasks results out of PyBossa
 
 from pybossa.exporter import Exporter
 import json
-import tempfile
-from pybossa.core import uploader, task_repo
-from werkzeug.datastructures import FileStorage
-from werkzeug.utils import secure_filename
+
+
+class JsonEncoder(object):
+
+    """Write the JSON list of the rows of a table to a file, batch by batch.
+
+    The info of every row is copied as it is stored (it is already JSON),
+    instead of decoding and encoding it again.
+
+    """
+
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns[:-1]
+        self.sep = ""
+        out.write("[")
+
+    def _items(self, rows):
+        """Yield the JSON object of every row."""
+        for row in rows:
+            item = json.dumps(dict(zip(self.columns, row[:-1])))
+            info = row[-1] or 'null'
+            if isinstance(info, unicode):
+                info = info.encode('utf-8')
+            yield '%s, "info": %s}' % (item[:-1], info)
+
+    def write(self, rows):
+        chunk = []
+        for item in self._items(rows):
+            chunk.append(self.sep + item)
+            self.sep = ", "
+        self.out.write(''.join(chunk))
+
+    def close(self):
+        self.out.write("]")
+
 
 class JsonExporter(Exporter):
 
-    def _gen_json(self, table, id):
-        n = getattr(task_repo, 'count_%ss_with' % table)(app_id=id)
-        sep = ", "
-        yield "["
-        for i, tr in enumerate(getattr(task_repo, 'filter_%ss_by' % table)(app_id=id, yielded=True), 1):
-            item = json.dumps(tr.dictize())
-            if (i == n):
-                sep = ""
-            yield item + sep
-        yield "]"
+    export_format = 'json'
+
+    def _encoder(self, out, table, app_id):
+        return JsonEncoder(out, self._columns(table))
+
+    def gen_json(self, table, id):
+        """Yield the JSON list of the rows of table (task or task_run) of an
+        app, in chunks, streaming them from the database."""
+        return self._generate(table, id)
 
     def _respond_json(self, ty, id):    # TODO: Refactor _respond_json out?
         # TODO: check ty here
-        return self._gen_json(ty, id)
-
-    def _make_zip(self, app, ty):
-        name = self._app_name_latin_encoded(app)
-        json_task_generator = self._respond_json(ty, app.id)
-        if json_task_generator is not None:
-            datafile = tempfile.NamedTemporaryFile()
-            try:
-                for line in json_task_generator:
-                    datafile.write(str(line))
-                datafile.flush()
-                zipped_datafile = tempfile.NamedTemporaryFile()
-                try:
-                    zip = self._zip_factory(zipped_datafile.name)
-                    zip.write(datafile.name, secure_filename('%s_%s.json' % (name, ty)))
-                    zip.close()
-                    container = "user_%d" % app.owner_id
-                    file = FileStorage(filename=self.download_name(app, ty), stream=zipped_datafile)
-                    uploader.upload_file(file, container=container)
-                finally:
-                    zipped_datafile.close()
-            finally:
-                datafile.close()
+        return self.gen_json(ty, id)
 
     def download_name(self, app, ty):
         return super(JsonExporter, self).download_name(app, ty, 'json')
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+NDJSON Exporter module for exporting tasks and tasks results out of PyBossa
+
+The rows are written as newline delimited JSON (one object per line) in a
+gzip file, so they can be read and processed one by one.
+"""
+
+import gzip
+from pybossa.core import uploader
+from pybossa.exporter import Exporter
+from pybossa.exporter.json_export import JsonEncoder
+
+
+class NdjsonEncoder(JsonEncoder):
+
+    """Write the rows of a table to a file as newline delimited JSON, batch
+    by batch."""
+
+    def __init__(self, out, columns):
+        self.out = out
+        self.columns = columns[:-1]
+
+    def write(self, rows):
+        self.out.write(''.join('%s\n' % item for item in self._items(rows)))
+
+    def close(self):
+        pass
+
+
+class NdjsonExporter(Exporter):
+
+    export_format = 'ndjson'
+    file_extension = 'gz'
+
+    def _encoder(self, out, table, app_id):
+        return NdjsonEncoder(out, self._columns(table))
+
+    def _write_zip(self, app, ty, arcname, write):
+        """Write a gzip file instead of a ZIP, as there is only one member and
+        it can be decompressed as a stream."""
+        with uploader.open_file(self.download_name(app, ty),
+                                self._container(app)) as out:
+            gz = gzip.GzipFile(filename=arcname, mode='wb', fileobj=out)
+            try:
+                write(gz)
+            finally:
+                gz.close()
+
+    def download_name(self, app, ty):
+        return super(NdjsonExporter, self).download_name(app, ty, 'ndjson')
+
+    def pregenerate_zip_files(self, app):
+        print "%d (ndjson)" % app.id
+        self._make_zip(app, "task")
+        self._make_zip(app, "task_run")
@@ -78,6 +78,7 @@ uploader = None
 # Exporters
 json_exporter = None
 csv_exporter = None
+ndjson_exporter = None
 
 # CSRF protection
 from flask_wtf.csrf import CsrfProtect
@@ -29,7 +29,7 @@ class FlickrService(object):
 
     def init_app(self, app): # pragma: no cover
         from flask import session
-        from pybossa.core import importer
+        from pybossa.core import importer, sentinel
         self.app = app
         self.client = OAuth().remote_app(
             'flickr',
@@ -40,7 +40,8 @@ class FlickrService(object):
             consumer_secret=app.config['FLICKR_SHARED_SECRET'])
         tokengetter = functools.partial(self.get_token, session)
         self.client.tokengetter(tokengetter)
-        importer_params = {'api_key': app.config['FLICKR_API_KEY']}
+        importer_params = {'api_key': app.config['FLICKR_API_KEY'],
+                           'redis_conn': sentinel.master}
         importer.register_flickr_importer(importer_params)
 
     def get_user_albums(self, session):
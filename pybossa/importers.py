@@ -18,8 +18,11 @@
 
 import string
 import json
+import codecs
+import hashlib
 import requests
-from StringIO import StringIO
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from flask.ext.babel import gettext
 from pybossa.util import unicode_csv_reader
 
@@ -35,17 +38,21 @@ class _BulkTaskImport(object):
         """Returns a generator with all the tasks imported"""
         pass
 
-    def count_tasks(self, **form_data):
-        """Returns amount of tasks to be imported"""
-        return len([task for task in self.tasks(**form_data)])
+    def count_tasks(self, limit=None, **form_data):
+        """Returns amount of tasks to be imported, or limit if there are more
+        than that (then the source does not need to be read to the end)"""
+        return sum(1 for task in islice(self.tasks(**form_data), limit))
 
 
 class _BulkTaskCSVImport(_BulkTaskImport):
     importer_id = "csv"
 
+    #: Bytes read from the response at a time
+    chunk_size = 64 * 1024
+
     def tasks(self, **form_data):
         dataurl = self._get_data_url(**form_data)
-        r = requests.get(dataurl)
+        r = requests.get(dataurl, stream=True)
         return self._get_csv_data_from_request(r)
 
     def _get_data_url(self, **form_data):
@@ -86,10 +93,27 @@ class _BulkTaskCSVImport(_BulkTaskImport):
             msg = gettext("Oops! That file doesn't look like the right file.")
             raise BulkImportException(msg, 'error')
 
-        csvcontent = StringIO(r.text)
-        csvreader = unicode_csv_reader(csvcontent)
+        csvreader = unicode_csv_reader(self._iter_lines(r))
         return self._import_csv_tasks(csvreader)
 
+    def _iter_lines(self, r):
+        """Yield the decoded lines of the response as they are downloaded,
+        with their line endings (as quoted cells can have new lines)."""
+        decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(
+            errors='replace')
+        pending = u''
+        try:
+            for chunk in r.iter_content(self.chunk_size):
+                lines = (pending + decoder.decode(chunk)).split(u'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line + u'\n'
+            pending += decoder.decode('', final=True)
+            if pending:
+                yield pending
+        finally:
+            r.close()
+
 
 class _BulkTaskGDImport(_BulkTaskCSVImport):
     importer_id = "gdocs"
@@ -135,31 +159,72 @@ class _BulkTaskEpiCollectPlusImport(_BulkTaskImport):
 class _BulkTaskFlickrImport(_BulkTaskImport):
     importer_id = "flickr"
 
-    def __init__(self, api_key):
+    url = 'https://api.flickr.com/services/rest/'
+    #: Pages of an album requested at the same time
+    max_workers = 4
+    #: Seconds the first page of an album is kept between counting its
+    #: photos and importing them
+    album_cache_timeout = 5 * 60
+
+    def __init__(self, api_key, redis_conn=None):
         self.api_key = api_key
+        self.redis = redis_conn
 
     def tasks(self, **form_data):
-        album_info = self._get_album_info(form_data['album_id'])
-        return self._get_tasks_data_from_request(album_info)
-
-    def count_tasks(self, **form_data):
-        album_info = self._get_album_info(form_data['album_id'])
-        return int(album_info['total'])
-
-    def _get_album_info(self, album_id):
-        url = 'https://api.flickr.com/services/rest/'
+        """Return a generator with the photos of the album. The first page
+        is requested (or taken from the count) before returning, so an
+        invalid album raises at once; the rest of the pages are requested
+        concurrently while the photos of the previous ones are yielded."""
+        album_id = form_data['album_id']
+        session = requests.Session()
+        try:
+            first_page = (self._cached_first_page(album_id) or
+                          self._get_page(session, album_id, 1))
+        except:
+            session.close()
+            raise
+        return self._get_tasks_data(session, album_id, first_page)
+
+    def count_tasks(self, limit=None, **form_data):
+        album_id = form_data['album_id']
+        session = requests.Session()
+        try:
+            first_page = self._get_page(session, album_id, 1)
+        finally:
+            session.close()
+        if self.redis is not None:
+            self.redis.setex(self._first_page_key(album_id),
+                             self.album_cache_timeout, json.dumps(first_page))
+        return int(first_page['total'])
+
+    def _first_page_key(self, album_id):
+        return 'pybossa:flickr:album:%s:first_page' % album_id
+
+    def _cached_first_page(self, album_id):
+        """Return (and forget) the first page of the album stored in Redis
+        by count_tasks, which may have run in another process (the import
+        itself runs in a worker)."""
+        if self.redis is None:
+            return None
+        key = self._first_page_key(album_id)
+        pipe = self.redis.pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        first_page = pipe.execute()[0]
+        if first_page is not None:
+            return json.loads(first_page)
+
+    def _get_page(self, session, album_id, page):
         payload = {'method': 'flickr.photosets.getPhotos',
                    'api_key': self.api_key,
                    'photoset_id': album_id,
                    'format': 'json',
                    'nojsoncallback': '1'}
-        res = requests.get(url, params=payload)
+        if page > 1:
+            payload['page'] = page
+        res = session.get(self.url, params=payload)
         if self._is_valid_response(res):
-            content = json.loads(res.text)['photoset']
-            total_pages = content.get('pages')
-            rest_photos = self._remaining_photos(url, payload, total_pages)
-            content['photo'] += rest_photos
-            return content
+            return json.loads(res.text)['photoset']
 
     def _is_valid_response(self, response):
         if type(response.text) is dict:
@@ -172,22 +237,24 @@ class _BulkTaskFlickrImport(_BulkTaskImport):
             raise BulkImportException(error_message)
         return valid
 
-    def _remaining_photos(self, url, payload, total_pages):
-        photo_lists = [self._photos_from_page(url, payload, page)
-            for page in range(2, total_pages+1)]
-        return [item for sublist in photo_lists for item in sublist]
-
-    def _photos_from_page(self, url, payload, page):
-        payload['page'] = page
-        res = requests.get(url, params=payload)
-        if self._is_valid_response(res):
-            return json.loads(res.text)['photoset']['photo']
-        return []
-
-    def _get_tasks_data_from_request(self, album_info):
-        photo_list = album_info['photo']
-        owner = album_info['owner']
-        return [self._extract_photo_info(photo, owner) for photo in photo_list]
+    def _get_tasks_data(self, session, album_id, first_page):
+        owner = first_page['owner']
+        remaining = range(2, (first_page.get('pages') or 1) + 1)
+        pool = None
+        try:
+            for photo in first_page['photo']:
+                yield self._extract_photo_info(photo, owner)
+            if not remaining:
+                return
+            pool = ThreadPool(min(self.max_workers, len(remaining)))
+            get_page = lambda page: self._get_page(session, album_id, page)
+            for content in pool.imap(get_page, remaining):
+                for photo in content['photo']:
+                    yield self._extract_photo_info(photo, owner)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            session.close()
 
     def _extract_photo_info(self, photo, owner):
         base_url = 'https://farm%s.staticflickr.com/%s/%s_%s' % (
@@ -207,7 +274,7 @@ class _BulkTaskDropboxImport(_BulkTaskImport):
     def tasks(self, **form_data):
         return [self._extract_file_info(_file) for _file in form_data['files']]
 
-    def count_tasks(self, **form_data):
+    def count_tasks(self, limit=None, **form_data):
         return len(self.tasks(**form_data))
 
     def _extract_file_info(self, _file):
@@ -260,57 +327,191 @@ class _BulkTaskDropboxImport(_BulkTaskImport):
         return new_url
 
 
+class ImportProgress(object):
+
+    """Progress of the last import of tasks of a project, in a Redis hash.
+
+    It has the state of the import (queued, running, finished or failed),
+    the counters of the rows parsed from the source, the new tasks inserted
+    and the duplicates skipped, and the number of rows of the source whose
+    tasks are already committed.
+
+    An import that did not finish is resumed from the committed rows only
+    when the user queues it again. Any other run (e.g. the autoimporter,
+    which imports the same source every day, whose content may have
+    changed) starts from the first row, and the repeated tasks are skipped
+    by their hashes.
+
+    """
+
+    timeout = 7 * 24 * 60 * 60
+    counters = ('parsed', 'inserted', 'duplicates', 'committed')
+
+    def __init__(self, redis_conn, project_id):
+        self.redis = redis_conn
+        self.key = 'pybossa:import:app:%s' % project_id
+
+    def get(self):
+        """Return the progress as a dict, or None if there is none."""
+        progress = self.redis.hgetall(self.key)
+        if not progress:
+            return None
+        progress.pop('source', None)
+        for name in self.counters:
+            progress[name] = int(progress.get(name) or 0)
+        return progress
+
+    def queue(self, form_data):
+        """Record that an import of form_data has been enqueued."""
+        if self._resumes(form_data):
+            self._set(state='queued')
+        else:
+            self._reset(form_data, 'queued')
+
+    def start(self, form_data):
+        """Start the import of form_data and return the number of rows of the
+        source to skip, as their tasks were committed by a previous run that
+        did not finish and the user queued again."""
+        if not self._resumes(form_data, states=('queued',)):
+            self._reset(form_data, 'running')
+            return 0
+        progress = self.get()
+        committed = progress['committed']
+        # Every committed row was either inserted or a duplicate
+        self._set(state='running', parsed=committed,
+                  duplicates=committed - progress['inserted'])
+        return committed
+
+    def update(self, parsed, inserted, duplicates, committed):
+        self._set(parsed=parsed, inserted=inserted, duplicates=duplicates,
+                  committed=committed)
+
+    def finish(self, message):
+        self._set(state='finished', message=message)
+
+    def fail(self, message):
+        self._set(state='failed', message=message)
+
+    def _resumes(self, form_data, states=('queued', 'running', 'failed')):
+        state, source = self.redis.hmget(self.key, 'state', 'source')
+        return state in states and source == self._source(form_data)
+
+    def _reset(self, form_data, state):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key)
+        pipe.hmset(self.key, dict(dict.fromkeys(self.counters, 0),
+                                  state=state, source=self._source(form_data),
+                                  message=''))
+        pipe.expire(self.key, self.timeout)
+        pipe.execute()
+
+    def _set(self, **fields):
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.key, fields)
+        pipe.expire(self.key, self.timeout)
+        pipe.execute()
+
+    def _source(self, form_data):
+        return hashlib.md5(json.dumps(form_data, sort_keys=True)).hexdigest()
+
+
+def _info_hash(info):
+    """Return the MD5 hash of the info of a task as stored (the same as md5
+    of the column in the database)."""
+    return hashlib.md5(json.dumps(info)).hexdigest()
+
+
 class Importer(object):
 
+    #: Tasks inserted and committed together
+    batch_size = 1000
+
     def __init__(self):
         self._importers = {'csv': _BulkTaskCSVImport,
                            'gdocs': _BulkTaskGDImport,
                            'epicollect': _BulkTaskEpiCollectPlusImport}
         self._importer_constructor_params = {}
+        self._importer_instances = {}
 
     def register_flickr_importer(self, flickr_params):
         self._importers['flickr'] = _BulkTaskFlickrImport
         self._importer_constructor_params['flickr'] = flickr_params
+        self._importer_instances.pop('flickr', None)
 
     def register_dropbox_importer(self):
         self._importers['dropbox'] = _BulkTaskDropboxImport
 
-    def create_tasks(self, task_repo, project_id, **form_data):
-        from pybossa.cache import apps as cached_apps
-        from pybossa.model.task import Task
+    def create_tasks(self, task_repo, project_id, progress=None,
+                     **form_data):
         """Create tasks from a remote source using an importer object and
-        avoiding the creation of repeated tasks"""
+        avoiding the creation of repeated tasks.
+
+        The hashes of the info of the existing tasks are loaded once to find
+        the repeated ones, and the new tasks are inserted in batches.
+
+        If an ImportProgress is given, the counters are reported to it after
+        every batch, and an import of the same source that did not finish
+        is resumed after the rows it had committed.
+
+        """
         importer_id = form_data.get('type')
-        empty = True
-        n = 0
         importer = self._create_importer_for(importer_id)
-        for task_data in importer.tasks(**form_data):
-            task = Task(app_id=project_id)
-            [setattr(task, k, v) for k, v in task_data.iteritems()]
-            found = task_repo.get_task_by(app_id=project_id, info=task.info)
-            if found is None:
-                task_repo.save(task)
-                n += 1
-                empty = False
-        if empty:
+        parsed = inserted = duplicates = 0
+        if progress is not None:
+            parsed = progress.start(form_data)
+            counters = progress.get()
+            inserted, duplicates = counters['inserted'], counters['duplicates']
+        # The rows up to the last batch saved are either inserted or
+        # duplicates of committed tasks
+        committed = parsed
+        hashes = task_repo.get_task_info_hashes(project_id)
+        tasks = islice(importer.tasks(**form_data), parsed, None)
+        batch = []
+        for task_data in tasks:
+            parsed += 1
+            info_hash = _info_hash(task_data.get('info', {}))
+            if info_hash in hashes:
+                duplicates += 1
+            else:
+                hashes.add(info_hash)
+                batch.append(task_data)
+            if len(batch) == self.batch_size:
+                task_repo.save_tasks(project_id, batch)
+                inserted += len(batch)
+                committed = parsed
+                batch = []
+            if progress is not None and parsed % self.batch_size == 0:
+                progress.update(parsed, inserted, duplicates,
+                                committed=committed)
+        if batch:
+            task_repo.save_tasks(project_id, batch)
+            inserted += len(batch)
+        if progress is not None:
+            progress.update(parsed, inserted, duplicates, committed=parsed)
+        n = inserted
+        if n == 0:
             msg = gettext('It looks like there were no new records to import')
             return msg
         msg = str(n) + " " + gettext('new tasks were imported successfully')
         if n == 1:
             msg = str(n) + " " + gettext('new task was imported successfully')
-        cached_apps.delete_n_tasks(project_id)
-        cached_apps.delete_n_task_runs(project_id)
-        cached_apps.delete_overall_progress(project_id)
-        cached_apps.delete_last_activity(project_id)
         return msg
 
-    def count_tasks_to_import(self, **form_data):
+    def count_tasks_to_import(self, limit=None, **form_data):
+        """Return the number of tasks to import, or limit if there are more
+        (importers reading their source as a stream can then stop early)."""
         importer_id = form_data.get('type')
-        return self._create_importer_for(importer_id).count_tasks(**form_data)
+        return self._create_importer_for(importer_id).count_tasks(
+            limit=limit, **form_data)
 
     def _create_importer_for(self, importer_id):
-        params = self._importer_constructor_params.get(importer_id) or {}
-        return self._importers[importer_id](**params)
+        """Return the importer for importer_id. The same object is used for
+        counting and importing, so it can keep what it read for the count."""
+        if importer_id not in self._importer_instances:
+            params = self._importer_constructor_params.get(importer_id) or {}
+            self._importer_instances[importer_id] = \
+                self._importers[importer_id](**params)
+        return self._importer_instances[importer_id]
 
     def get_all_importer_names(self):
         return self._importers.keys()
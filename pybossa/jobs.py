@@ -17,11 +17,13 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 """Jobs module for running background tasks in PyBossa server."""
 from datetime import datetime
+from dateutil.relativedelta import relativedelta
 import math
 from flask import current_app, render_template
 from flask.ext.mail import Message
 from pybossa.core import mail, task_repo, importer
 from pybossa.util import with_cache_disabled
+from pybossa.cache import delete_untagged_memoized
 
 
 MINUTE = 60
@@ -54,6 +56,12 @@ def schedule_job(function, scheduler):
     return msg
 
 
+def months_ago(months):
+    """Return the ISO 8601 timestamp of the given months ago, to compare it
+    with the timestamps stored as text (which sort chronologically)."""
+    return (datetime.utcnow() - relativedelta(months=months)).isoformat()
+
+
 def get_quarterly_date(now):
     if not isinstance(now, datetime):
         raise TypeError('Expected %s, got %s' % (type(datetime), type(now)))
@@ -110,11 +118,17 @@ def get_default_jobs():  # pragma: no cover
                timeout=(10 * MINUTE), queue='low')
     yield dict(name=warm_cache, args=[], kwargs={},
                timeout=(10 * MINUTE), queue='super')
+    yield dict(name=reconcile_project_stats, args=[], kwargs={},
+               timeout=(10 * MINUTE), queue='low')
+    yield dict(name=delete_untagged_memoized, args=[], kwargs={},
+               timeout=(10 * MINUTE), queue='low')
 
 
 def get_export_task_jobs(queue):
-    """Export tasks to zip"""
+    """Export tasks to zip, with one job for the tasks and another one for the
+    task runs of every project, if they changed since the last export."""
     from pybossa.core import project_repo
+    from pybossa.exporter import export_is_outdated
     import pybossa.cache.apps as cached_apps
     if queue == 'high':
         projects = cached_apps.get_from_pro_user()
@@ -123,20 +137,33 @@ def get_export_task_jobs(queue):
                     if p.owner.pro is False)
     for project in projects:
         project_id = project.get('id')
-        job = dict(name=project_export,
-                   args=[project_id], kwargs={},
-                   timeout=(10 * MINUTE),
-                   queue=queue)
-        yield job
+        for ty in ('task', 'task_run'):
+            if not export_is_outdated(project_id, ty):
+                continue
+            job = dict(name=project_export,
+                       args=[project_id], kwargs=dict(ty=ty),
+                       timeout=(10 * MINUTE),
+                       queue=queue)
+            yield job
 
 
-def project_export(_id):
-    from pybossa.core import project_repo, json_exporter, csv_exporter
+def project_export(_id, ty=None):
+    """Generate the JSON, CSV and NDJSON exports of the tasks or task runs of
+    a project (or both, if ty is None), reading the rows once for all the
+    formats."""
+    from pybossa.core import (project_repo, json_exporter, csv_exporter,
+                              ndjson_exporter)
+    from pybossa.exporter import write_zips, export_watermark, mark_exported
     app = project_repo.get(_id)
     if app is not None:
         print "Export project id %d" % _id
-        json_exporter.pregenerate_zip_files(app)
-        csv_exporter.pregenerate_zip_files(app)
+        for ty in [ty] if ty else ['task', 'task_run']:
+            # Taken before reading the rows, so changes made meanwhile are
+            # exported next time
+            watermark = export_watermark(app.id, ty)
+            write_zips(app, ty, [json_exporter, csv_exporter,
+                                 ndjson_exporter])
+            mark_exported(app.id, ty, watermark)
 
 
 def get_project_jobs(queue='super'):
@@ -165,9 +192,9 @@ def get_inactive_users_jobs(queue='quaterly'):
     # First users that have participated once but more than 3 months ago
     sql = text('''SELECT user_id FROM task_run
                WHERE user_id IS NOT NULL
-               AND TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-               <= NOW() - '3 month'::INTERVAL GROUP BY task_run.user_id;''')
-    results = db.slave_session.execute(sql)
+               AND task_run.finish_time <= :before
+               GROUP BY task_run.user_id;''')
+    results = db.slave_session.execute(sql, dict(before=months_ago(3)))
     for row in results:
 
         user = User.query.get(row.user_id)
@@ -247,18 +274,13 @@ def get_autoimport_jobs(queue='low'):
 
 @with_cache_disabled
 def get_app_stats(_id, short_name):  # pragma: no cover
-    """Get stats for app."""
+    """Get stats for app, folding into them the task runs sent since the
+    last time."""
     import pybossa.cache.apps as cached_apps
     import pybossa.cache.project_stats as stats
     from flask import current_app
 
     cached_apps.get_app(short_name)
-    cached_apps.n_tasks(_id)
-    cached_apps.n_task_runs(_id)
-    cached_apps.overall_progress(_id)
-    cached_apps.last_activity(_id)
-    cached_apps.n_completed_tasks(_id)
-    cached_apps.n_volunteers(_id)
     stats.get_stats(_id, current_app.config.get('GEO'))
 
 
@@ -266,16 +288,10 @@ def get_app_stats(_id, short_name):  # pragma: no cover
 def warm_up_stats():  # pragma: no cover
     """Background job for warming stats."""
     print "Running on the background warm_up_stats"
-    from pybossa.cache.site_stats import (n_auth_users, n_anon_users,
-                                          n_tasks_site, n_total_tasks_site,
-                                          n_task_runs_site,
+    from pybossa.cache.site_stats import (n_auth_users,
                                           get_top5_apps_24_hours,
                                           get_top5_users_24_hours, get_locs)
     n_auth_users()
-    n_anon_users()
-    n_tasks_site()
-    n_total_tasks_site()
-    n_task_runs_site()
     get_top5_apps_24_hours()
     get_top5_users_24_hours()
     get_locs()
@@ -283,6 +299,25 @@ def warm_up_stats():  # pragma: no cover
     return True
 
 
+def reconcile_project_stats():
+    """Rebuild the project_stats table from scratch, fixing any drift of
+    its counters (e.g. rows deleted in bulk, without the event listeners)."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    from pybossa.model.project_stats import rebuild_project_stats, SITE
+    sql = text('''SELECT id FROM app;''')
+    app_ids = [row.id for row in db.slave_session.execute(sql)]
+    for app_id in app_ids + [SITE]:
+        rebuild_project_stats(db.session.connection(), app_id)
+        db.session.commit()
+    sql = text('''DELETE FROM project_stats WHERE app_id != :site
+               AND NOT EXISTS (SELECT 1 FROM app
+               WHERE app.id=project_stats.app_id);''')
+    db.session.execute(sql, dict(site=SITE))
+    db.session.commit()
+    return True
+
+
 @with_cache_disabled
 def warm_cache():  # pragma: no cover
     """Background job to warm cache."""
@@ -299,12 +334,7 @@ def warm_cache():  # pragma: no cover
     def warm_app(_id, short_name, featured=False):
         if _id not in apps_cached:
             cached_apps.get_app(short_name)
-            cached_apps.n_tasks(_id)
-            n_task_runs = cached_apps.n_task_runs(_id)
-            cached_apps.overall_progress(_id)
-            cached_apps.last_activity(_id)
-            cached_apps.n_completed_tasks(_id)
-            cached_apps.n_volunteers(_id)
+            n_task_runs = cached_apps.summary(_id)['n_task_runs']
             if n_task_runs >= 1000 or featured:
                 print ("Getting stats for %s as it has %s task runs" %
                        (short_name, n_task_runs))
@@ -344,15 +374,22 @@ def warm_cache():  # pragma: no cover
     return True
 
 
+def warm_task_queue(app_id):
+    """Load the Redis task queue of a project for the scheduler."""
+    from pybossa.core import sentinel
+    from pybossa.task_queue import TaskQueue
+    TaskQueue(sentinel.master).warm(app_id)
+    return True
+
+
 def get_non_updated_apps():
     """Return a list of non updated apps."""
     from sqlalchemy.sql import text
     from pybossa.model.app import App
     from pybossa.core import db
-    sql = text('''SELECT id FROM app WHERE TO_DATE(updated,
-                'YYYY-MM-DD\THH24:MI:SS.US') <= NOW() - '3 month':: INTERVAL
+    sql = text('''SELECT id FROM app WHERE updated <= :before
                AND contacted != True LIMIT 25''')
-    results = db.slave_session.execute(sql)
+    results = db.slave_session.execute(sql, dict(before=months_ago(3)))
     apps = []
     for row in results:
         a = App.query.get(row.id)
@@ -392,9 +429,19 @@ def send_mail(message_dict):
 
 
 def import_tasks(project_id, **form_data):
-    from pybossa.core import project_repo
+    """Import tasks into a project, reporting the progress in Redis. If the
+    user queued again an import that did not finish, it is resumed."""
+    from pybossa.core import project_repo, sentinel
+    from pybossa.importers import ImportProgress
     app = project_repo.get(project_id)
-    msg = importer.create_tasks(task_repo, project_id, **form_data)
+    progress = ImportProgress(sentinel.master, project_id)
+    try:
+        msg = importer.create_tasks(task_repo, project_id, progress=progress,
+                                    **form_data)
+    except Exception as e:
+        progress.fail(unicode(e.args[0]) if e.args else repr(e))
+        raise
+    progress.finish(msg)
     msg = msg + ' to your project %s!' % app.name
     subject = 'Tasks Import to your project %s' % app.name
     body = 'Hello,\n\n' + msg + '\n\nAll the best,\nThe %s team.'\
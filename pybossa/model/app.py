@@ -20,6 +20,7 @@ from sqlalchemy import Integer, Boolean, Unicode, Float, UnicodeText, Text
 from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy import event
+from sqlalchemy.sql import text
 
 
 from pybossa.core import db, signer
@@ -41,7 +42,8 @@ class App(db.Model, DomainObject):
     #: UTC timestamp when the project is created
     created = Column(Text, default=make_timestamp)
     #: UTC timestamp when the project is updated (or any of its relationships)
-    updated = Column(Text, default=make_timestamp, onupdate=make_timestamp)
+    updated = Column(Text, default=make_timestamp, onupdate=make_timestamp,
+                     index=True)
     #: Project name
     name = Column(Unicode(length=255), unique=True, nullable=False)
     #: Project slug for the URL
@@ -136,3 +138,10 @@ def add_event(mapper, conn, target):
                short_name=target.short_name,
                action_updated='Project')
     update_redis(obj)
+
+
+@event.listens_for(App, 'after_delete')
+def delete_project_stats(mapper, conn, target):
+    """Delete the project_stats row of the app."""
+    sql = text('DELETE FROM project_stats WHERE app_id=:app_id')
+    conn.execute(sql, dict(app_id=target.id))
@@ -0,0 +1,239 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rollup table with the counters of every project.
+
+This module exports:
+    * ProjectStats class: one row per project, that the Task and TaskRun
+      event listeners keep up to date, plus the SITE row with the counters
+      of the whole site
+    * update_project_stats: atomically add deltas to the counters of a row
+    * count_task and count_task_run: update the project row for a Task or
+      TaskRun that has been inserted (sign=1) or deleted (sign=-1)
+    * count_task_runs: the same for many task runs of a volunteer inserted
+      at once
+    * rebuild_project_stats: compute a row from scratch
+
+The SITE row is never updated when tasks or task runs change, as every
+submission would wait for its lock. Only the reconcile_project_stats job
+computes it, and the site counters that are sums of the project ones are
+read by adding up the project rows.
+
+Whether some task runs are the first (or the last) ones of a volunteer in a
+project is checked by one transaction at a time, which holds an advisory lock
+for that volunteer and project.
+
+Anything that changes tasks or task runs without going through the ORM
+(i.e. bulk SQL statements) has to call rebuild_project_stats afterwards. The
+reconcile_project_stats job rebuilds every row to fix any drift.
+
+"""
+from sqlalchemy import Integer, Text
+from sqlalchemy.schema import Column
+from sqlalchemy.sql import text
+
+from pybossa.core import db
+from pybossa.model import DomainObject
+
+
+#: app_id of the row with the counters of the whole site
+SITE = 0
+
+COUNTERS = ('n_tasks', 'n_completed_tasks', 'n_answers', 'n_task_runs',
+            'n_registered_volunteers', 'n_anonymous_volunteers')
+
+
+class ProjectStats(db.Model, DomainObject):
+    '''Counters of a project, or of the whole site for app_id SITE.'''
+
+    __tablename__ = 'project_stats'
+
+    #: App.id (not a foreign key, as SITE is not a project)
+    app_id = Column(Integer, primary_key=True, autoincrement=False)
+    #: Number of tasks
+    n_tasks = Column(Integer, default=0, nullable=False)
+    #: Number of completed tasks
+    n_completed_tasks = Column(Integer, default=0, nullable=False)
+    #: Sum of the n_answers of the tasks
+    n_answers = Column(Integer, default=0, nullable=False)
+    #: Number of task runs
+    n_task_runs = Column(Integer, default=0, nullable=False)
+    #: Number of distinct authenticated users that sent task runs
+    n_registered_volunteers = Column(Integer, default=0, nullable=False)
+    #: Number of distinct IPs that sent anonymous task runs
+    n_anonymous_volunteers = Column(Integer, default=0, nullable=False)
+    #: finish_time of the latest task run
+    last_activity = Column(Text)
+
+
+def update_project_stats(conn, app_id, last_activity=None, **deltas):
+    """Add the deltas to the counters of the row of app_id, creating the row
+    from scratch if it does not exist yet."""
+    assignments = ['%s = %s + :%s' % (name, name, name) for name in deltas]
+    if last_activity is not None:
+        assignments.append('last_activity = '
+                           'GREATEST(COALESCE(last_activity, \'\'), '
+                           ':last_activity)')
+    if not assignments:
+        return
+    sql = text('UPDATE project_stats SET %s WHERE app_id=:app_id'
+               % ', '.join(assignments))
+    params = dict(deltas, app_id=app_id, last_activity=last_activity)
+    if conn.execute(sql, params).rowcount == 0:
+        # The new row is computed from the current data, which already
+        # includes the change
+        rebuild_project_stats(conn, app_id)
+
+
+def count_task(conn, task, sign):
+    """Update the project counters for an inserted (sign=1) or deleted
+    (sign=-1) task."""
+    deltas = dict(n_tasks=sign, n_answers=sign * (task.n_answers or 0))
+    if task.state == u'completed':
+        deltas['n_completed_tasks'] = sign
+    update_project_stats(conn, task.app_id, **deltas)
+
+
+def count_task_run(conn, task_run, sign):
+    """Update the project counters for an inserted (sign=1) or deleted
+    (sign=-1) task run."""
+    last_activity = task_run.finish_time if sign > 0 else None
+    deltas = dict(n_task_runs=sign)
+    # The volunteer is new if this is their only task run, or gone if they
+    # have none left
+    remaining = 1 if sign > 0 else 0
+    volunteer = _volunteer(task_run.user_id, task_run.user_ip)
+    if volunteer is not None:
+        column, value, counter = volunteer
+        _lock_volunteer(conn, task_run.app_id, column, value)
+        if _n_task_runs_by(conn, task_run.app_id, column,
+                           value) == remaining:
+            deltas[counter] = sign
+    update_project_stats(conn, task_run.app_id, last_activity=last_activity,
+                         **deltas)
+
+
+def count_task_runs(conn, n_task_runs, user_id, user_ip, last_activity):
+    """Update the project counters for the task runs of a volunteer inserted
+    at once. n_task_runs maps the app_id of every project to the number of
+    task runs inserted in it.
+
+    The rows are locked in app_id order, so two of these can not deadlock.
+
+    """
+    volunteer = _volunteer(user_id, user_ip)
+    for app_id, n in sorted(n_task_runs.items()):
+        deltas = dict(n_task_runs=n)
+        # The volunteer is new if these are their only task runs
+        if volunteer is not None:
+            column, value, counter = volunteer
+            _lock_volunteer(conn, app_id, column, value)
+            if _n_task_runs_by(conn, app_id, column, value,
+                               limit=n + 1) == n:
+                deltas[counter] = 1
+        update_project_stats(conn, app_id, last_activity=last_activity,
+                             **deltas)
+
+
+def _volunteer(user_id, user_ip):
+    """Return the column and value that identify the volunteer of some task
+    runs, and the counter of their kind of volunteers (or None)."""
+    if user_id is not None and user_ip is None:
+        return 'user_id', user_id, 'n_registered_volunteers'
+    if user_id is None and user_ip is not None:
+        return 'user_ip', user_ip, 'n_anonymous_volunteers'
+    return None
+
+
+def _lock_volunteer(conn, app_id, column, value):
+    """Take a transaction lock on a volunteer of a project, so only one
+    transaction at a time checks whether their task runs are the first (or
+    the last) ones, and sees the task runs the previous one committed."""
+    sql = text('SELECT pg_advisory_xact_lock(:app_id, hashtext(:volunteer))')
+    conn.execute(sql, dict(app_id=app_id,
+                           volunteer='%s:%s' % (column, value)))
+
+
+def _n_task_runs_by(conn, app_id, column, value, limit=2):
+    """Return the number of task runs of a volunteer in a project, up to
+    limit."""
+    sql = text('''SELECT COUNT(*) FROM (SELECT 1 FROM task_run
+               WHERE app_id=:app_id AND %s=:value AND %s IS NULL
+               LIMIT :limit) AS runs'''
+               % (column, 'user_ip' if column == 'user_id' else 'user_id'))
+    return conn.scalar(sql, dict(app_id=app_id, value=value, limit=limit))
+
+
+def rebuild_project_stats(conn, app_id):
+    """Compute the row of app_id (or SITE) from scratch.
+
+    The row is locked before the counters are computed, so the transactions
+    that change them meanwhile add their deltas after it is written, instead
+    of being overwritten by it.
+
+    """
+    _create_project_stats(conn, app_id)
+    sql = text('''SELECT 1 FROM project_stats WHERE app_id=:app_id
+               FOR UPDATE''')
+    conn.execute(sql, dict(app_id=app_id))
+    where = _where(app_id)
+    sql = text('''
+               SELECT
+               (SELECT COUNT(id) FROM task WHERE {0}) AS n_tasks,
+               (SELECT COUNT(id) FROM task WHERE {0} AND state='completed')
+                AS n_completed_tasks,
+               (SELECT COALESCE(SUM(n_answers), 0) FROM task WHERE {0})
+                AS n_answers,
+               (SELECT COUNT(id) FROM task_run WHERE {0}) AS n_task_runs,
+               (SELECT COUNT(DISTINCT user_id) FROM task_run
+                WHERE {0} AND user_ip IS NULL) AS n_registered_volunteers,
+               (SELECT COUNT(DISTINCT user_ip) FROM task_run
+                WHERE {0} AND user_id IS NULL) AS n_anonymous_volunteers,
+               (SELECT MAX(finish_time) FROM task_run WHERE {0})
+                AS last_activity;
+               '''.format(where))
+    params = dict(conn.execute(sql, dict(app_id=app_id)).first().items())
+    params['app_id'] = app_id
+    columns = COUNTERS + ('last_activity',)
+    sql = text('UPDATE project_stats SET %s WHERE app_id=:app_id'
+               % ', '.join('%s = :%s' % (name, name) for name in columns))
+    conn.execute(sql, params)
+
+
+def _create_project_stats(conn, app_id):
+    """Insert an empty row for app_id if there is none.
+
+    Concurrent insertions of the same row wait for each other on an advisory
+    lock, so the later ones see the row instead of failing on its primary
+    key.
+
+    """
+    sql = text('SELECT 1 FROM project_stats WHERE app_id=:app_id')
+    if conn.scalar(sql, dict(app_id=app_id)) is not None:
+        return
+    conn.execute(text('SELECT pg_advisory_xact_lock(:app_id)'),
+                 dict(app_id=app_id))
+    sql = text('''INSERT INTO project_stats (app_id, %s)
+               SELECT :app_id, %s WHERE NOT EXISTS
+               (SELECT 1 FROM project_stats WHERE app_id=:app_id)'''
+               % (', '.join(COUNTERS), ', '.join('0' for _ in COUNTERS)))
+    conn.execute(sql, dict(app_id=app_id))
+
+
+def _where(app_id):
+    return 'TRUE' if app_id == SITE else 'app_id=:app_id'
@@ -17,14 +17,16 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy import Integer, Boolean, Float, UnicodeText, Text
-from sqlalchemy.schema import Column, ForeignKey
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy import event
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy import event, inspect
 
-from pybossa.core import db
+from pybossa.core import db, sentinel
 from pybossa.model import DomainObject, JSONType, JSONEncodedDict, \
     make_timestamp, update_redis, update_app_timestamp
 from pybossa.model.task_run import TaskRun
+from pybossa.model.project_stats import count_task, update_project_stats
+from pybossa.task_queue import TaskQueue
 
 
 
@@ -64,6 +66,18 @@ class Task(db.Model, DomainObject):
         else:  # pragma: no cover
             return float(0)
 
+
+Index('task_app_id_state_priority_idx', Task.app_id, Task.state,
+      Task.priority_0.desc(), Task.id)
+# The tasks the schedulers can still hand out, in the order of the depth first
+# scheduler
+Index('task_ongoing_app_id_priority_idx', Task.app_id, Task.priority_0.desc(),
+      Task.id, postgresql_where=(Task.state != u'completed'))
+# The same tasks by id, for the random scheduler
+Index('task_ongoing_app_id_id_idx', Task.app_id, Task.id,
+      postgresql_where=(Task.state != u'completed'))
+
+
 @event.listens_for(Task, 'after_insert')
 def add_event(mapper, conn, target):
     """Update PyBossa feed with new task."""
@@ -87,3 +101,69 @@ def add_event(mapper, conn, target):
 def update_app(mapper, conn, target):
     """Update app updated timestamp."""
     update_app_timestamp(mapper, conn, target)
+
+
+@event.listens_for(Task, 'after_insert')
+@event.listens_for(Task, 'after_update')
+def update_task_queue(mapper, conn, target):
+    """Add or re-score the task in the project Redis task queue."""
+    if TaskQueue.enabled():
+        queue = TaskQueue(sentinel.master)
+        if target.state == u'completed':
+            queue.remove_task(target.app_id, target.id)
+        else:
+            queue.add_task(target.app_id, target.id, target.priority_0)
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_from_task_queue(mapper, conn, target):
+    """Remove the task from the project Redis task queue."""
+    if TaskQueue.enabled():
+        TaskQueue(sentinel.master).remove_task(target.app_id, target.id)
+
+
+@event.listens_for(Task, 'after_insert')
+def add_to_project_stats(mapper, conn, target):
+    """Count the new task in the project_stats table."""
+    count_task(conn, target, 1)
+
+
+@event.listens_for(Task, 'after_update')
+def update_project_stats_counters(mapper, conn, target):
+    """Update the project_stats table if the state or n_answers changed."""
+    attrs = inspect(target).attrs
+    deltas = {}
+    state = attrs.state.history
+    if state.has_changes():
+        was_completed = u'completed' in (state.deleted or [])
+        is_completed = target.state == u'completed'
+        if was_completed != is_completed:
+            deltas['n_completed_tasks'] = 1 if is_completed else -1
+    n_answers = attrs.n_answers.history
+    if n_answers.has_changes() and n_answers.deleted:
+        deltas['n_answers'] = ((target.n_answers or 0) -
+                               (n_answers.deleted[0] or 0))
+    if deltas:
+        update_project_stats(conn, target.app_id, **deltas)
+
+
+@event.listens_for(Task, 'after_update')
+def outdate_export(mapper, conn, target):
+    """Regenerate the exports of the tasks of the app, as their watermark
+    does not change when a task is edited."""
+    from pybossa.exporter import mark_export_outdated
+    mark_export_outdated(target.app_id, 'task')
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_from_project_stats(mapper, conn, target):
+    """Discount the deleted task in the project_stats table."""
+    count_task(conn, target, -1)
+
+
+@event.listens_for(Task, 'after_delete')
+def reset_app_stats(mapper, conn, target):
+    """Reset the aggregates of the app stats, which include the answers of
+    the deleted task, once the deletion is committed."""
+    from pybossa.cache.project_stats import reset_stats_after_commit
+    reset_stats_after_commit(object_session(target), target.app_id)
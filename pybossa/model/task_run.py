@@ -18,13 +18,19 @@
 
 from datetime import datetime
 from sqlalchemy import Integer, Text
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.sql import text
 from sqlalchemy import event
+from sqlalchemy.orm import object_session
 from rq import Queue
 
 from pybossa.core import db, sentinel
 from pybossa.model import DomainObject, JSONType, make_timestamp, update_redis, \
     update_app_timestamp, webhook
+from pybossa.model.project_stats import count_task_run, count_task_runs, \
+    update_project_stats
+from pybossa.task_queue import TaskQueue
+from pybossa.task_reservation import TaskReservation
 
 
 webhook_queue = Queue('high', connection=sentinel.master)
@@ -34,6 +40,19 @@ class TaskRun(db.Model, DomainObject):
     '''A run of a given task by a specific user.
     '''
     __tablename__ = 'task_run'
+    # finish_time is an ISO 8601 string, so these indexes serve range
+    # predicates with ISO bounds (e.g. the answers of the last 24 hours)
+    __table_args__ = (Index('task_run_app_id_finish_time_idx', 'app_id',
+                            'finish_time'),
+                      Index('task_run_finish_time_idx', 'finish_time'),
+                      # Counts of the answers of a task (update_task_state)
+                      Index('task_run_task_id_idx', 'task_id'),
+                      # The tasks a user has already answered (schedulers,
+                      # n_available_tasks and count_task_runs_with)
+                      Index('task_run_app_id_user_id_task_id_idx', 'app_id',
+                            'user_id', 'task_id'),
+                      Index('task_run_app_id_user_ip_task_id_idx', 'app_id',
+                            'user_ip', 'task_id'))
 
     #: ID of the TaskRun
     id = Column(Integer, primary_key=True)
@@ -62,14 +81,111 @@ class TaskRun(db.Model, DomainObject):
     '''
 
 
+@event.listens_for(TaskRun, 'after_insert')
+def add_to_project_stats(mapper, conn, target):
+    """Count the new task run in the project_stats table.
+
+    It must run before update_task_state, which counts the task as completed
+    in the same row.
+
+    """
+    count_task_run(conn, target, 1)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def remove_from_project_stats(mapper, conn, target):
+    """Discount the deleted task run in the project_stats table."""
+    count_task_run(conn, target, -1)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def reset_app_stats(mapper, conn, target):
+    """Reset the aggregates of the app stats, which include the deleted task
+    run, once the deletion is committed."""
+    from pybossa.cache.project_stats import reset_stats_after_commit
+    reset_stats_after_commit(object_session(target), target.app_id)
+
+
 @event.listens_for(TaskRun, 'after_insert')
 def update_task_state(mapper, conn, target):
     """Update the task.state when n_answers condition is met."""
-    # Get app details
+    app_obj = _get_app_obj(conn, target.app_id)
+    # Check if user is Authenticated
+    if target.user_id is not None:
+        _add_user_contribution(conn, app_obj, target.user_id)
+    # Check if Task.state should be updated
+    sql_query = ('select count(id) from task_run \
+                 where task_run.task_id=%s') % target.task_id
+    n_answers = conn.scalar(sql_query)
+    sql_query = ('select n_answers from task \
+                 where task.id=%s') % target.task_id
+    task_n_answers = conn.scalar(sql_query)
+    if (n_answers) >= task_n_answers:
+        sql_query = ("UPDATE task SET state=\'completed\' \
+                     where id=%s and state!=\'completed\'") % target.task_id
+        if conn.execute(sql_query).rowcount:
+            update_project_stats(conn, target.app_id, n_completed_tasks=1)
+        _task_completed(app_obj, target.task_id)
+
+
+def after_bulk_insert(conn, task_runs):
+    """Do what the after_insert listeners do for every TaskRun, for task runs
+    of one volunteer inserted at once without the ORM (see
+    TaskRepository.save_task_runs). task_runs are the inserted rows as dicts.
+
+    The tasks that got all their answers are found and completed with one
+    statement.
+
+    """
+    user_id, user_ip = task_runs[0]['user_id'], task_runs[0]['user_ip']
+    n_task_runs = {}
+    for task_run in task_runs:
+        app_id = task_run['app_id']
+        n_task_runs[app_id] = n_task_runs.get(app_id, 0) + 1
+    last_activity = max(task_run['finish_time'] for task_run in task_runs)
+    count_task_runs(conn, n_task_runs, user_id, user_ip, last_activity)
+    app_objs = dict((app_id, _get_app_obj(conn, app_id))
+                    for app_id in n_task_runs)
+    if user_id is not None:
+        for app_obj in app_objs.values():
+            _add_user_contribution(conn, app_obj, user_id)
+    sql = text('''
+               WITH answered AS (
+               SELECT task.id, task.app_id, task.state FROM task,
+               (SELECT task_id, COUNT(id) AS n_task_runs FROM task_run
+                WHERE task_id = ANY(:task_ids) GROUP BY task_id) AS runs
+               WHERE runs.task_id=task.id
+               AND runs.n_task_runs >= task.n_answers),
+               completed AS (
+               UPDATE task SET state='completed' FROM answered
+               WHERE task.id=answered.id AND answered.state!='completed'
+               RETURNING task.id)
+               SELECT answered.id, answered.app_id,
+               completed.id IS NOT NULL AS newly_completed
+               FROM answered LEFT JOIN completed ON completed.id=answered.id;
+               ''')
+    task_ids = [task_run['task_id'] for task_run in task_runs]
+    n_completed_tasks = {}
+    for row in conn.execute(sql, dict(task_ids=task_ids)):
+        if row.newly_completed:
+            n_completed_tasks[row.app_id] = \
+                n_completed_tasks.get(row.app_id, 0) + 1
+        _task_completed(app_objs[row.app_id], row.id)
+    for app_id, n in sorted(n_completed_tasks.items()):
+        update_project_stats(conn, app_id, n_completed_tasks=n)
+    for app_id in n_task_runs:
+        update_app_timestamp(None, conn, TaskRun(app_id=app_id))
+    for task_run in task_runs:
+        update_task_queue_seen(None, conn, TaskRun(**task_run))
+        release_task_reservation(None, conn, TaskRun(**task_run))
+
+
+def _get_app_obj(conn, app_id):
+    """Return the app details for the update feed and the webhook."""
     sql_query = ('select name, short_name, webhook, info from app \
-                 where id=%s') % target.app_id
+                 where id=%s') % app_id
     results = conn.execute(sql_query)
-    app_obj = dict(id=target.app_id,
+    app_obj = dict(id=app_id,
                    name=None,
                    short_name=None,
                    info=None,
@@ -80,42 +196,40 @@ def update_task_state(mapper, conn, target):
         app_obj['short_name'] = r.short_name
         app_obj['info'] = r.info
         app_obj['webhook'] = r.webhook
+    return app_obj
 
-    # Check if user is Authenticated
-    if target.user_id is not None:
-        sql_query = ('select fullname, name, info from "user" \
-                     where id=%s') % target.user_id
-        results = conn.execute(sql_query)
-        for r in results:
-            obj = dict(id=target.user_id,
-                       name=r.name,
-                       fullname=r.fullname,
-                       info=r.info,
-                       app_name=app_obj['name'],
+
+def _add_user_contribution(conn, app_obj, user_id):
+    """Add the contribution of a user to the update feed."""
+    sql_query = ('select fullname, name, info from "user" \
+                 where id=%s') % user_id
+    results = conn.execute(sql_query)
+    for r in results:
+        obj = dict(id=user_id,
+                   name=r.name,
+                   fullname=r.fullname,
+                   info=r.info,
+                   app_name=app_obj['name'],
+                   app_short_name=app_obj['short_name'],
+                   action_updated='UserContribution')
+    # Add the event
+    update_redis(obj)
+
+
+def _task_completed(app_obj, task_id):
+    """Take a task with all its answers out of the queue, and announce it in
+    the update feed and the webhook of its project."""
+    if TaskQueue.enabled():
+        TaskQueue(sentinel.master).remove_task(app_obj['id'], task_id)
+    update_redis(app_obj)
+    # PUSH changes via the webhook
+    if app_obj['webhook']:
+        payload = dict(event="task_completed",
                        app_short_name=app_obj['short_name'],
-                       action_updated='UserContribution')
-        # Add the event
-        update_redis(obj)
-    # Check if Task.state should be updated
-    sql_query = ('select count(id) from task_run \
-                 where task_run.task_id=%s') % target.task_id
-    n_answers = conn.scalar(sql_query)
-    sql_query = ('select n_answers from task \
-                 where task.id=%s') % target.task_id
-    task_n_answers = conn.scalar(sql_query)
-    if (n_answers) >= task_n_answers:
-        sql_query = ("UPDATE task SET state=\'completed\' \
-                     where id=%s") % target.task_id
-        conn.execute(sql_query)
-        update_redis(app_obj)
-        # PUSH changes via the webhook
-        if app_obj['webhook']:
-            payload = dict(event="task_completed",
-                           app_short_name=app_obj['short_name'],
-                           app_id=target.app_id,
-                           task_id=target.task_id,
-                           fired_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-            webhook_queue.enqueue(webhook, app_obj['webhook'], payload)
+                       app_id=app_obj['id'],
+                       task_id=task_id,
+                       fired_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        webhook_queue.enqueue(webhook, app_obj['webhook'], payload)
 
 
 
@@ -124,3 +238,29 @@ def update_task_state(mapper, conn, target):
 def update_app(mapper, conn, target):
     """Update app updated timestamp."""
     update_app_timestamp(mapper, conn, target)
+
+
+@event.listens_for(TaskRun, 'after_update')
+def outdate_export(mapper, conn, target):
+    """Regenerate the exports of the task runs of the app, as their
+    watermark does not change when a task run is edited."""
+    from pybossa.exporter import mark_export_outdated
+    mark_export_outdated(target.app_id, 'task_run')
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def update_task_queue_seen(mapper, conn, target):
+    """Record the task as seen by the user in the Redis task queue."""
+    if TaskQueue.enabled():
+        TaskQueue(sentinel.master).add_seen(target.app_id, target.task_id,
+                                            target.user_id, target.user_ip)
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def release_task_reservation(mapper, conn, target):
+    """Release the reservation the user had for the task."""
+    if TaskReservation.enabled():
+        TaskReservation(sentinel.master).release(target.task_id,
+                                                 target.user_id,
+                                                 target.user_ip)
+
@@ -17,11 +17,16 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy.sql import text
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
-from pybossa.model.task import Task
-from pybossa.model.task_run import TaskRun
+from pybossa.model import make_timestamp, update_app_timestamp
+from pybossa.model.task import Task, add_event
+from pybossa.model.task_run import TaskRun, after_bulk_insert
+from pybossa.model.project_stats import rebuild_project_stats, \
+    update_project_stats
 from pybossa.exc import WrongObjectError, DBIntegrityError
+from pybossa.task_queue import TaskQueue
+from pybossa.core import sentinel
 
 
 
@@ -49,6 +54,15 @@ class TaskRepository(object):
     def count_tasks_with(self, **filters):
         return self.db.session.query(Task).filter_by(**filters).count()
 
+    def get_task_info_hashes(self, app_id):
+        """Return the set of the MD5 hashes of the info of the tasks of a
+        project, as stored (the JSON text). Only the hashes are sent by the
+        database."""
+        sql = text('''SELECT md5(info) AS hash FROM task
+                   WHERE app_id=:app_id;''')
+        results = self.db.session.execute(sql, dict(app_id=app_id))
+        return set(row.hash for row in results)
+
 
 
     # Methods for queries on TaskRun objects
@@ -68,6 +82,23 @@ class TaskRepository(object):
     def count_task_runs_with(self, **filters):
         return self.db.session.query(TaskRun).filter_by(**filters).count()
 
+    def get_tasks_by_ids(self, ids):
+        """Return a dict with the tasks of ids that exist, by id."""
+        if not ids:
+            return {}
+        tasks = self.db.session.query(Task).filter(Task.id.in_(ids)).all()
+        return dict((task.id, task) for task in tasks)
+
+    def get_answered_task_ids(self, task_ids, user_id=None, user_ip=None):
+        """Return the set of the tasks of task_ids that already have a task
+        run of the user (by user_id) or of the anonymous user (by user_ip)."""
+        if not task_ids:
+            return set()
+        query = self.db.session.query(TaskRun.task_id).filter(
+            TaskRun.task_id.in_(task_ids), TaskRun.user_id == user_id,
+            TaskRun.user_ip == user_ip)
+        return set(row.task_id for row in query)
+
 
 
     # Methods for saving, deleting and updating both Task and TaskRun objects
@@ -80,6 +111,81 @@ class TaskRepository(object):
             self.db.session.rollback()
             raise DBIntegrityError(e)
 
+    def save_tasks(self, app_id, tasks):
+        """Insert many tasks of a project in one statement and commit them.
+
+        tasks are dicts with Task attributes. As no Task object is flushed,
+        what the Task event listeners do for every task is done once for all
+        of them: the project_stats counters, the app updated timestamp, the
+        activity feed and the task queue.
+
+        """
+        table = Task.__table__
+        # executemany needs the same columns in every row
+        defaults = dict((c.name, c.default.arg) for c in table.columns
+                        if c.default is not None and c.default.is_scalar)
+        defaults.update(created=make_timestamp(), info={})
+        rows = [dict(defaults, **task) for task in tasks]
+        for row in rows:
+            row['app_id'] = app_id
+        try:
+            conn = self.db.session.connection()
+            conn.execute(table.insert(), rows)
+            n_completed_tasks = sum(1 for row in rows
+                                    if row['state'] == u'completed')
+            n_answers = sum(int(row['n_answers'] or 0) for row in rows)
+            update_project_stats(conn, app_id, n_tasks=len(rows),
+                                 n_completed_tasks=n_completed_tasks,
+                                 n_answers=n_answers)
+            task = Task(app_id=app_id)
+            update_app_timestamp(None, conn, task)
+            add_event(None, conn, task)
+            self.db.session.commit()
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+        except SQLAlchemyError:
+            # e.g. a deadlock, which leaves the transaction aborted
+            self.db.session.rollback()
+            raise
+        if TaskQueue.enabled():
+            TaskQueue(sentinel.master).invalidate(app_id)
+
+    def save_task_runs(self, task_runs):
+        """Insert many task runs of one volunteer in one statement and commit
+        them. Return the ids of the new task runs, in the same order.
+
+        task_runs are dicts with TaskRun attributes, with at most one task run
+        per task. As no TaskRun object is flushed, what the TaskRun event
+        listeners do for every task run is done by after_bulk_insert for all
+        of them.
+
+        """
+        table = TaskRun.__table__
+        now = make_timestamp()
+        # A multi row insert needs the same columns in every row
+        defaults = dict((c.name, None) for c in table.columns
+                        if c.name != 'id')
+        defaults.update(created=now, finish_time=now, info={})
+        rows = [dict(defaults, **task_run) for task_run in task_runs]
+        try:
+            conn = self.db.session.connection()
+            insert = table.insert().values(rows).returning(table.c.id,
+                                                           table.c.task_id)
+            ids = dict((row.task_id, row.id) for row in conn.execute(insert))
+            for row in rows:
+                row['id'] = ids[row['task_id']]
+            after_bulk_insert(conn, rows)
+            self.db.session.commit()
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+        except SQLAlchemyError:
+            # e.g. a deadlock, which leaves the transaction aborted
+            self.db.session.rollback()
+            raise
+        return [row['id'] for row in rows]
+
     def update(self, element):
         self._validate_can_be('updated', element)
         try:
@@ -125,7 +231,11 @@ class TaskRepository(object):
                    and project_tasks.id=task.id
                    ''')
         self.db.session.execute(sql, dict(n_answers=n_answer, app_id=project.id))
+        rebuild_project_stats(self.db.session.connection(), project.id)
         self.db.session.commit()
+        # Task states changed in bulk, so the scheduler queue must be reloaded
+        if TaskQueue.enabled():
+            TaskQueue(sentinel.master).invalidate(project.id)
 
 
     def _validate_can_be(self, action, element):
@@ -19,17 +19,26 @@
 #import json
 #from flask import Blueprint, request, url_for, flash, redirect, abort
 #from flask import abort, request, make_response, current_app
-from sqlalchemy.sql import text
+from sqlalchemy.sql import text, func
 from pybossa.model.app import App
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
-from pybossa.core import db
+from pybossa.core import db, sentinel
+from pybossa.task_queue import TaskQueue
+from pybossa.task_reservation import TaskReservation
 import random
 
 
 
 session = db.slave_session
 
+# Maximum number of candidate tasks taken into account for a user (i.e. the
+# biggest offset a task presenter can ask for is MAX_CANDIDATES - 1)
+MAX_CANDIDATES = 10
+# Candidate tasks loaded when tasks are reserved, as the first ones may be
+# held by other users
+RESERVATION_CANDIDATES = 5 * MAX_CANDIDATES
+
 def new_task(app_id, sched, user_id=None, user_ip=None, offset=0):
     '''Get a new task by calling the appropriate scheduler function.
     '''
@@ -43,6 +52,20 @@ def new_task(app_id, sched, user_id=None, user_ip=None, offset=0):
     return scheduler(app_id, user_id, user_ip, offset=offset)
 
 
+def new_tasks(app_id, sched, user_id=None, user_ip=None, offset=0, limit=1):
+    '''Get up to limit new tasks, in the order new_task would return them
+    for consecutive offsets, with a single evaluation of the scheduler.
+    '''
+    sched_map = {
+        'default': get_depth_first_tasks,
+        'breadth_first': get_breadth_first_tasks,
+        'depth_first': get_depth_first_tasks,
+        'random': get_random_tasks,
+        'incremental': get_incremental_tasks}
+    scheduler = sched_map.get(sched, sched_map['default'])
+    return scheduler(app_id, user_id, user_ip, offset=offset, limit=limit)
+
+
 def get_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task which have the least number of task runs (excluding the
     current user).
@@ -51,79 +74,148 @@ def get_breadth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, off
     (this is not a big issue as all it means is that you may end up with some
     tasks run more than is strictly needed!)
     """
+    return _first(get_breadth_first_tasks(app_id, user_id, user_ip,
+                                          n_answers, offset=offset))
+
+
+def get_breadth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30,
+                            offset=0, limit=1):
+    """Gets up to limit new tasks for the breadth first scheduler."""
     # Uncomment the next three lines to profile the sched function
     #import timeit
     #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
     #                  user_ip, n_answers))
     #print "First algorithm: %s" % T.timeit(number=1)
+    if offset >= MAX_CANDIDATES:
+        return []
     if user_id and not user_ip:
         sql = text('''
+                   SELECT task.* FROM task JOIN (
                    SELECT task.id, COUNT(task_run.task_id) AS taskcount FROM task
                    LEFT JOIN task_run ON (task.id = task_run.task_id) WHERE NOT EXISTS
                    (SELECT 1 FROM task_run WHERE app_id=:app_id AND
                    user_id=:user_id AND task_id=task.id)
                    AND task.app_id=:app_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
+                   group by task.id ORDER BY taskcount, id ASC
+                   LIMIT :limit OFFSET :offset) AS candidates
+                   ON (task.id = candidates.id)
+                   ORDER BY candidates.taskcount, task.id ASC;
                    ''')
-        tasks = session.execute(sql, dict(app_id=app_id, user_id=user_id))
+        params = dict(app_id=app_id, user_id=user_id)
     else:
         if not user_ip: # pragma: no cover
             user_ip = '127.0.0.1'
         sql = text('''
+                   SELECT task.* FROM task JOIN (
                    SELECT task.id, COUNT(task_run.task_id) AS taskcount FROM task
                    LEFT JOIN task_run ON (task.id = task_run.task_id) WHERE NOT EXISTS
                    (SELECT 1 FROM task_run WHERE app_id=:app_id AND
                    user_ip=:user_ip AND task_id=task.id)
                    AND task.app_id=:app_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
+                   group by task.id ORDER BY taskcount, id ASC
+                   LIMIT :limit OFFSET :offset) AS candidates
+                   ON (task.id = candidates.id)
+                   ORDER BY candidates.taskcount, task.id ASC;
                    ''')
-
-        # results will be list of (taskid, count)
-        tasks = session.execute(sql, dict(app_id=app_id, user_ip=user_ip))
+        params = dict(app_id=app_id, user_ip=user_ip)
     # ignore n_answers for the present - we will just keep going once we've
     # done as many as we need
-    tasks = [x[0] for x in tasks]
-    if tasks:
-        if (offset == 0):
-            return session.query(Task).get(tasks[0])
-        else:
-            if (offset < len(tasks)):
-                return session.query(Task).get(tasks[offset])
-            else:
-                return None
-    else: # pragma: no cover
-        return None
+    first, n_candidates = candidate_window(offset, limit)
+    params.update(limit=n_candidates, offset=first)
+    tasks = session.query(Task).from_statement(sql).params(**params).all()
+    return pick_tasks(app_id, tasks, user_id, user_ip, offset, limit)
 
 
 def get_depth_first_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
     """Gets a new task for a given project"""
+    return _first(get_depth_first_tasks(app_id, user_id, user_ip, n_answers,
+                                        offset=offset))
+
+
+def get_depth_first_tasks(app_id, user_id=None, user_ip=None, n_answers=30,
+                          offset=0, limit=1):
+    """Gets up to limit new tasks for the depth first scheduler."""
+    if offset >= MAX_CANDIDATES:
+        return []
+    first, n_candidates = candidate_window(offset, limit)
+    if TaskQueue.enabled():
+        queue = TaskQueue(sentinel.master)
+        task_ids = queue.get_task_ids(app_id, user_id, user_ip,
+                                      limit=n_candidates, offset=first)
+        if task_ids is not None:
+            if not task_ids:
+                return []
+            tasks = session.query(Task).filter(Task.id.in_(task_ids),
+                                               Task.state != u'completed').all()
+            tasks = dict((task.id, task) for task in tasks)
+            if len(tasks) == len(task_ids):
+                tasks = [tasks[task_id] for task_id in task_ids]
+                return pick_tasks(app_id, tasks, user_id, user_ip, offset,
+                                  limit)
+            # The queue was stale, so remove the tasks and ask the DB
+            for task_id in task_ids:
+                if task_id not in tasks:
+                    queue.remove_task(app_id, task_id)
     # Uncomment the next three lines to profile the sched function
     #import timeit
     #T = timeit.Timer(lambda: get_candidate_tasks(app_id, user_id,
     #                  user_ip, n_answers))
     #print "First algorithm: %s" % T.timeit(number=1)
-    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers, offset=offset)
-    total_remaining = len(candidate_tasks)
-    #print "Available tasks %s " % total_remaining
-    if total_remaining == 0:
-        return None
-    if (offset == 0):
-        return candidate_tasks[0]
-    else:
-        if (offset < len(candidate_tasks)):
-            return candidate_tasks[offset]
-        else:
-            return None
+    candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip, n_answers,
+                                          offset=first, limit=n_candidates)
+    return pick_tasks(app_id, candidate_tasks, user_id, user_ip, offset, limit)
 
 
 def get_random_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
-    """Returns a random task for the user"""
-    app = session.query(App).get(app_id)
-    from random import choice
-    if len(app.tasks) > 0:
-        return choice(app.tasks)
+    """Returns a random task for the user.
+
+    Instead of loading all the tasks of the project, it picks a random id
+    between the lowest and highest ids of the open tasks, and returns the
+    first task from it that the user has not contributed to yet (wrapping
+    around to the lowest ids if there is none after it). The queries use the
+    task_ongoing_app_id_id_idx index, so the cost does not grow with the
+    project. The tasks that follow gaps in the ids are more likely, which
+    is the price of not counting the candidates.
+    """
+    return _first(get_random_tasks(app_id, user_id, user_ip, n_answers,
+                                   offset=offset))
+
+
+def get_random_tasks(app_id, user_id=None, user_ip=None, n_answers=30,
+                     offset=0, limit=1):
+    """Returns up to limit tasks for the user, from the candidate at offset
+    after a random id (see get_random_task)."""
+    if offset >= MAX_CANDIDATES:
+        return []
+    if user_id and not user_ip:
+        exclude = 'user_id=:user_id'
+        params = dict(app_id=app_id, user_id=user_id)
     else:
-        return None
+        exclude = 'user_ip=:user_ip'
+        params = dict(app_id=app_id, user_ip=user_ip or '127.0.0.1')
+    sql = text('''SELECT MIN(id), MAX(id) FROM task
+               WHERE app_id=:app_id AND state !='completed';''')
+    min_id, max_id = session.execute(sql, params).first()
+    if min_id is None:
+        return []
+    probe = random.randint(min_id, max_id)
+    sql = text('''SELECT * FROM task WHERE NOT EXISTS
+               (SELECT 1 FROM task_run WHERE app_id=:app_id AND %s
+               AND task_id=task.id)
+               AND app_id=:app_id AND state !='completed'
+               AND id >= :first AND id < :last
+               ORDER BY id ASC LIMIT :limit;''' % exclude)
+    n_candidates = offset + limit
+    tasks = session.query(Task).from_statement(sql)\
+                   .params(first=probe, last=max_id + 1, limit=n_candidates,
+                           **params).all()
+    if len(tasks) < n_candidates:
+        # Wrap around to the lowest ids
+        tasks += session.query(Task).from_statement(sql)\
+                        .params(first=min_id, last=probe,
+                                limit=n_candidates - len(tasks),
+                                **params).all()
+    return tasks[offset:]
 
 
 def get_incremental_task(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
@@ -132,48 +224,113 @@ def get_incremental_task(app_id, user_id=None, user_ip=None, n_answers=30, offse
     It is an important strategy when dealing with large tasks, as
     transcriptions.
     """
+    return _first(get_incremental_tasks(app_id, user_id, user_ip, n_answers,
+                                        offset=offset))
+
+
+def get_incremental_tasks(app_id, user_id=None, user_ip=None, n_answers=30,
+                          offset=0, limit=1):
+    """Get up to limit new tasks with their last given answers (see
+    get_incremental_task)."""
+    first, n_candidates = candidate_window(0, MAX_CANDIDATES)
     candidate_tasks = get_candidate_tasks(app_id, user_id, user_ip,
-                                          n_answers, offset=0)
-    total_remaining = len(candidate_tasks)
-    if total_remaining == 0:
-        return None
-    rand = random.randrange(0, total_remaining)
-    task = candidate_tasks[rand]
-    #Find last answer for the task
-    q = session.query(TaskRun)\
-          .filter(TaskRun.task_id == task.id)\
-          .order_by(TaskRun.finish_time.desc())
-    last_task_run = q.first()
-    if last_task_run:
-        task.info['last_answer'] = last_task_run.info
-        #TODO: As discussed in GitHub #53
-        # it is necessary to create a lock in the task!
-    return task
-
-
-def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30, offset=0):
-    """Gets all available tasks for a given project and user"""
-    rows = None
+                                          n_answers, offset=first,
+                                          limit=n_candidates)
+    random.shuffle(candidate_tasks)
+    # The tasks are reserved, so two users do not work on them at the same
+    # time (as discussed in GitHub #53)
+    tasks = pick_tasks(app_id, candidate_tasks, user_id, user_ip, limit=limit)
+    for task in tasks:
+        #Find last answer for the task
+        q = session.query(TaskRun)\
+              .filter(TaskRun.task_id == task.id)\
+              .order_by(TaskRun.finish_time.desc())
+        last_task_run = q.first()
+        if last_task_run:
+            task.info['last_answer'] = last_task_run.info
+    return tasks
+
+
+def get_candidate_tasks(app_id, user_id=None, user_ip=None, n_answers=30,
+                        offset=0, limit=MAX_CANDIDATES):
+    """Gets all available tasks for a given project and user.
+
+    The tasks are fully loaded with a single query; use offset and limit to
+    get only some of them (e.g. limit=1 for the task at a given offset).
+    """
     if user_id and not user_ip:
         query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
+                     SELECT * FROM task WHERE NOT EXISTS
                      (SELECT task_id FROM task_run WHERE
                      app_id=:app_id AND user_id=:user_id AND task_id=task.id)
                      AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = session.execute(query, dict(app_id=app_id, user_id=user_id))
+                     ORDER BY priority_0 DESC, id ASC
+                     LIMIT :limit OFFSET :offset''')
+        params = dict(app_id=app_id, user_id=user_id)
     else:
         if not user_ip:
             user_ip = '127.0.0.1'
         query = text('''
-                     SELECT id FROM task WHERE NOT EXISTS
+                     SELECT * FROM task WHERE NOT EXISTS
                      (SELECT task_id FROM task_run WHERE
                      app_id=:app_id AND user_ip=:user_ip AND task_id=task.id)
                      AND app_id=:app_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
-        rows = session.execute(query, dict(app_id=app_id, user_ip=user_ip))
+                     ORDER BY priority_0 DESC, id ASC
+                     LIMIT :limit OFFSET :offset''')
+        params = dict(app_id=app_id, user_ip=user_ip)
+    params.update(limit=limit, offset=offset)
+    return session.query(Task).from_statement(query).params(**params).all()
 
-    tasks = []
-    for t in rows:
-        tasks.append(session.query(Task).get(t.id))
-    return tasks
+
+def candidate_window(offset=0, limit=1):
+    """Returns the (offset, limit) of the candidate tasks a scheduler has to
+    load for the tasks at a given offset.
+
+    Without reservations it is just the tasks from the offset. With them, the
+    task at a given offset depends on which of the previous ones are taken,
+    so a wider window from the first candidate is loaded.
+    """
+    if TaskReservation.enabled():
+        return 0, RESERVATION_CANDIDATES
+    return offset, min(limit, MAX_CANDIDATES - offset)
+
+
+def pick_tasks(app_id, tasks, user_id=None, user_ip=None, offset=0, limit=1):
+    """Picks up to limit tasks among the candidates loaded for
+    candidate_window(offset, limit).
+
+    With reservations, it returns the tasks from the offset among the ones
+    that can be reserved for the user, i.e. the ones with fewer users working
+    on them than the answers they still need. Only the returned tasks are
+    reserved, and if every candidate is taken it returns fewer tasks (or
+    none), so no task is handed out to more users than it needs.
+    """
+    if not TaskReservation.enabled():
+        return tasks[:limit]
+    if offset >= len(tasks):
+        return []
+    time_limit = session.query(App.time_limit)\
+                        .filter(App.id == app_id).scalar()
+    timeout = TaskReservation.timeout(time_limit)
+    task_ids = [task.id for task in tasks]
+    n_runs = dict(session.query(TaskRun.task_id, func.count(TaskRun.id))
+                  .filter(TaskRun.task_id.in_(task_ids))
+                  .group_by(TaskRun.task_id).all())
+    reservation = TaskReservation(sentinel.master)
+    skipped = 0
+    picked = []
+    for task in tasks:
+        slots = (task.n_answers or 0) - n_runs.get(task.id, 0)
+        if skipped < offset:
+            # The tasks before the offset are counted, not reserved
+            if reservation.is_free(task.id, slots, user_id, user_ip):
+                skipped += 1
+        elif reservation.reserve(task.id, slots, timeout, user_id, user_ip):
+            picked.append(task)
+            if len(picked) == limit:
+                break
+    return picked
+
+
+def _first(tasks):
+    return tasks[0] if tasks else None
@@ -0,0 +1,186 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Task queue module for serving the depth first scheduler from Redis.
+
+This module exports:
+    * TaskQueue class: keeps, for every project, a sorted set with the ids of
+      its open tasks (scored by priority_0 and id) and, for every user, a set
+      with the ids of the tasks the user has already contributed to.
+
+The structures are filled lazily and kept up to date by the Task and TaskRun
+event listeners. When they are not loaded (cold), the scheduler falls back to
+the SQL queries.
+
+"""
+from flask import current_app
+from sqlalchemy.sql import text
+from rq import Queue
+
+from pybossa.core import db, sentinel
+
+
+class TaskQueue(object):
+
+    """Redis backed queue of open tasks for a project."""
+
+    queue_timeout = 24 * 60 * 60
+    seen_timeout = 60 * 60
+    warm_timeout = 10 * 60
+    chunk_size = 50
+    max_scan = 1000
+    batch_size = 1000
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+
+    @staticmethod
+    def enabled():
+        """Return True if the scheduler should use the Redis task queue."""
+        return bool(current_app.config.get('SCHED_TASK_QUEUE'))
+
+    def get_task_ids(self, app_id, user_id=None, user_ip=None, limit=1,
+                     offset=0):
+        """Return the ids of the open tasks the user has not contributed to
+        yet, sorted as the depth first scheduler does (priority_0 DESC, id
+        ASC).
+
+        Returns None if the queue of the project is cold, or if the user has
+        contributed to so many of the top tasks that answering from Redis
+        would be more expensive than asking the DB.
+
+        """
+        key = self._queue_key(app_id)
+        if not self.redis.exists(self._loaded_key(key)):
+            self.request_warm(app_id)
+            return None
+        seen_key = self._load_seen(app_id, user_id, user_ip)
+        wanted = offset + limit
+        task_ids = []
+        start = 0
+        while start < self.max_scan:
+            members = self.redis.zrange(key, start,
+                                        start + self.chunk_size - 1)
+            if not members:
+                return task_ids[offset:]
+            pipe = self.redis.pipeline(transaction=False)
+            for member in members:
+                pipe.sismember(seen_key, int(member))
+            for member, seen in zip(members, pipe.execute()):
+                if not seen:
+                    task_ids.append(int(member))
+                    if len(task_ids) >= wanted:
+                        return task_ids[offset:]
+            start += self.chunk_size
+        return None
+
+    def request_warm(self, app_id):
+        """Enqueue a job for loading the queue of a project, unless there is
+        one already on its way."""
+        from pybossa.jobs import warm_task_queue
+        warming_key = '%s:warming' % self._queue_key(app_id)
+        if self.redis.set(warming_key, 1, ex=self.warm_timeout, nx=True):
+            queue = Queue('high', connection=sentinel.master)
+            queue.enqueue(warm_task_queue, app_id)
+
+    def warm(self, app_id):
+        """Load the queue of a project with all its open tasks."""
+        key = self._queue_key(app_id)
+        sql = text('''SELECT id, priority_0 FROM task WHERE app_id=:app_id
+                   AND state !='completed';''')
+        results = db.slave_session.execute(sql, dict(app_id=app_id))
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        batch = []
+        for row in results:
+            batch.extend([self._score(row.priority_0), self._member(row.id)])
+            if len(batch) >= 2 * self.batch_size:
+                pipe.zadd(key, *batch)
+                batch = []
+        if batch:
+            pipe.zadd(key, *batch)
+        pipe.expire(key, self.queue_timeout)
+        pipe.setex(self._loaded_key(key), self.queue_timeout, 1)
+        pipe.delete('%s:warming' % key)
+        pipe.execute()
+
+    def invalidate(self, app_id):
+        """Mark the queue of a project as cold, so it is loaded again."""
+        key = self._queue_key(app_id)
+        self.redis.delete(self._loaded_key(key), key)
+
+    def add_task(self, app_id, task_id, priority_0):
+        """Add (or re-score) an open task in the queue of its project."""
+        key = self._queue_key(app_id)
+        if self.redis.exists(self._loaded_key(key)):
+            self.redis.zadd(key, self._score(priority_0),
+                            self._member(task_id))
+
+    def remove_task(self, app_id, task_id):
+        """Remove a task (completed or deleted) from the queue."""
+        self.redis.zrem(self._queue_key(app_id), self._member(task_id))
+
+    def add_seen(self, app_id, task_id, user_id=None, user_ip=None):
+        """Record that a user has contributed to a task."""
+        key = self._seen_key(app_id, user_id, user_ip)
+        if self.redis.exists(self._loaded_key(key)):
+            self.redis.sadd(key, task_id)
+
+    def _load_seen(self, app_id, user_id=None, user_ip=None):
+        key = self._seen_key(app_id, user_id, user_ip)
+        if self.redis.exists(self._loaded_key(key)):
+            return key
+        if user_id and not user_ip:
+            sql = text('''SELECT task_id FROM task_run WHERE app_id=:app_id
+                       AND user_id=:user_id;''')
+            params = dict(app_id=app_id, user_id=user_id)
+        else:
+            sql = text('''SELECT task_id FROM task_run WHERE app_id=:app_id
+                       AND user_ip=:user_ip;''')
+            params = dict(app_id=app_id, user_ip=user_ip or '127.0.0.1')
+        task_ids = [row.task_id for row in
+                    db.slave_session.execute(sql, params)]
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        for i in range(0, len(task_ids), self.batch_size):
+            pipe.sadd(key, *task_ids[i:i + self.batch_size])
+        pipe.expire(key, self.seen_timeout)
+        pipe.setex(self._loaded_key(key), self.seen_timeout, 1)
+        pipe.execute()
+        return key
+
+    def _queue_key(self, app_id):
+        return 'pybossa:sched:app:%s:tasks' % app_id
+
+    def _seen_key(self, app_id, user_id=None, user_ip=None):
+        if user_id and not user_ip:
+            usr = user_id
+        else:
+            usr = user_ip or '127.0.0.1'
+        return 'pybossa:sched:app:%s:user:%s:seen' % (app_id, usr)
+
+    def _loaded_key(self, key):
+        return '%s:loaded' % key
+
+    def _score(self, priority_0):
+        # Lower scores come first, so the highest priority gets the lowest one
+        return -(priority_0 or 0)
+
+    def _member(self, task_id):
+        # Zero padded, so tasks with the same priority are sorted by id
+        return '%010d' % task_id
@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Task reservation module for the schedulers.
+
+This module exports:
+    * TaskReservation class: keeps, for every task, a sorted set with the
+      users that have been given the task and have not sent their answer yet
+      (scored by the time their reservation expires), so a task is not handed
+      out to more users than the answers it still needs.
+
+Reservations are released when the user sends a TaskRun for the task, or when
+they expire.
+
+"""
+import time
+
+from flask import current_app
+
+
+class TaskReservation(object):
+
+    """Redis backed reservations of tasks for users."""
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+
+    @staticmethod
+    def enabled():
+        """Return True if the schedulers should reserve tasks."""
+        return bool(current_app.config.get('SCHED_RESERVATION'))
+
+    @staticmethod
+    def timeout(time_limit=None):
+        """Return the reservation timeout for a project, which is its
+        time_limit if it has one, or the default SCHED_RESERVATION_TIMEOUT."""
+        if time_limit:
+            return time_limit
+        return current_app.config.get('SCHED_RESERVATION_TIMEOUT')
+
+    def reserve(self, task_id, slots, timeout, user_id=None, user_ip=None):
+        """Reserve a task for a user if there are free slots for it.
+
+        slots is the number of users that can hold the task at the same time
+        (i.e. n_answers - current task runs). Returns True if the user holds
+        the task (even if they already had it), False otherwise.
+
+        """
+        key = self._key(task_id)
+        member = self._member(user_id, user_ip)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zscore(key, member)
+        if pipe.execute()[1] is not None:
+            return True
+        if slots <= 0:
+            return False
+        pipe = self.redis.pipeline()
+        pipe.zadd(key, now + timeout, member)
+        pipe.zrank(key, member)
+        pipe.expire(key, timeout)
+        rank = pipe.execute()[1]
+        if rank is not None and rank < slots:
+            return True
+        # Somebody else took the last free slot
+        self.redis.zrem(key, member)
+        return False
+
+    def is_free(self, task_id, slots, user_id=None, user_ip=None):
+        """Return True if reserve would give the task to the user (they hold
+        it, or it has a free slot), without reserving it."""
+        key = self._key(task_id)
+        pipe = self.redis.pipeline()
+        pipe.zscore(key, self._member(user_id, user_ip))
+        pipe.zcount(key, time.time(), '+inf')
+        score, n_reserved = pipe.execute()
+        if score is not None and score > time.time():
+            return True
+        return n_reserved < slots
+
+    def release(self, task_id, user_id=None, user_ip=None):
+        """Release the reservation of a task for a user."""
+        self.redis.zrem(self._key(task_id), self._member(user_id, user_ip))
+
+    def count(self, task_id):
+        """Return the number of live reservations of a task."""
+        return self.redis.zcount(self._key(task_id), time.time(), '+inf')
+
+    def _key(self, task_id):
+        return 'pybossa:sched:task:%s:reserved' % task_id
+
+    def _member(self, user_id=None, user_ip=None):
+        if user_id and not user_ip:
+            return 'user:%s' % user_id
+        return 'ip:%s' % (user_ip or '127.0.0.1')
@@ -24,7 +24,10 @@ This module exports:
 
 """
 import sys
+import tempfile
+from contextlib import contextmanager
 from PIL import Image
+from werkzeug.datastructures import FileStorage
 
 
 class Uploader(object):
@@ -98,6 +101,26 @@ class Uploader(object):
         else:
             return False
 
+    @contextmanager
+    def open_file(self, filename, container):
+        """Yield a file to write the content of filename, which is uploaded
+        into the container when the block ends without errors.
+
+        By default the content goes to a temporary file, that is uploaded
+        and then removed. Its extension is not checked, as it is not a file
+        sent by a user.
+
+        """
+        tmp = tempfile.TemporaryFile()
+        try:
+            yield tmp
+            tmp.flush()
+            tmp.seek(0)
+            self._upload_file(FileStorage(filename=filename, stream=tmp),
+                              container)
+        finally:
+            tmp.close()
+
     def external_url_handler(self, error, endpoint, values):
         """Build up an external URL when url_for cannot build a URL."""
         # This is an example of hooking the build_error_handler.
@@ -25,6 +25,8 @@ This module exports:
 """
 from pybossa.uploader import Uploader
 import os
+import tempfile
+from contextlib import contextmanager
 from werkzeug import secure_filename
 
 
@@ -64,6 +66,25 @@ class LocalUploader(Uploader):
         except:
             return False
 
+    @contextmanager
+    def open_file(self, filename, container):
+        """Yield a file in the folder of the container, that replaces
+        filename when the block ends without errors, so the content is
+        written to disk just once."""
+        folder = os.path.join(self.upload_folder, container)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, secure_filename(filename))
+        tmp = tempfile.NamedTemporaryFile(dir=folder, prefix='.', delete=False)
+        try:
+            yield tmp
+            tmp.close()
+            os.rename(tmp.name, path)
+        except:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+
     def delete_file(self, name, container):
         """Delete file from filesystem."""
         try:
@@ -22,7 +22,6 @@ import json
 import os
 import math
 import requests
-from StringIO import StringIO
 
 from flask import Blueprint, request, url_for, flash, redirect, abort, Response, current_app
 from flask import render_template, make_response, session
@@ -34,9 +33,8 @@ import pybossa.model as model
 import pybossa.sched as sched
 
 from pybossa.core import (uploader, signer, sentinel, json_exporter,
-    csv_exporter, importer, flickr)
+    csv_exporter, ndjson_exporter, importer, flickr)
 from pybossa.model.app import App
-from pybossa.model.task import Task
 from pybossa.model.auditlog import Auditlog
 from pybossa.model.blogpost import Blogpost
 from pybossa.util import Pagination, admin_required, get_user_id_or_ip
@@ -51,7 +49,7 @@ from pybossa.cookies import CookieHandler
 from pybossa.password_manager import ProjectPasswdManager
 from pybossa.jobs import import_tasks
 from pybossa.forms.applications_view_forms import *
-from pybossa.importers import BulkImportException
+from pybossa.importers import BulkImportException, ImportProgress
 
 from pybossa.core import project_repo, user_repo, task_repo, blog_repo, auditlog_repo
 from pybossa.auditlogger import AuditLogger
@@ -63,6 +61,7 @@ auditlogger = AuditLogger(auditlog_repo, caller='web')
 importer_queue = Queue('medium', connection=sentinel.master)
 MAX_NUM_SYNCHRONOUS_TASKS_IMPORT = 200
 HOUR = 60 * 60
+IMPORT_TIMEOUT = 2 * HOUR
 
 def app_title(app, page_name):
     if not app:  # pragma: no cover
@@ -347,6 +346,7 @@ def delete(short_name):
     cached_apps.delete_app(app.short_name)
     cached_apps.clean(app.id)
     project_repo.delete(app)
+    stats.reset_stats(app.id)
     auditlogger.add_log_entry(app, None, current_user)
     flash(gettext('Project deleted!'), 'success')
     return redirect(url_for('account.profile', name=current_user.name))
@@ -566,12 +566,17 @@ def import_task(short_name):
 
 
 def _import_tasks(app, **form_data):
-    number_of_tasks = importer.count_tasks_to_import(**form_data)
+    # Counting stops as soon as there are too many tasks, so a big file is
+    # only read to the end once, by the import job
+    number_of_tasks = importer.count_tasks_to_import(
+        limit=MAX_NUM_SYNCHRONOUS_TASKS_IMPORT + 1, **form_data)
     if number_of_tasks <= MAX_NUM_SYNCHRONOUS_TASKS_IMPORT:
         msg = importer.create_tasks(task_repo, app.id, **form_data)
         flash(msg)
     else:
-        importer_queue.enqueue(import_tasks, app.id, **form_data)
+        ImportProgress(sentinel.master, app.id).queue(form_data)
+        importer_queue.enqueue_call(func=import_tasks, args=(app.id,),
+                                    kwargs=form_data, timeout=IMPORT_TIMEOUT)
         flash(gettext("You're trying to import a large amount of tasks, so please be patient.\
             You will receive an email when the tasks are ready."))
     return redirect(url_for('.tasks', short_name=app.short_name))
@@ -894,10 +899,7 @@ def delete_tasks(short_name):
         task_repo.delete_all(tasks)
         msg = gettext("All the tasks and associated task runs have been deleted")
         flash(msg, 'success')
-        cached_apps.delete_last_activity(app.id)
-        cached_apps.delete_n_tasks(app.id)
-        cached_apps.delete_n_task_runs(app.id)
-        cached_apps.delete_overall_progress(app.id)
+        stats.reset_stats(app.id)
         return redirect(url_for('.tasks', short_name=app.short_name))
 
 
@@ -931,60 +933,7 @@ def export_to(short_name):
 
 
     def gen_json(table):
-        n = getattr(task_repo, 'count_%ss_with' % table)(app_id=app.id)
-        sep = ", "
-        yield "["
-        for i, tr in enumerate(getattr(task_repo, 'filter_%ss_by' % table)(app_id=app.id, yielded=True), 1):
-            item = json.dumps(tr.dictize())
-            if (i == n):
-                sep = ""
-            yield item + sep
-        yield "]"
-
-    def format_csv_properly(row, ty=None):
-        tmp = row.keys()
-        task_keys = []
-        for k in tmp:
-            k = "%s__%s" % (ty, k)
-            task_keys.append(k)
-        if (type(row['info']) == dict):
-            task_info_keys = []
-            tmp = row['info'].keys()
-            for k in tmp:
-                k = "%sinfo__%s" % (ty, k)
-                task_info_keys.append(k)
-        else:
-            task_info_keys = []
-
-        keys = sorted(task_keys + task_info_keys)
-        values = []
-        _prefix = "%sinfo" % ty
-        for k in keys:
-            prefix, k = k.split("__")
-            if prefix == _prefix:
-                if row['info'].get(k) is not None:
-                    values.append(row['info'][k])
-                else:
-                    values.append(None)
-            else:
-                if row.get(k) is not None:
-                    values.append(row[k])
-                else:
-                    values.append(None)
-
-        return values
-
-    def handle_task(writer, t):
-        writer.writerow(format_csv_properly(t.dictize(), ty='task'))
-
-    def handle_task_run(writer, t):
-        writer.writerow(format_csv_properly(t.dictize(), ty='taskrun'))
-
-    def get_csv(out, writer, table, handle_row):
-        for tr in getattr(task_repo, 'filter_%ss_by' % table)(app_id=app.id,
-                                                              yielded=True):
-            handle_row(writer, tr)
-        yield out.getvalue()
+        return json_exporter.gen_json(table, app.id)
 
     def respond_json(ty):
         if ty not in ['task', 'task_run']:
@@ -992,6 +941,11 @@ def export_to(short_name):
         res = json_exporter.response_zip(app, ty)
         return res
 
+    def respond_ndjson(ty):
+        if ty not in ['task', 'task_run']:
+            return abort(404)
+        return ndjson_exporter.response_zip(app, ty)
+
     def create_ckan_datastore(ckan, table, package_id):
         new_resource = ckan.resource_create(name=table,
                                             package_id=package_id)
@@ -1063,20 +1017,14 @@ def export_to(short_name):
     def respond_csv(ty):
         # Export Task(/Runs) to CSV
         types = {
-            "task": (
-                Task, handle_task,
-                (lambda x: True),
-                gettext(
-                    "Oops, the project does not have tasks to \
-                    export, if you are the owner add some tasks")),
-            "task_run": (
-                model.task_run.TaskRun, handle_task_run,
-                (lambda x: True),
-                gettext(
-                    "Oops, there are no Task Runs yet to export, invite \
-                     some users to participate"))}
+            "task": gettext(
+                "Oops, the project does not have tasks to \
+                export, if you are the owner add some tasks"),
+            "task_run": gettext(
+                "Oops, there are no Task Runs yet to export, invite \
+                 some users to participate")}
         try:
-            table, handle_row, test, msg = types[ty]
+            msg = types[ty]
         except KeyError:
             return abort(404)
 
@@ -1089,7 +1037,7 @@ def export_to(short_name):
             flash(msg, 'info')
             return respond()
 
-    export_formats = ["json", "csv"]
+    export_formats = ["json", "csv", "ndjson"]
     if current_user.is_authenticated():
         if current_user.ckan_api:
             export_formats.append('ckan')
@@ -1113,7 +1061,8 @@ def export_to(short_name):
                                overall_progress=overall_progress)
     if fmt not in export_formats:
         abort(415)
-    return {"json": respond_json, "csv": respond_csv, 'ckan': respond_ckan}[fmt](ty)
+    return {"json": respond_json, "csv": respond_csv, "ndjson": respond_ndjson,
+            'ckan': respond_ckan}[fmt](ty)
 
 
 @blueprint.route('/<short_name>/stats')
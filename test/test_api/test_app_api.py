@@ -645,3 +645,61 @@ class TestAppAPI(TestAPI):
         url = '/api/app/%s/newtask?offset=1000' % app.id
         res = self.app.get(url)
         assert res.data == '{}', res.data
+
+
+    @with_context
+    def test_newtasks(self):
+        """Test API project new_tasks method returns several tasks"""
+        app = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=app)
+
+        res = self.app.get('/api/app/%s/newtasks?limit=2' % app.id)
+        data = json.loads(res.data)
+
+        assert res.mimetype == 'application/json', res
+        assert [t['id'] for t in data] == [tasks[0].id, tasks[1].id], data
+
+        res = self.app.get('/api/app/%s/newtasks?limit=10' % app.id)
+        data = json.loads(res.data)
+        assert len(data) == 3, data
+
+    @with_context
+    @patch('pybossa.api.mark_task_as_requested_by_user')
+    def test_newtasks_marks_all_tasks_as_requested(self, mark):
+        """Test API project new_tasks marks every task as requested"""
+        app = AppFactory.create()
+        TaskFactory.create_batch(3, app=app)
+
+        self.app.get('/api/app/%s/newtasks?limit=3' % app.id)
+
+        assert mark.call_count == 3, mark.call_count
+
+    @with_context
+    def test_import_progress(self):
+        """Test API import progress returns the progress of the last import
+        of the project to its owner only"""
+        from pybossa.core import sentinel
+        from pybossa.importers import ImportProgress
+        owner, other = UserFactory.create_batch(2)
+        app = AppFactory.create(owner=owner)
+        url = '/api/app/%s/import?api_key=%s' % (app.id, owner.api_key)
+
+        res = self.app.get(url)
+        assert json.loads(res.data) == {}, res.data
+
+        progress = ImportProgress(sentinel.master, app.id)
+        progress.queue(dict(type='csv', csv_url='http://fakecsv.com'))
+        progress.update(parsed=10, inserted=8, duplicates=2, committed=10)
+
+        res = self.app.get(url)
+        data = json.loads(res.data)
+        assert data == dict(state='queued', parsed=10, inserted=8,
+                            duplicates=2, committed=10, message=''), data
+
+        res = self.app.get('/api/app/%s/import?api_key=%s'
+                           % (app.id, other.api_key))
+        assert res.status_code == 403, res.status_code
+        res = self.app.get('/api/app/%s/import' % app.id)
+        assert res.status_code == 401, res.status_code
+        res = self.app.get('/api/app/5000/import?api_key=%s' % owner.api_key)
+        assert res.status_code == 404, res.status_code
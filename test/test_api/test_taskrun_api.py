@@ -16,12 +16,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 import json
-from default import with_context
+from default import with_context, db
 from nose.tools import assert_equal
 from test_api import TestAPI
 from mock import patch
 from factories import (AppFactory, TaskFactory, TaskRunFactory,
                         AnonymousTaskRunFactory, UserFactory)
+from pybossa.repositories import TaskRepository
+
+task_repo = TaskRepository(db)
 
 
 
@@ -445,3 +448,124 @@ class TestTaskrunAPI(TestAPI):
         assert tmp.status_code == 200, r_taskrun
         err_msg = "Task state should be equal to completed"
         assert task.state == 'completed', err_msg
+
+
+    @with_context
+    @patch('pybossa.api.task_run._check_tasks_requested_by_user')
+    def test_taskrun_bulk_post(self, requested):
+        """Test API TaskRun bulk creation saves the valid task runs and
+        returns the result of every one"""
+        app = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=app, n_answers=1)
+        requested.return_value = set(task.id for task in tasks)
+        url = '/api/taskrun/bulk?api_key=%s' % app.owner.api_key
+        data = [dict(app_id=app.id, task_id=tasks[0].id, info='answer 0'),
+                dict(app_id=app.id + 1, task_id=tasks[1].id, info='answer 1'),
+                dict(app_id=app.id, task_id=100000000, info='answer 2'),
+                dict(app_id=app.id, task_id=tasks[2].id, info='answer 3'),
+                dict(app_id=app.id, task_id=tasks[2].id, info='answer 4'),
+                dict(app_id=app.id, task_id=tasks[1].id, wrong='answer 5')]
+
+        res = self.app.post(url, data=json.dumps(data))
+        results = json.loads(res.data)
+
+        assert res.status_code == 200, res.data
+        assert [r['status'] for r in results] == ['ok', 'failed', 'failed',
+                                                  'ok', 'failed', 'failed']
+        assert [r.get('status_code') for r in results] == [None, 403, 403,
+                                                           None, 403, 415]
+        assert results[1]['exception_msg'] == 'Invalid app_id', results
+        assert results[2]['exception_msg'] == 'Invalid task_id', results
+        assert results[1]['target'] == 'taskrun', results
+        taskrun = task_repo.get_task_run(results[3]['id'])
+        assert taskrun.task_id == tasks[2].id, taskrun
+        assert taskrun.user_id == app.owner.id, taskrun
+        assert taskrun.info == 'answer 3', taskrun
+        assert task_repo.count_task_runs_with(app_id=app.id) == 2
+        assert [task_repo.get_task(t.id).state for t in tasks] == [
+            'completed', 'ongoing', 'completed']
+
+        # Sending them again is forbidden
+        res = self.app.post(url, data=json.dumps(data[:1]))
+        results = json.loads(res.data)
+        assert results[0]['status_code'] == 403, results
+
+
+    @with_context
+    def test_taskrun_bulk_post_requires_newtask_first(self):
+        """Test API TaskRun bulk creation fails for the tasks that were not
+        previously requested by the user"""
+        app = AppFactory.create()
+        tasks = TaskFactory.create_batch(2, app=app)
+        res = self.app.get('/api/app/%s/newtask?api_key=%s'
+                           % (app.id, app.owner.api_key))
+        requested_id = json.loads(res.data)['id']
+        other_id = [t.id for t in tasks if t.id != requested_id][0]
+        url = '/api/taskrun/bulk?api_key=%s' % app.owner.api_key
+        data = [dict(app_id=app.id, task_id=task_id, info='my task result')
+                for task_id in (requested_id, other_id)]
+
+        res = self.app.post(url, data=json.dumps(data))
+        results = json.loads(res.data)
+
+        assert [r['status'] for r in results] == ['ok', 'failed'], results
+        assert results[1]['exception_msg'] == 'You must request a task first!'
+
+
+    @with_context
+    def test_taskrun_bulk_post_keeps_the_requests_of_failed_task_runs(self):
+        """Test API TaskRun bulk creation forgets only the requests of the
+        tasks of the saved task runs"""
+        app = AppFactory.create()
+        TaskFactory.create(app=app)
+        res = self.app.get('/api/app/%s/newtask?api_key=%s'
+                           % (app.id, app.owner.api_key))
+        task_id = json.loads(res.data)['id']
+        url = '/api/taskrun/bulk?api_key=%s' % app.owner.api_key
+
+        res = self.app.post(url, data=json.dumps(
+            [dict(app_id=app.id + 1, task_id=task_id, info='answer')]))
+        assert json.loads(res.data)[0]['exception_msg'] == 'Invalid app_id'
+
+        res = self.app.post(url, data=json.dumps(
+            [dict(app_id=app.id, task_id=task_id, info='answer')]))
+        assert json.loads(res.data)[0]['status'] == 'ok', res.data
+
+
+    @with_context
+    @patch('pybossa.api.task_run._check_tasks_requested_by_user')
+    def test_taskrun_bulk_post_anonymous(self, requested):
+        """Test API TaskRun bulk creation for anonymous users respects the
+        projects that do not allow them"""
+        app = AppFactory.create()
+        closed_app = AppFactory.create(allow_anonymous_contributors=False)
+        task = TaskFactory.create(app=app)
+        closed_task = TaskFactory.create(app=closed_app)
+        requested.return_value = set([task.id, closed_task.id])
+        data = [dict(app_id=app.id, task_id=task.id, info='answer'),
+                dict(app_id=closed_app.id, task_id=closed_task.id,
+                     info='answer')]
+
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps(data))
+        results = json.loads(res.data)
+
+        assert results[0]['status'] == 'ok', results
+        assert results[1]['status_code'] == 401, results
+        taskrun = task_repo.get_task_run(results[0]['id'])
+        assert taskrun.user_id is None and taskrun.user_ip is not None
+
+
+    @with_context
+    def test_taskrun_bulk_post_with_bad_data(self):
+        """Test API TaskRun bulk creation refuses anything but a list of at
+        most MAX_BULK_TASK_RUNS task runs"""
+        from pybossa.api.task_run import MAX_BULK_TASK_RUNS
+        app = AppFactory.create()
+        url = '/api/taskrun/bulk?api_key=%s' % app.owner.api_key
+
+        res = self.app.post(url, data=json.dumps(dict(app_id=app.id)))
+        assert res.status_code == 415, res.data
+
+        data = [dict(app_id=app.id, task_id=1)] * (MAX_BULK_TASK_RUNS + 1)
+        res = self.app.post(url, data=json.dumps(data))
+        assert res.status_code == 415, res.data
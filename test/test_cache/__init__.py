@@ -16,10 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import hashlib
+import cPickle as pickle
 from mock import patch
 from pybossa.cache import (get_key_to_hash, get_hash_key, cache, memoize,
-                           delete_cached, delete_memoized)
+                           delete_cached, delete_memoized,
+                           delete_untagged_memoized)
+from pybossa.cache.local import LocalCache
 from pybossa.sentinel import Sentinel
 from settings_test import REDIS_SENTINEL, REDIS_KEYPREFIX
 
@@ -209,6 +213,132 @@ class TestCacheMemoizeFunctions(object):
         assert second_call_other_arg == [('other',), {'kwarg': 'other'}], first_call
 
 
+    def test_memoize_waits_for_the_process_computing_a_missed_key(self):
+        """Test CACHE memoize does not call the function while another
+        process holds the lock for the same key, and returns its value"""
+
+        calls = []
+        @memoize()
+        def my_func(arg):
+            calls.append(arg)
+            return len(calls)
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set("%s:lock" % key, 1)
+
+        def other_process_stores_value(seconds):
+            test_sentinel.master.set(key, pickle.dumps(42))
+        with patch('pybossa.cache.time.sleep',
+                   side_effect=other_process_stores_value):
+            output = my_func('arg')
+
+        assert output == 42, output
+        assert calls == [], calls
+
+
+    def test_memoize_computes_value_if_the_lock_is_released_without_it(self):
+        """Test CACHE memoize calls the function if the process holding the
+        lock releases it without storing a value"""
+
+        @memoize()
+        def my_func(arg):
+            return 'computed'
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        lock = "%s:lock" % key
+        test_sentinel.master.set(lock, 1)
+
+        def other_process_fails(seconds):
+            test_sentinel.master.delete(lock)
+        with patch('pybossa.cache.time.sleep', side_effect=other_process_fails):
+            output = my_func('arg')
+
+        assert output == 'computed', output
+        assert not test_sentinel.master.exists(lock)
+
+
+    def test_memoize_waits_while_the_lock_is_held(self):
+        """Test CACHE memoize keeps waiting for the value while the process
+        computing it holds the lock, however long it takes"""
+
+        calls = []
+        @memoize()
+        def my_func(arg):
+            calls.append(arg)
+            return 'computed'
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set("%s:lock" % key, 1)
+        start = time.time()
+        now = [start]
+        def other_process_takes_a_while(seconds):
+            now[0] += 1
+            if now[0] - start > 10:
+                test_sentinel.master.set(key, pickle.dumps(42))
+        with patch('pybossa.cache.time.time', side_effect=lambda: now[0]):
+            with patch('pybossa.cache.time.sleep',
+                       side_effect=other_process_takes_a_while):
+                output = my_func('arg')
+
+        assert output == 42, output
+        assert calls == [], calls
+
+
+    @patch('pybossa.cache.LOCK_TIMEOUT', 0.2)
+    def test_memoize_computes_value_if_the_wait_runs_out(self):
+        """Test CACHE memoize calls the function if the process holding the
+        lock does not store a value within LOCK_TIMEOUT seconds"""
+
+        @memoize()
+        def my_func(arg):
+            return 'computed'
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set("%s:lock" % key, 1)
+
+        output = my_func('arg')
+
+        assert output == 'computed', output
+
+
+    @patch('pybossa.cache._start_listener')
+    def test_waiting_for_a_key_counts_a_single_miss(self, _start_listener):
+        """Test CACHE the reads of a process waiting for a missed key are not
+        counted as misses of the local cache"""
+
+        @memoize()
+        def my_func(arg):
+            return 'computed'
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set("%s:lock" % key, 1)
+        polls = []
+        def other_process_stores_value(seconds):
+            polls.append(seconds)
+            if len(polls) == 3:
+                test_sentinel.master.set(key, pickle.dumps(42))
+        local_cache = LocalCache(size=10, timeout=5)
+        with patch('pybossa.cache.local_cache', local_cache):
+            with patch('pybossa.cache.time.sleep',
+                       side_effect=other_process_stores_value):
+                output = my_func('arg')
+
+        assert output == 42, output
+        assert local_cache.stats()['misses'] == 1, local_cache.stats()
+
+
+    def test_cache_releases_lock_after_computing(self):
+        """Test CACHE cache releases the lock once the value is stored"""
+
+        @cache(key_prefix='my_cached_func')
+        def my_func():
+            return 'my_func was called'
+        my_func()
+        key = "%s::%s" % (REDIS_KEYPREFIX, 'my_cached_func')
+
+        assert test_sentinel.master.keys() == [key], test_sentinel.master.keys()
+
+
     def test_delete_cached_returns_true_when_delete_succeeds(self):
         """Test CACHE delete_cached deletes a stored key and returns True if
         deletion is successful"""
@@ -246,7 +376,8 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, my_func.__name__)
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
@@ -260,11 +391,12 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, my_func.__name__)
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
 
         delete_succedeed = delete_memoized(my_func, 'badarg', kwarg='barkwarg')
         assert delete_succedeed is False, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Key was unexpectedly deleted'
+        assert len(test_sentinel.master.keys(key_pattern)) == 1, 'Key was unexpectedly deleted'
 
 
     def test_delete_memoized_deletes_only_requested(self):
@@ -276,11 +408,12 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
-        assert len(test_sentinel.master.keys()) == 2
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, my_func.__name__)
+        assert len(test_sentinel.master.keys(key_pattern)) == 2
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Everything was deleted!'
+        assert len(test_sentinel.master.keys(key_pattern)) == 1, 'Everything was deleted!'
 
 
     def test_delete_memoized_deletes_all_function_calls(self):
@@ -296,8 +429,201 @@ class TestCacheMemoizeFunctions(object):
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
         my_other_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 3
+        key_pattern = "%s:*_args:*" % REDIS_KEYPREFIX
+        assert len(test_sentinel.master.keys(key_pattern)) == 3
 
         delete_succedeed = delete_memoized(my_func)
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
+
+
+    def test_delete_untagged_memoized_deletes_old_keys_once(self):
+        """Test CACHE delete_untagged_memoized deletes the memoized values
+        that are in no tag set, but scans the keyspace only once"""
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.setex(key, 300, pickle.dumps('untagged'))
+
+        assert delete_untagged_memoized() == 1
+        assert test_sentinel.master.get(key) is None
+
+        test_sentinel.master.setex(key, 300, pickle.dumps('untagged'))
+        assert delete_untagged_memoized() == 0
+        assert test_sentinel.master.get(key) is not None
+
+
+    def test_delete_untagged_memoized_scans_again_if_a_scan_failed(self):
+        """Test CACHE delete_untagged_memoized only records that the keyspace
+        was scanned once a scan finishes"""
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.setex(key, 300, pickle.dumps('untagged'))
+
+        with patch.object(test_sentinel.master, 'scan_iter',
+                          side_effect=Exception('connection lost')):
+            try:
+                delete_untagged_memoized()
+            except Exception:
+                pass
+
+        assert delete_untagged_memoized() == 1
+        assert test_sentinel.master.get(key) is None
+
+
+    def test_delete_untagged_memoized_scans_in_one_process_at_a_time(self):
+        """Test CACHE delete_untagged_memoized does not scan the keyspace while
+        another process is scanning it"""
+        key = get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                           get_key_to_hash('arg'))
+        test_sentinel.master.setex(key, 300, pickle.dumps('untagged'))
+        lock = "%s:ztag:untagged_deleted:lock" % REDIS_KEYPREFIX
+        test_sentinel.master.set(lock, 1)
+
+        assert delete_untagged_memoized() == 0
+        assert test_sentinel.master.get(key) is not None
+
+        test_sentinel.master.delete(lock)
+        assert delete_untagged_memoized() == 1
+
+
+    def test_memoize_prunes_expired_keys_from_the_tag_set(self):
+        """Test CACHE memoize removes the keys that already expired from the
+        tag set of the function when it stores a new one"""
+
+        @memoize(timeout=1)
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+        tag = "%s:ztag:%s_args" % (REDIS_KEYPREFIX, my_func.__name__)
+        my_func('arg')
+
+        with patch('pybossa.cache.time.time', return_value=time.time() + 2):
+            my_func('other')
+
+        assert test_sentinel.master.zrange(tag, 0, -1) == [
+            get_hash_key("%s:%s_args:" % (REDIS_KEYPREFIX, 'my_func'),
+                         get_key_to_hash('other'))]
+
+
+    def test_delete_memoized_does_not_scan_keyspace(self):
+        """Test CACHE delete_memoized deletes all the function calls from the
+        tag set of the function, without using KEYS"""
+
+        @memoize()
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+        my_func('arg')
+        my_func('other')
+        tag = "%s:ztag:%s_args" % (REDIS_KEYPREFIX, my_func.__name__)
+        assert test_sentinel.master.zcard(tag) == 2
+
+        with patch.object(test_sentinel.slave, 'keys') as keys:
+            delete_succedeed = delete_memoized(my_func)
+
+        assert delete_succedeed is True, delete_succedeed
+        assert not keys.called
+        assert test_sentinel.master.keys() == [], test_sentinel.master.keys()
+
+
+
+class TestLocalCache(object):
+
+    def test_get_returns_stored_value_and_counts_hits(self):
+        """Test LocalCache get returns the stored value and counts hits and
+        misses"""
+        local_cache = LocalCache(size=10, timeout=60)
+        local_cache.set('key', 'value')
+
+        assert local_cache.get('key') == 'value'
+        assert local_cache.get('other') is None
+        assert local_cache.stats() == dict(hits=1, misses=1, size=1)
+
+    def test_evicts_least_recently_used(self):
+        """Test LocalCache evicts the least recently used value when full"""
+        local_cache = LocalCache(size=2, timeout=60)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        local_cache.get('a')
+        local_cache.set('c', 3)
+
+        assert local_cache.get('b') is None
+        assert local_cache.get('a') == 1
+        assert local_cache.get('c') == 3
+
+    @patch('pybossa.cache.local.time')
+    def test_values_expire(self, fake_time):
+        """Test LocalCache does not return expired values"""
+        fake_time.time.return_value = 1000
+        local_cache = LocalCache(size=10, timeout=5)
+        local_cache.set('key', 'value')
+        fake_time.time.return_value = 1006
+
+        assert local_cache.get('key') is None
+
+    def test_delete_with_wildcard_deletes_prefix(self):
+        """Test LocalCache delete with a trailing * deletes all the keys with
+        that prefix"""
+        local_cache = LocalCache(size=10, timeout=60)
+        local_cache.set('func:1', 1)
+        local_cache.set('func:2', 2)
+        local_cache.set('other:1', 3)
+
+        local_cache.delete('func:*')
+
+        assert local_cache.stats()['size'] == 1
+        assert local_cache.get('other:1') == 3
+
+
+@patch('pybossa.cache._start_listener')
+@patch('pybossa.cache.sentinel', new=test_sentinel)
+class TestCacheWithLocalCache(object):
+
+    @classmethod
+    def setup_class(cls):
+        import os
+        cls.cache = os.environ.pop('PYBOSSA_REDIS_CACHE_DISABLED', None)
+
+    @classmethod
+    def teardown_class(cls):
+        if cls.cache:
+            import os
+            os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = cls.cache
+
+    def setUp(self):
+        test_sentinel.master.flushall()
+
+    def test_memoize_hits_local_cache(self, _start_listener):
+        """Test CACHE memoize gets the value from the local cache without
+        going to Redis"""
+        local_cache = LocalCache()
+        with patch('pybossa.cache.local_cache', new=local_cache):
+            @memoize()
+            def my_func(arg, call_count=[]):
+                call_count.append(1)
+                return len(call_count)
+            my_func('arg')
+            test_sentinel.master.flushall()
+
+            assert my_func('arg') == 1
+            assert local_cache.stats()['hits'] == 1, local_cache.stats()
+
+    def test_delete_memoized_invalidates_local_cache(self, _start_listener):
+        """Test CACHE delete_memoized drops the local copies and publishes
+        the invalidation"""
+        local_cache = LocalCache()
+        with patch('pybossa.cache.local_cache', new=local_cache):
+            @memoize()
+            def my_func(arg, call_count=[]):
+                call_count.append(1)
+                return len(call_count)
+            my_func('arg')
+            my_func('other')
+
+            with patch.object(test_sentinel.master, 'publish') as publish:
+                delete_memoized(my_func)
+
+            assert local_cache.stats()['size'] == 0, local_cache.stats()
+            channel, key = publish.call_args[0]
+            assert channel == '%s:invalidate' % REDIS_KEYPREFIX, channel
+            assert key.endswith('my_func_args:*'), key
+            assert my_func('arg') == 3
+
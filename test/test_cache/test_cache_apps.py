@@ -439,6 +439,68 @@ class TestAppsCache(Test):
         assert cached_task.get('pct_status') == 1.0, cached_task.get('pct_status')
 
 
+    def test_summary_has_all_the_counters(self):
+        """Test CACHE PROJECTS summary returns all the counters of a project"""
+        project = self.create_app_with_contributors(2, 3, two_tasks=True)
+
+        summary = cached_apps.summary(project.id)
+
+        assert summary['n_tasks'] == 2, summary
+        assert summary['n_completed_tasks'] == 0, summary
+        assert summary['n_task_runs'] == 10, summary
+        assert summary['n_registered_volunteers'] == 3, summary
+        assert summary['n_anonymous_volunteers'] == 2, summary
+        assert summary['n_volunteers'] == 5, summary
+        assert summary['overall_progress'] == 0, summary
+        assert summary['last_activity'] is not None, summary
+
+
+    def test_summaries_returns_the_same_values_as_single_calls(self):
+        """Test CACHE PROJECTS summaries gets the same values in a batch as one
+        by one, also for projects without tasks"""
+        project = self.create_app_with_contributors(2, 3, two_tasks=True)
+        completed = self.create_app_with_tasks(2, 1)
+        empty = AppFactory.create()
+        app_ids = [project.id, completed.id, empty.id]
+
+        expected = [cached_apps.summary(app_id) for app_id in app_ids]
+        summaries = cached_apps.summaries(app_ids)
+
+        assert summaries == expected, (summaries, expected)
+        assert summaries[1]['overall_progress'] == 66, summaries[1]
+        assert summaries[2]['n_tasks'] == 0, summaries[2]
+        assert summaries[2]['last_activity'] is None, summaries[2]
+
+
+    def test_summaries_match_the_counters_computed_from_scratch(self):
+        """Test CACHE PROJECTS summaries read from project_stats are the same
+        as the ones computed from the task and task_run tables"""
+        project = self.create_app_with_contributors(2, 3, two_tasks=True)
+        completed = self.create_app_with_tasks(2, 1)
+        app_ids = [project.id, completed.id]
+
+        summaries = cached_apps.summaries(app_ids)
+        rows = cached_apps._count_summaries(app_ids)
+
+        for app_id, summary in zip(app_ids, summaries):
+            assert summary == cached_apps._summary(rows[app_id]), summary
+
+
+    def test_get_featured_adds_stats_in_batches(self):
+        """Test CACHE PROJECTS get_featured gets the stats of all the projects
+        in a single batch"""
+        AppFactory.create_batch(3, featured=True)
+
+        with patch.object(cached_apps, 'summaries',
+                          wraps=cached_apps.summaries) as summaries:
+            featured = cached_apps.get_featured()
+
+        assert len(featured) == 3, featured
+        assert summaries.call_count == 1, summaries.call_count
+        for project in featured:
+            assert project['n_tasks'] == 0, project
+
+
     def test_n_featured_returns_nothing(self):
         """Test CACHE PROJECTS _n_featured 0 if there are no featured projects"""
         number_of_featured = cached_apps._n_featured()
@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2014 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from default import Test, with_context
+from pybossa.cache import site_stats
+from factories import AppFactory, TaskFactory, TaskRunFactory
+
+
+class TestSiteStatsCache(Test):
+
+    def setUp(self):
+        super(TestSiteStatsCache, self).setUp()
+        self.yesterday = (datetime.datetime.utcnow() -
+                          datetime.timedelta(hours=25)).isoformat()
+
+    @with_context
+    def test_get_top5_apps_24_hours_counts_the_last_24_hours(self):
+        """Test CACHE SITE STATS get_top5_apps_24_hours ignores the answers
+        sent more than 24 hours ago"""
+        old, recent = AppFactory.create_batch(2)
+        TaskRunFactory.create(task=TaskFactory.create(app=old),
+                              finish_time=self.yesterday)
+        TaskRunFactory.create(task=TaskFactory.create(app=recent))
+
+        top5 = site_stats.get_top5_apps_24_hours()
+
+        assert [app['id'] for app in top5] == [recent.id], top5
+        assert top5[0]['n_answers'] == 1, top5
+
+    @with_context
+    def test_get_top5_users_24_hours_counts_the_last_24_hours(self):
+        """Test CACHE SITE STATS get_top5_users_24_hours ignores the answers
+        sent more than 24 hours ago"""
+        old = TaskRunFactory.create(finish_time=self.yesterday)
+        recent = TaskRunFactory.create()
+
+        top5 = site_stats.get_top5_users_24_hours()
+
+        assert [user['id'] for user in top5] == [recent.user_id], top5
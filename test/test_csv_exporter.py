@@ -0,0 +1,123 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import os
+import tempfile
+import zipfile
+from mock import patch
+from default import Test, with_context
+from factories import AppFactory, TaskFactory, TaskRunFactory
+from pybossa.exporter import Exporter, write_zips
+from pybossa.exporter.csv_export import CsvExporter
+from pybossa.exporter.json_export import JsonExporter
+
+
+class TestCsvExporter(Test):
+
+    def setUp(self):
+        super(TestCsvExporter, self).setUp()
+        self.exporter = CsvExporter()
+
+    def export(self, table, app_id):
+        out = tempfile.TemporaryFile()
+        self.exporter._write_csv(out, table, app_id)
+        out.seek(0)
+        return list(csv.DictReader(out))
+
+    @with_context
+    def test_header_has_the_info_keys_of_every_row(self):
+        """Test CSV exporter header has the union of the info keys, and the
+        values of every row are in their columns"""
+        project = AppFactory.create()
+        TaskFactory.create(app=project, info={u'a': 1})
+        TaskFactory.create(app=project, info={u'b': u'two'})
+        TaskFactory.create(app=project, info=[1, 2])
+        self.exporter.fetch_size = 2
+
+        rows = self.export('task', project.id)
+
+        assert len(rows) == 3, rows
+        assert rows[0]['taskinfo__a'] == '1', rows[0]
+        assert rows[0]['taskinfo__b'] == 'None', rows[0]
+        assert rows[1]['taskinfo__a'] == 'None', rows[1]
+        assert rows[1]['taskinfo__b'] == 'two', rows[1]
+        assert rows[2]['taskinfo__a'] == 'None', rows[2]
+
+    @with_context
+    def test_header_is_sorted(self):
+        """Test CSV exporter columns are sorted, with the table as prefix"""
+        project = AppFactory.create()
+        task_run = TaskRunFactory.create(task=TaskFactory.create(app=project),
+                                         info={u'answer': u'yes'})
+        out = tempfile.TemporaryFile()
+        self.exporter._write_csv(out, 'task_run', project.id)
+        out.seek(0)
+
+        header = next(csv.reader(out))
+
+        assert header == sorted(header), header
+        assert 'task_run__id' in header, header
+        assert 'task_runinfo__answer' in header, header
+        assert self.export('task_run', project.id)[0]['task_run__id'] == \
+            str(task_run.id)
+
+    @with_context
+    def test_write_zips_reads_the_rows_once(self):
+        """Test write_zips writes the JSON and CSV ZIPs from one scan of the
+        rows"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project)
+        json_exporter = JsonExporter()
+        upload_folder = tempfile.mkdtemp()
+
+        with patch('pybossa.core.uploader.upload_folder', upload_folder):
+            with patch.object(Exporter, '_rows', autospec=True,
+                              side_effect=Exporter._rows) as rows:
+                write_zips(project, 'task', [json_exporter, self.exporter])
+
+        assert rows.call_count == 1, rows.call_args_list
+        folder = os.path.join(upload_folder, 'user_%d' % project.owner_id)
+        json_zip = zipfile.ZipFile(os.path.join(
+            folder, json_exporter.download_name(project, 'task')))
+        csv_zip = zipfile.ZipFile(os.path.join(
+            folder, self.exporter.download_name(project, 'task')))
+        exported = json.loads(json_zip.read(json_zip.namelist()[0]))
+        assert [t['id'] for t in exported] == [t.id for t in tasks]
+        csv_rows = list(csv.DictReader(
+            csv_zip.open(csv_zip.namelist()[0])))
+        assert [r['task__id'] for r in csv_rows] == \
+            [str(t.id) for t in tasks]
+
+    @with_context
+    def test_write_zips_skips_the_csv_of_an_empty_table(self):
+        """Test write_zips does not generate the CSV ZIP of a project without
+        rows, but still generates the other formats"""
+        project = AppFactory.create()
+        json_exporter = JsonExporter()
+        upload_folder = tempfile.mkdtemp()
+
+        with patch('pybossa.core.uploader.upload_folder', upload_folder):
+            write_zips(project, 'task_run', [json_exporter, self.exporter])
+
+        folder = os.path.join(upload_folder, 'user_%d' % project.owner_id)
+        assert os.path.isfile(os.path.join(
+            folder, json_exporter.download_name(project, 'task_run')))
+        assert not os.path.exists(os.path.join(
+            folder, self.exporter.download_name(project, 'task_run')))
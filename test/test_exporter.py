@@ -0,0 +1,69 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import tempfile
+import zipfile
+from pybossa.exporter import ZipEntryWriter
+
+
+class TestZipEntryWriter(object):
+
+    def write_zip(self, entries):
+        """Write a ZIP with a ZipEntryWriter for every (arcname, chunks) of
+        entries, and return it open for reading with zipfile."""
+        out = tempfile.TemporaryFile()
+        zip = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED,
+                              allowZip64=True)
+        for arcname, chunks in entries:
+            entry = ZipEntryWriter(zip, arcname)
+            for chunk in chunks:
+                entry.write(chunk)
+            entry.close()
+        zip.close()
+        out.seek(0)
+        return zipfile.ZipFile(out)
+
+    def test_entries_are_read_back_by_zipfile(self):
+        """Test ZipEntryWriter members are read by zipfile, which checks
+        their CRC"""
+        zip = self.write_zip([('a.csv', [u'a,b\n', u'1,\xf1\n']),
+                              ('b.json', ['[]'])])
+
+        assert zip.namelist() == ['a.csv', 'b.json'], zip.namelist()
+        assert zip.read('a.csv') == u'a,b\n1,\xf1\n'.encode('utf-8')
+        assert zip.read('b.json') == '[]'
+        assert zip.testzip() is None
+
+    def test_zip64_sized_entry_is_read_back_by_zipfile(self):
+        """Test ZipEntryWriter writes a member bigger than 4 GiB with the
+        ZIP64 sizes zipfile expects"""
+        size = 2 ** 32 + 1
+        chunk = '\0' * 2 ** 24
+
+        def chunks():
+            left = size
+            while left:
+                yield chunk[:min(left, len(chunk))]
+                left -= min(left, len(chunk))
+
+        zip = self.write_zip([('big.csv', chunks()),
+                              ('small.csv', ['a,b\n'])])
+
+        assert zip.getinfo('big.csv').file_size == size
+        assert zip.open('big.csv').read(4) == '\0' * 4
+        assert zip.read('small.csv') == 'a,b\n'
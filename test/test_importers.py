@@ -23,15 +23,29 @@ from mock import patch, Mock
 from nose.tools import assert_raises
 from pybossa.importers import (_BulkTaskDropboxImport, _BulkTaskFlickrImport,
     _BulkTaskCSVImport, _BulkTaskGDImport, _BulkTaskEpiCollectPlusImport,
-    BulkImportException, Importer)
+    BulkImportException, Importer, ImportProgress)
 
 from default import Test
 from factories import AppFactory, TaskFactory
 from pybossa.repositories import TaskRepository
-from pybossa.core import db
+from pybossa.core import db, sentinel
 task_repo = TaskRepository(db)
 
 
+class FakeStreamedResponse(namedtuple('FakeStreamedResponse',
+                                      ['text', 'status_code', 'headers'])):
+    """Response of requests.get(url, stream=True) with the given text."""
+    encoding = 'utf-8'
+
+    def iter_content(self, chunk_size=1):
+        content = self.text.encode(self.encoding)
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
 
 @patch.object(Importer, '_create_importer_for')
 class TestImporterPublicMethods(Test):
@@ -87,6 +101,135 @@ class TestImporterPublicMethods(Test):
         importer_factory.assert_called_with('flickr')
 
 
+    def test_create_tasks_not_creates_duplicated_tasks_in_the_import(self, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = [{'info': {'question': 'question'}},
+                                            {'info': {'question': 'question'}}]
+        importer_factory.return_value = mock_importer
+        app = AppFactory.create()
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+
+        result = self.importer.create_tasks(task_repo, app.id, **form_data)
+        tasks = task_repo.filter_tasks_by(app_id=app.id)
+
+        assert len(tasks) == 1, len(tasks)
+        assert result == '1 new task was imported successfully', result
+
+
+    @patch.object(Importer, 'batch_size', 2)
+    def test_create_tasks_saves_them_in_batches(self, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = [{'info': {'question': i}}
+                                            for i in range(5)]
+        importer_factory.return_value = mock_importer
+        app = AppFactory.create()
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+
+        with patch.object(task_repo, 'save_tasks',
+                          wraps=task_repo.save_tasks) as save_tasks:
+            result = self.importer.create_tasks(task_repo, app.id, **form_data)
+        tasks = task_repo.filter_tasks_by(app_id=app.id)
+
+        assert [len(call[0][1]) for call in save_tasks.call_args_list] == \
+            [2, 2, 1], save_tasks.call_args_list
+        assert [t.info for t in tasks] == [{'question': i} for i in range(5)]
+        assert result == '5 new tasks were imported successfully', result
+
+
+    @patch.object(Importer, 'batch_size', 2)
+    def test_create_tasks_resumes_an_unfinished_import(self, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = [{'info': {'question': i}}
+                                            for i in range(5)]
+        importer_factory.return_value = mock_importer
+        app = AppFactory.create()
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+        progress = ImportProgress(sentinel.master, app.id)
+        # A previous run committed the first batch and died, and the user
+        # queued the import again
+        progress.start(form_data)
+        task_repo.save_tasks(app.id, [{'info': {'question': i}}
+                                      for i in range(2)])
+        progress.update(parsed=3, inserted=2, duplicates=0, committed=2)
+        progress.fail('Killed')
+        progress.queue(form_data)
+
+        with patch.object(task_repo, 'save_tasks',
+                          wraps=task_repo.save_tasks) as save_tasks:
+            result = self.importer.create_tasks(task_repo, app.id,
+                                                progress=progress, **form_data)
+        tasks = task_repo.filter_tasks_by(app_id=app.id)
+
+        assert [call[0][1] for call in save_tasks.call_args_list] == \
+            [[{'info': {'question': 2}}, {'info': {'question': 3}}],
+             [{'info': {'question': 4}}]], save_tasks.call_args_list
+        assert [t.info for t in tasks] == [{'question': i} for i in range(5)]
+        assert result == '5 new tasks were imported successfully', result
+        counters = progress.get()
+        assert (counters['parsed'], counters['inserted'],
+                counters['duplicates'], counters['committed']) == (5, 5, 0, 5)
+
+
+    @patch.object(Importer, 'batch_size', 3)
+    def test_create_tasks_checkpoints_the_rows_of_the_saved_batches(self, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = [
+            {'info': {'question': 0}}, {'info': {'question': 1}},
+            {'info': {'question': 'dup'}}, {'info': {'question': 2}},
+            {'info': {'question': 'dup'}}, {'info': {'question': 3}}]
+        importer_factory.return_value = mock_importer
+        app = AppFactory.create()
+        TaskFactory.create(app=app, info={'question': 'dup'})
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+        progress = ImportProgress(sentinel.master, app.id)
+
+        with patch.object(progress, 'update',
+                          wraps=progress.update) as update:
+            self.importer.create_tasks(task_repo, app.id, progress=progress,
+                                       **form_data)
+
+        # Nothing is committed until the first batch is full, at the 4th row
+        assert [call[1]['committed'] for call in update.call_args_list] == \
+            [0, 4, 6], update.call_args_list
+        counters = progress.get()
+        assert (counters['parsed'], counters['inserted'],
+                counters['duplicates'], counters['committed']) == (6, 4, 2, 6)
+
+
+    def test_import_progress_resumes_only_an_import_queued_again(self, importer_factory):
+        progress = ImportProgress(sentinel.master, 1)
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+        progress.start(form_data)
+        progress.update(parsed=4, inserted=1, duplicates=1, committed=2)
+        progress.fail('Killed')
+
+        # e.g. the autoimporter, which runs without queueing
+        assert progress.start(form_data) == 0
+        assert progress.get()['committed'] == 0, progress.get()
+
+        progress.update(parsed=4, inserted=1, duplicates=1, committed=2)
+        progress.fail('Killed')
+        progress.queue(form_data)
+
+        assert progress.start(form_data) == 2
+        assert progress.get()['duplicates'] == 1, progress.get()
+
+
+    def test_import_progress_starts_again_a_different_or_finished_import(self, importer_factory):
+        progress = ImportProgress(sentinel.master, 1)
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+        progress.start(form_data)
+        progress.update(parsed=4, inserted=1, duplicates=1, committed=2)
+
+        assert progress.start(dict(form_data, csv_url='http://other.com')) == 0
+        progress.update(parsed=4, inserted=1, duplicates=1, committed=2)
+        progress.finish('1 new task was imported successfully')
+
+        assert progress.start(dict(form_data, csv_url='http://other.com')) == 0
+        assert progress.get()['state'] == 'running', progress.get()
+        assert progress.get()['inserted'] == 0, progress.get()
+
+
     def test_count_tasks_to_import_returns_what_expected(self, importer_factory):
         mock_importer = Mock()
         mock_importer.count_tasks.return_value = 2
@@ -345,7 +488,11 @@ class Test_BulkTaskFlickrImport(object):
     photo = {u'isfamily': 0, u'title': u'Inflating the balloon', u'farm': 6,
              u'ispublic': 1, u'server': u'5441', u'isfriend': 0,
              u'secret': u'00e2301a0d', u'isprimary': u'0', u'id': u'8947115130'}
-    importer = _BulkTaskFlickrImport(api_key='fake-key')
+
+    def setUp(self):
+        sentinel.master.flushall()
+        self.importer = _BulkTaskFlickrImport(api_key='fake-key',
+                                              redis_conn=sentinel.master)
 
 
     def make_response(self, text, status_code=200):
@@ -356,28 +503,28 @@ class Test_BulkTaskFlickrImport(object):
 
 
     def test_call_to_flickr_api_endpoint(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.response))
-        self.importer._get_album_info('72157633923521788')
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.response))
+        self.importer.count_tasks(album_id='72157633923521788')
         url = 'https://api.flickr.com/services/rest/'
         payload = {'method': 'flickr.photosets.getPhotos',
                    'api_key': 'fake-key',
                    'photoset_id': '72157633923521788',
                    'format': 'json',
                    'nojsoncallback': '1'}
-        requests.get.assert_called_with(url, params=payload)
+        requests.Session.return_value.get.assert_called_with(url, params=payload)
 
 
     def test_call_to_flickr_api_uses_no_credentials(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.response))
-        self.importer._get_album_info('72157633923521788')
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.response))
+        self.importer.count_tasks(album_id='72157633923521788')
 
         # The request MUST NOT include user credentials, to avoid private photos
-        url_call_params = requests.get.call_args_list[0][1]['params'].keys()
+        url_call_params = requests.Session.return_value.get.call_args_list[0][1]['params'].keys()
         assert 'auth_token' not in url_call_params
 
 
     def test_count_tasks_returns_number_of_photos_in_album(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.response))
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.response))
 
         number_of_tasks = self.importer.count_tasks(album_id='72157633923521788')
 
@@ -385,34 +532,34 @@ class Test_BulkTaskFlickrImport(object):
 
 
     def test_count_tasks_raises_exception_if_invalid_album(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.invalid_response))
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.invalid_response))
 
         assert_raises(BulkImportException, self.importer.count_tasks, album_id='bad')
 
 
     def test_count_tasks_raises_exception_on_non_200_flickr_response(self, requests):
-        requests.get.return_value = self.make_response('Not Found', 404)
+        requests.Session.return_value.get.return_value = self.make_response('Not Found', 404)
 
         assert_raises(BulkImportException, self.importer.count_tasks,
                       album_id='72157633923521788')
 
 
     def test_tasks_returns_list_of_all_photos(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.response))
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.response))
 
-        photos = self.importer.tasks(album_id='72157633923521788')
+        photos = list(self.importer.tasks(album_id='72157633923521788'))
 
         assert len(photos) == 3, len(photos)
 
 
     def test_tasks_returns_tasks_with_title_and_url_info_fields(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.response))
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.response))
         url = 'https://farm6.staticflickr.com/5441/8947115130_00e2301a0d.jpg'
         url_m = 'https://farm6.staticflickr.com/5441/8947115130_00e2301a0d_m.jpg'
         url_b = 'https://farm6.staticflickr.com/5441/8947115130_00e2301a0d_b.jpg'
         link = 'https://www.flickr.com/photos/32985084@N00/8947115130'
         title = self.response['photoset']['photo'][0]['title']
-        photo = self.importer.tasks(album_id='72157633923521788')[0]
+        photo = self.importer.tasks(album_id='72157633923521788').next()
 
         assert photo['info'].get('title') == title
         assert photo['info'].get('url') == url, photo['info'].get('url')
@@ -422,13 +569,13 @@ class Test_BulkTaskFlickrImport(object):
 
 
     def test_tasks_raises_exception_if_invalid_album(self, requests):
-        requests.get.return_value = self.make_response(json.dumps(self.invalid_response))
+        requests.Session.return_value.get.return_value = self.make_response(json.dumps(self.invalid_response))
 
         assert_raises(BulkImportException, self.importer.tasks, album_id='bad')
 
 
     def test_tasks_raises_exception_on_non_200_flickr_response(self, requests):
-        requests.get.return_value = self.make_response('Not Found', 404)
+        requests.Session.return_value.get.return_value = self.make_response('Not Found', 404)
 
         assert_raises(BulkImportException, self.importer.tasks,
                       album_id='72157633923521788')
@@ -450,9 +597,9 @@ class Test_BulkTaskFlickrImport(object):
         fake_first_response = self.make_response(json.dumps(first_response))
         fake_second_response = self.make_response(json.dumps(second_response))
         responses = [fake_first_response, fake_second_response]
-        requests.get.side_effect = lambda *args, **kwargs: responses.pop(0)
+        requests.Session.return_value.get.side_effect = lambda *args, **kwargs: responses.pop(0)
 
-        photos = self.importer.tasks(album_id='72157633923521788')
+        photos = list(self.importer.tasks(album_id='72157633923521788'))
 
         assert len(photos) == 600, len(photos)
 
@@ -479,18 +626,87 @@ class Test_BulkTaskFlickrImport(object):
         fake_second_response = self.make_response(json.dumps(second_response))
         fake_third_response = self.make_response(json.dumps(third_response))
         responses = [fake_first_response, fake_second_response, fake_third_response]
-        requests.get.side_effect = lambda *args, **kwargs: responses.pop(0)
+        requests.Session.return_value.get.side_effect = lambda *args, **kwargs: responses.pop(0)
 
-        photos = self.importer.tasks(album_id='72157633923521788')
+        photos = list(self.importer.tasks(album_id='72157633923521788'))
 
         assert len(photos) == 1100, len(photos)
 
 
+    def make_album(self, pages):
+        responses = {}
+        for page in range(1, pages + 1):
+            response = copy.deepcopy(self.response)
+            response['photoset']['pages'] = pages
+            response['photoset']['total'] = unicode(pages * 10)
+            response['photoset']['page'] = page
+            photo = dict(self.photo, id=unicode(page))
+            response['photoset']['photo'] = [photo for i in range(10)]
+            responses[page] = self.make_response(json.dumps(response))
+        return lambda url, params: responses[params.get('page', 1)]
+
+
+    def test_count_tasks_requests_only_the_first_page(self, requests):
+        requests.Session.return_value.get.side_effect = self.make_album(5)
+
+        number_of_tasks = self.importer.count_tasks(album_id='72157633923521788')
+
+        assert number_of_tasks == 50, number_of_tasks
+        assert requests.Session.return_value.get.call_count == 1
+
+
+    def test_tasks_reuses_the_first_page_from_count_tasks(self, requests):
+        get = requests.Session.return_value.get
+        get.side_effect = self.make_album(3)
+        self.importer.count_tasks(album_id='72157633923521788')
+        get.reset_mock()
+
+        photos = list(self.importer.tasks(album_id='72157633923521788'))
+
+        assert len(photos) == 30, len(photos)
+        pages = sorted(call[1]['params'].get('page') for call in get.call_args_list)
+        assert pages == [2, 3], pages
+
+
+    def test_tasks_reuses_the_first_page_counted_by_another_process(self, requests):
+        get = requests.Session.return_value.get
+        get.side_effect = self.make_album(3)
+        self.importer.count_tasks(album_id='72157633923521788')
+        get.reset_mock()
+        worker_importer = _BulkTaskFlickrImport(api_key='fake-key',
+                                                redis_conn=sentinel.master)
+
+        photos = list(worker_importer.tasks(album_id='72157633923521788'))
+
+        assert len(photos) == 30, len(photos)
+        pages = sorted(call[1]['params'].get('page') for call in get.call_args_list)
+        assert pages == [2, 3], pages
+
+
+    def test_count_tasks_stores_the_first_page_with_a_timeout(self, requests):
+        requests.Session.return_value.get.side_effect = self.make_album(3)
+
+        self.importer.count_tasks(album_id='1')
+
+        ttl = sentinel.master.ttl(self.importer._first_page_key('1'))
+        assert 0 < ttl <= _BulkTaskFlickrImport.album_cache_timeout, ttl
+
+
+    def test_tasks_yields_the_photos_in_page_order(self, requests):
+        requests.Session.return_value.get.side_effect = self.make_album(8)
+
+        photos = list(self.importer.tasks(album_id='72157633923521788'))
+
+        pages = [photo['info']['link'].rsplit('/', 1)[1] for photo in photos]
+        expected = [unicode(page) for page in range(1, 9) for i in range(10)]
+        assert pages == expected, pages
+
+
 
 @patch('pybossa.importers.requests.get')
 class Test_BulkTaskCSVImport(object):
 
-    FakeRequest = namedtuple('FakeRequest', ['text', 'status_code', 'headers'])
+    FakeRequest = FakeStreamedResponse
     url = 'http://myfakecsvurl.com'
     importer = _BulkTaskCSVImport()
 
@@ -620,10 +836,35 @@ class Test_BulkTaskCSVImport(object):
 
 
 
+    def test_tasks_streams_the_file(self, request):
+        csv_file = self.FakeRequest(u'Foo,Bar\r\n"multi\nline",\u00bfs\u00ed?\r\n'
+                                    u'1,2', 200, {'content-type': 'text/csv'})
+        request.return_value = csv_file
+        importer = _BulkTaskCSVImport()
+        importer.chunk_size = 3
+
+        tasks = list(importer.tasks(csv_url=self.url))
+
+        request.assert_called_with(self.url, stream=True)
+        assert tasks == [{'info': {u'Foo': u'multi\nline', u'Bar': u'\u00bfs\u00ed?'}},
+                         {'info': {u'Foo': u'1', u'Bar': u'2'}}], tasks
+
+
+    def test_count_tasks_stops_at_limit(self, request):
+        csv_file = self.FakeRequest('Foo\n1\n2\n3\n', 200,
+                                    {'content-type': 'text/plain'})
+        request.return_value = csv_file
+
+        number_of_tasks = self.importer.count_tasks(csv_url=self.url, limit=2)
+
+        assert number_of_tasks == 2, number_of_tasks
+
+
+
 @patch('pybossa.importers.requests.get')
 class Test_BulkTaskGDImport(object):
 
-    FakeRequest = namedtuple('FakeRequest', ['text', 'status_code', 'headers'])
+    FakeRequest = FakeStreamedResponse
     url = 'http://drive.google.com'
     importer = _BulkTaskGDImport()
 
@@ -0,0 +1,93 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from default import Test, db, with_context
+from factories import AppFactory, TaskFactory, TaskRunFactory
+
+
+class TestIndexes(Test):
+
+    """EXPLAIN the hot scheduler and progress queries and check they are
+    served by the indexes declared in the models (sequential scans are
+    disabled, as on test sized tables they are always cheaper)."""
+
+    def setUp(self):
+        super(TestIndexes, self).setUp()
+        with self.flask_app.app_context():
+            project = AppFactory.create()
+            task = TaskFactory.create(app=project)
+            TaskRunFactory.create(task=task)
+            self.params = dict(app_id=project.id, task_id=task.id,
+                               user_id=1, user_ip='127.0.0.1')
+
+    def plan(self, sql):
+        db.session.execute('SET enable_seqscan = off')
+        results = db.session.execute('EXPLAIN ' + sql, self.params)
+        plan = '\n'.join(row[0] for row in results)
+        db.session.rollback()
+        return plan
+
+    @with_context
+    def test_candidate_tasks_for_a_user(self):
+        """Test the depth first candidates of a user use the indexes"""
+        plan = self.plan('''SELECT * FROM task WHERE NOT EXISTS
+                         (SELECT task_id FROM task_run WHERE
+                         app_id=:app_id AND user_id=:user_id
+                         AND task_id=task.id)
+                         AND app_id=:app_id AND state !='completed'
+                         ORDER BY priority_0 DESC, id ASC LIMIT 10''')
+
+        assert 'task_ongoing_app_id_priority_idx' in plan, plan
+        assert 'task_run_app_id_user_id_task_id_idx' in plan, plan
+
+    @with_context
+    def test_candidate_tasks_for_an_anonymous_user(self):
+        """Test the depth first candidates of an IP use the indexes"""
+        plan = self.plan('''SELECT * FROM task WHERE NOT EXISTS
+                         (SELECT task_id FROM task_run WHERE
+                         app_id=:app_id AND user_ip=:user_ip
+                         AND task_id=task.id)
+                         AND app_id=:app_id AND state !='completed'
+                         ORDER BY priority_0 DESC, id ASC LIMIT 10''')
+
+        assert 'task_ongoing_app_id_priority_idx' in plan, plan
+        assert 'task_run_app_id_user_ip_task_id_idx' in plan, plan
+
+    @with_context
+    def test_answers_of_a_task(self):
+        """Test counting the answers of a task uses an index"""
+        plan = self.plan('''SELECT COUNT(id) FROM task_run
+                         WHERE task_run.task_id=:task_id''')
+
+        assert 'task_run_task_id_idx' in plan, plan
+
+    @with_context
+    def test_completed_tasks_of_a_project(self):
+        """Test counting the completed tasks of a project uses an index"""
+        plan = self.plan('''SELECT COUNT(id) FROM task
+                         WHERE app_id=:app_id AND state='completed' ''')
+
+        assert 'task_app_id_state_priority_idx' in plan, plan
+
+    @with_context
+    def test_task_runs_of_a_user(self):
+        """Test counting the task runs of a user in a project uses an index"""
+        plan = self.plan('''SELECT COUNT(id) FROM task_run
+                         WHERE app_id=:app_id AND user_id=:user_id''')
+
+        assert 'task_run_app_id_user_id_task_id_idx' in plan, plan
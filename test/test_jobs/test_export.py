@@ -15,11 +15,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
-from default import Test, with_context
-from factories import AppFactory, UserFactory
+from default import Test, with_context, db
+from factories import AppFactory, UserFactory, TaskFactory
 from pybossa.jobs import get_export_task_jobs, project_export
+from pybossa.exporter import export_watermark, mark_exported
+from pybossa.repositories import TaskRepository
 from mock import patch
 
+task_repo = TaskRepository(db)
+
+
 class TestExport(Test):
 
     @with_context
@@ -31,8 +36,10 @@ class TestExport(Test):
         for job in jobs_generator:
             jobs.append(job)
 
-        msg = "There should be only one job."
-        assert len(jobs) == 1, len(jobs)
+        msg = "There should be one job for tasks and one for task runs."
+        assert len(jobs) == 2, len(jobs)
+        assert [job['kwargs'] for job in jobs] == [dict(ty='task'),
+                                                   dict(ty='task_run')]
         job = jobs[0]
         msg = "The job should be for the same app.id"
         assert job['args'] == [app.id], msg
@@ -49,8 +56,8 @@ class TestExport(Test):
         for job in jobs_generator:
             jobs.append(job)
 
-        msg = "There should be only one job."
-        assert len(jobs) == 1, len(jobs)
+        msg = "There should be one job for tasks and one for task runs."
+        assert len(jobs) == 2, len(jobs)
         job = jobs[0]
         msg = "The job should be for the same app.id"
         assert job['args'] == [app.id], msg
@@ -58,20 +65,60 @@ class TestExport(Test):
         assert job['queue'] == 'high', msg
 
     @with_context
-    @patch('pybossa.core.json_exporter')
-    @patch('pybossa.core.csv_exporter')
-    def test_project_export(self, csv_exporter, json_exporter):
+    def test_get_export_task_jobs_skips_unchanged_exports(self):
+        """Test JOB export task jobs skips the exports that did not change
+        since they were generated."""
+        app = AppFactory.create()
+        TaskFactory.create(app=app)
+        mark_exported(app.id, 'task', export_watermark(app.id, 'task'))
+
+        jobs = list(get_export_task_jobs(queue='low'))
+
+        assert [job['kwargs'] for job in jobs] == [dict(ty='task_run')], jobs
+
+        TaskFactory.create(app=app)
+        jobs = list(get_export_task_jobs(queue='low'))
+
+        assert len(jobs) == 2, jobs
+
+    @with_context
+    def test_get_export_task_jobs_after_a_task_is_edited(self):
+        """Test JOB export task jobs regenerates the export of the tasks when
+        a task is edited, which does not change its watermark."""
+        app = AppFactory.create()
+        task = TaskFactory.create(app=app)
+        mark_exported(app.id, 'task', export_watermark(app.id, 'task'))
+
+        task.info = {u'question': u'edited'}
+        task_repo.update(task)
+        jobs = list(get_export_task_jobs(queue='low'))
+
+        assert [job['kwargs'] for job in jobs] == [dict(ty='task'),
+                                                   dict(ty='task_run')], jobs
+
+    @with_context
+    @patch('pybossa.exporter.write_zips')
+    def test_project_export(self, write_zips):
         """Test JOB project_export works."""
+        from pybossa.core import json_exporter, csv_exporter, ndjson_exporter
+        app = AppFactory.create()
+        project_export(app.id, ty='task')
+        write_zips.assert_called_once_with(
+            app, 'task', [json_exporter, csv_exporter, ndjson_exporter])
+
+    @with_context
+    @patch('pybossa.exporter.write_zips')
+    def test_project_export_all(self, write_zips):
+        """Test JOB project_export without a type exports tasks and task
+        runs."""
         app = AppFactory.create()
         project_export(app.id)
-        csv_exporter.pregenerate_zip_files.assert_called_once_with(app)
-        json_exporter.pregenerate_zip_files.assert_called_once_with(app)
+        assert [call[0][1] for call in write_zips.call_args_list] == \
+            ['task', 'task_run']
 
     @with_context
-    @patch('pybossa.core.json_exporter')
-    @patch('pybossa.core.csv_exporter')
-    def test_project_export_none(self, csv_exporter, json_exporter):
+    @patch('pybossa.exporter.write_zips')
+    def test_project_export_none(self, write_zips):
         """Test JOB project_export without project works."""
         project_export(0)
-        assert not csv_exporter.pregenerate_zip_files.called
-        assert not json_exporter.pregenerate_zip_files.called
+        assert not write_zips.called
@@ -20,7 +20,10 @@ from default import Test, db, with_context
 from pybossa.jobs import import_tasks, task_repo, get_autoimport_jobs
 from pybossa.model.task import Task
 from factories import AppFactory, TaskFactory, UserFactory
-from mock import patch
+from mock import patch, ANY
+from nose.tools import assert_raises
+from pybossa.core import sentinel
+from pybossa.importers import ImportProgress, BulkImportException
 
 class TestImportTasksJob(Test):
 
@@ -32,7 +35,40 @@ class TestImportTasksJob(Test):
 
         import_tasks(app.id, **form_data)
 
-        create.assert_called_once_with(task_repo, app.id, **form_data)
+        create.assert_called_once_with(task_repo, app.id, progress=ANY,
+                                       **form_data)
+
+
+    @with_context
+    @patch('pybossa.jobs.send_mail')
+    @patch('pybossa.importers.Importer._create_importer_for')
+    def test_it_reports_the_progress(self, create_importer, send_mail):
+        create_importer.return_value.tasks.return_value = [
+            {'info': {'question': 1}}, {'info': {'question': 1}},
+            {'info': {'question': 2}}]
+        app = AppFactory.create()
+        form_data = {'type': 'csv', 'csv_url': 'http://google.es'}
+
+        import_tasks(app.id, **form_data)
+        progress = ImportProgress(sentinel.master, app.id).get()
+
+        assert progress == dict(state='finished', parsed=3, inserted=2,
+                                duplicates=1, committed=3,
+                                message='2 new tasks were imported successfully'), progress
+
+
+    @with_context
+    @patch('pybossa.jobs.importer.create_tasks')
+    def test_it_reports_the_failure(self, create):
+        create.side_effect = BulkImportException('Wrong file', 'error')
+        app = AppFactory.create()
+        form_data = {'type': 'csv', 'csv_url': 'http://google.es'}
+
+        assert_raises(BulkImportException, import_tasks, app.id, **form_data)
+        progress = ImportProgress(sentinel.master, app.id).get()
+
+        assert progress['state'] == 'failed', progress
+        assert progress['message'] == 'Wrong file', progress
 
 
     @with_context
@@ -0,0 +1,78 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import tempfile
+import zipfile
+from mock import patch
+from default import Test, with_context
+from factories import AppFactory, TaskFactory, TaskRunFactory
+from pybossa.exporter.json_export import JsonExporter
+
+
+class TestJsonExporter(Test):
+
+    def setUp(self):
+        super(TestJsonExporter, self).setUp()
+        self.exporter = JsonExporter()
+
+    def export(self, table, app_id):
+        return json.loads(''.join(self.exporter.gen_json(table, app_id)))
+
+    @with_context
+    def test_gen_json_no_rows(self):
+        """Test JSON exporter gen_json returns an empty list for a project
+        without tasks"""
+        project = AppFactory.create()
+
+        assert self.export('task', project.id) == []
+
+    @with_context
+    def test_gen_json_returns_the_dictized_rows(self):
+        """Test JSON exporter gen_json returns the same as dictizing every
+        object, for rows in several fetches"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project,
+                                         info={u'question': u'¿Qué?'})
+        task_runs = [TaskRunFactory.create(task=task) for task in tasks]
+        self.exporter.fetch_size = 2
+
+        exported_tasks = self.export('task', project.id)
+        exported_task_runs = self.export('task_run', project.id)
+
+        assert exported_tasks == [t.dictize() for t in tasks], exported_tasks
+        assert exported_task_runs == [tr.dictize() for tr in task_runs]
+
+    @with_context
+    def test_make_zip_writes_the_json_in_the_uploader(self):
+        """Test JSON exporter _make_zip writes a ZIP with the JSON of the
+        tasks into the container of the owner"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project)
+        upload_folder = tempfile.mkdtemp()
+
+        with patch('pybossa.core.uploader.upload_folder', upload_folder):
+            self.exporter._make_zip(project, 'task')
+
+        path = os.path.join(upload_folder, 'user_%d' % project.owner_id,
+                            self.exporter.download_name(project, 'task'))
+        zip = zipfile.ZipFile(path)
+        assert zip.testzip() is None
+        [name] = zip.namelist()
+        assert json.loads(zip.read(name)) == [t.dictize() for t in tasks]
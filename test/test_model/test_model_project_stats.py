@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2013 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from default import Test, db, with_context
+from factories import AppFactory, TaskFactory, TaskRunFactory, \
+    AnonymousTaskRunFactory, UserFactory
+from pybossa.repositories import ProjectRepository, TaskRepository
+from pybossa.model.project_stats import ProjectStats, SITE, \
+    rebuild_project_stats
+from pybossa.jobs import reconcile_project_stats
+from pybossa.cache import site_stats
+
+project_repo = ProjectRepository(db)
+task_repo = TaskRepository(db)
+
+
+class TestModelProjectStats(Test):
+
+    def stats(self, app_id):
+        db.session.expire_all()
+        return db.session.query(ProjectStats).get(app_id)
+
+    @with_context
+    def test_tasks_are_counted(self):
+        """Test PROJECT_STATS counts inserted and deleted tasks"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project, n_answers=2)
+
+        assert self.stats(project.id).n_tasks == 3
+        assert self.stats(project.id).n_answers == 6
+        assert site_stats.n_tasks_site() == 3
+
+        task_repo.delete(tasks[0])
+
+        assert self.stats(project.id).n_tasks == 2
+        assert site_stats.n_total_tasks_site() == 4
+
+    @with_context
+    def test_task_runs_and_volunteers_are_counted(self):
+        """Test PROJECT_STATS counts task runs and distinct volunteers"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project, n_answers=10)
+        user = UserFactory.create()
+        TaskRunFactory.create_batch(2, task=task, user=user)
+        AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.1')
+        last = AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.2')
+
+        stats = self.stats(project.id)
+        assert stats.n_task_runs == 4, stats
+        assert stats.n_registered_volunteers == 1, stats
+        assert stats.n_anonymous_volunteers == 2, stats
+        assert stats.last_activity == last.finish_time, stats
+
+        task_repo.delete(last)
+
+        assert self.stats(project.id).n_anonymous_volunteers == 1
+        assert site_stats.n_task_runs_site() == 3
+
+    @with_context
+    def test_completed_tasks_are_counted(self):
+        """Test PROJECT_STATS counts a task as completed once it gets all its
+        answers"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project, n_answers=1)
+
+        TaskRunFactory.create(task=task)
+        TaskRunFactory.create(task=task)
+
+        assert self.stats(project.id).n_completed_tasks == 1
+
+    @with_context
+    def test_redundancy_update_refreshes_the_counters(self):
+        """Test PROJECT_STATS is refreshed when the redundancy of all the
+        tasks of a project is updated"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(2, app=project, n_answers=2)
+        TaskRunFactory.create(task=tasks[0])
+
+        task_repo.update_tasks_redundancy(project, 1)
+
+        assert self.stats(project.id).n_completed_tasks == 1
+        assert self.stats(project.id).n_answers == 2
+        assert site_stats.n_total_tasks_site() == 2
+
+    @with_context
+    def test_deleted_project_row_is_removed(self):
+        """Test PROJECT_STATS removes the row of a deleted project"""
+        project = AppFactory.create()
+        TaskRunFactory.create(task=TaskFactory.create(app=project))
+
+        project_repo.delete(project)
+
+        assert self.stats(project.id) is None
+        assert site_stats.n_tasks_site() == 0
+        assert site_stats.n_task_runs_site() == 0
+
+    @with_context
+    def test_reconcile_fixes_drift(self):
+        """Test reconcile_project_stats rebuilds the counters from scratch"""
+        project = AppFactory.create()
+        TaskFactory.create_batch(2, app=project)
+        db.session.execute('UPDATE project_stats SET n_tasks=42')
+        db.session.commit()
+
+        reconcile_project_stats()
+
+        assert self.stats(project.id).n_tasks == 2
+        assert self.stats(SITE).n_tasks == 2
+
+    @with_context
+    def test_rebuild_creates_a_missing_row(self):
+        """Test rebuild_project_stats creates the row of a project if it does
+        not exist, and only updates it afterwards"""
+        project = AppFactory.create()
+        TaskFactory.create_batch(2, app=project)
+        db.session.execute('DELETE FROM project_stats')
+        db.session.commit()
+
+        rebuild_project_stats(db.session.connection(), project.id)
+        rebuild_project_stats(db.session.connection(), project.id)
+        db.session.commit()
+
+        assert self.stats(project.id).n_tasks == 2
+        assert db.session.query(ProjectStats).count() == 1
+
+    @with_context
+    def test_site_row_is_only_computed_by_reconcile(self):
+        """Test PROJECT_STATS does not update the SITE row when tasks and task
+        runs are inserted, as reconcile_project_stats computes it"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project)
+        AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.1')
+
+        assert self.stats(SITE) is None
+        assert site_stats.n_anon_users() == 1
+
+        AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.2')
+        reconcile_project_stats()
+
+        assert self.stats(SITE).n_anonymous_volunteers == 2
+        assert site_stats.n_anon_users() == 2
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import json
+import os
+import tempfile
+from mock import patch
+from default import Test, with_context
+from factories import AppFactory, TaskFactory, TaskRunFactory
+from pybossa.exporter.ndjson_export import NdjsonExporter
+
+
+class TestNdjsonExporter(Test):
+
+    def setUp(self):
+        super(TestNdjsonExporter, self).setUp()
+        self.exporter = NdjsonExporter()
+
+    @with_context
+    def test_one_line_per_row(self):
+        """Test NDJSON exporter writes every row dictized in its own line"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project)
+        task_runs = [TaskRunFactory.create(task=task,
+                                           info={u'answer': u'¿Sí?'})
+                     for task in tasks]
+        self.exporter.fetch_size = 2
+
+        lines = ''.join(self.exporter._generate('task_run', project.id))
+
+        assert lines.endswith('\n'), lines
+        assert [json.loads(line) for line in lines.splitlines()] == \
+            [tr.dictize() for tr in task_runs]
+
+    @with_context
+    def test_no_rows(self):
+        """Test NDJSON exporter writes nothing for a project without tasks"""
+        project = AppFactory.create()
+
+        assert ''.join(self.exporter._generate('task', project.id)) == ''
+
+    @with_context
+    def test_make_zip_writes_a_gzip_file(self):
+        """Test NDJSON exporter _make_zip uploads the lines gzipped"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(2, app=project)
+        upload_folder = tempfile.mkdtemp()
+
+        with patch('pybossa.core.uploader.upload_folder', upload_folder):
+            self.exporter._make_zip(project, 'task')
+
+        name = self.exporter.download_name(project, 'task')
+        assert name.endswith('_task_ndjson.gz'), name
+        path = os.path.join(upload_folder, 'user_%d' % project.owner_id, name)
+        lines = gzip.open(path).read().splitlines()
+        assert [json.loads(line)['id'] for line in lines] == \
+            [t.id for t in tasks]
@@ -17,11 +17,16 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 # Cache global variables for timeouts
 
+import hashlib
+import json
 from default import Test, db
+from mock import patch
 from nose.tools import assert_raises
-from factories import TaskFactory, TaskRunFactory, AppFactory
+from sqlalchemy.exc import OperationalError
+from factories import TaskFactory, TaskRunFactory, AppFactory, UserFactory
 from pybossa.repositories import TaskRepository
 from pybossa.exc import WrongObjectError, DBIntegrityError
+from pybossa.model.project_stats import ProjectStats
 
 
 class TestTaskRepositoryForTaskQueries(Test):
@@ -496,6 +501,138 @@ class TestTaskRepositorySaveDeleteUpdate(Test):
         assert_raises(WrongObjectError, self.task_repo.delete_all, bad_objects)
 
 
+    def test_get_task_info_hashes(self):
+        """Test get_task_info_hashes returns the md5 of the stored info of the
+        tasks of a project"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project, info={'question': 'what?'})
+        TaskFactory.create(info={'question': 'other project'})
+
+        hashes = self.task_repo.get_task_info_hashes(project.id)
+
+        assert hashes == set([hashlib.md5(json.dumps(task.info)).hexdigest()])
+
+
+    def test_save_tasks_saves_many_tasks(self):
+        """Test save_tasks inserts all the tasks with the defaults of the
+        missing attributes"""
+        project = AppFactory.create()
+
+        self.task_repo.save_tasks(project.id, [
+            {'info': {'question': 1}, 'n_answers': 2},
+            {'info': {'question': 2}, 'state': 'completed'}])
+        tasks = self.task_repo.filter_tasks_by(app_id=project.id)
+
+        assert [t.info for t in tasks] == [{'question': 1}, {'question': 2}]
+        assert [t.n_answers for t in tasks] == [2, 30], tasks
+        assert [t.state for t in tasks] == ['ongoing', 'completed'], tasks
+        assert tasks[0].created is not None
+
+
+    def test_save_tasks_updates_the_project_stats(self):
+        """Test save_tasks counts the tasks in project_stats"""
+        project = AppFactory.create()
+        TaskFactory.create(app=project, n_answers=1)
+
+        self.task_repo.save_tasks(project.id, [
+            {'info': {'question': 1}, 'n_answers': '2'},
+            {'info': {'question': 2}, 'state': 'completed'}])
+
+        stats = db.session.query(ProjectStats).get(project.id)
+        assert stats.n_tasks == 3, stats.n_tasks
+        assert stats.n_completed_tasks == 1, stats.n_completed_tasks
+        assert stats.n_answers == 33, stats.n_answers
+
+
+    def test_save_tasks_rolls_back_on_any_database_error(self):
+        """Test save_tasks rolls back the transaction on database errors other
+        than integrity ones (e.g. a deadlock), and raises them"""
+        project = AppFactory.create()
+        error = OperationalError('UPDATE project_stats', {},
+                                 Exception('deadlock detected'))
+
+        with patch('pybossa.repositories.task_repository.update_project_stats',
+                   side_effect=error):
+            assert_raises(OperationalError, self.task_repo.save_tasks,
+                          project.id, [{'info': {'question': 1}}])
+
+        assert self.task_repo.count_tasks_with(app_id=project.id) == 0
+
+
+    def test_get_answered_task_ids(self):
+        """Test get_answered_task_ids returns the tasks that already have a
+        task run of the user"""
+        user = UserFactory.create()
+        answered, other, unanswered = TaskFactory.create_batch(3)
+        TaskRunFactory.create(task=answered, user=user)
+        TaskRunFactory.create(task=other)
+
+        task_ids = self.task_repo.get_answered_task_ids(
+            [answered.id, other.id, unanswered.id], user_id=user.id)
+
+        assert task_ids == set([answered.id]), task_ids
+
+
+    def test_save_task_runs_saves_many_task_runs(self):
+        """Test save_task_runs inserts all the task runs and completes the
+        tasks that got all their answers"""
+        project = AppFactory.create()
+        user = UserFactory.create()
+        completed = TaskFactory.create(app=project, n_answers=1)
+        ongoing = TaskFactory.create(app=project, n_answers=2)
+
+        ids = self.task_repo.save_task_runs([
+            {'app_id': project.id, 'task_id': completed.id,
+             'user_id': user.id, 'info': {'answer': 1}},
+            {'app_id': project.id, 'task_id': ongoing.id,
+             'user_id': user.id, 'info': {'answer': 2}}])
+        task_runs = [self.task_repo.get_task_run(_id) for _id in ids]
+
+        assert [tr.task_id for tr in task_runs] == [completed.id, ongoing.id]
+        assert [tr.info for tr in task_runs] == [{'answer': 1}, {'answer': 2}]
+        assert task_runs[0].finish_time is not None
+        assert self.task_repo.get_task(completed.id).state == 'completed'
+        assert self.task_repo.get_task(ongoing.id).state == 'ongoing'
+
+
+    def test_save_task_runs_updates_the_project_stats(self):
+        """Test save_task_runs counts the task runs, the new volunteer and the
+        completed tasks in project_stats"""
+        project = AppFactory.create()
+        other_user, user = UserFactory.create_batch(2)
+        tasks = TaskFactory.create_batch(3, app=project, n_answers=1)
+        self.task_repo.save_task_runs([
+            {'app_id': project.id, 'task_id': tasks[0].id,
+             'user_id': other_user.id}])
+
+        self.task_repo.save_task_runs([
+            {'app_id': project.id, 'task_id': task.id, 'user_id': user.id}
+            for task in tasks[1:]])
+
+        stats = db.session.query(ProjectStats).get(project.id)
+        assert stats.n_task_runs == 3, stats.n_task_runs
+        assert stats.n_registered_volunteers == 2, \
+            stats.n_registered_volunteers
+        assert stats.n_completed_tasks == 3, stats.n_completed_tasks
+
+
+    def test_save_task_runs_rolls_back_on_any_database_error(self):
+        """Test save_task_runs rolls back the transaction on database errors
+        other than integrity ones (e.g. a deadlock), and raises them"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project)
+        error = OperationalError('UPDATE project_stats', {},
+                                 Exception('deadlock detected'))
+
+        with patch('pybossa.repositories.task_repository.after_bulk_insert',
+                   side_effect=error):
+            assert_raises(OperationalError, self.task_repo.save_task_runs,
+                          [{'app_id': project.id, 'task_id': task.id,
+                            'user_ip': '10.0.0.1'}])
+
+        assert self.task_repo.count_task_runs_with(app_id=project.id) == 0
+
+
     def test_update_tasks_redundancy_changes_all_project_tasks_redundancy(self):
         """Test update_tasks_redundancy updates the n_answers value for every
         task in the project"""
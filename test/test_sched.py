@@ -431,6 +431,57 @@ class TestGetBreadthFirst(Test):
     def test_get_random_task(self):
         self._test_get_random_task()
 
+    @with_context
+    def test_get_random_task_skips_completed_and_answered_tasks(self):
+        """Test get_random_task only returns open tasks not answered by the
+        user"""
+        project = AppFactory.create()
+        user = UserFactory.create()
+        answered, completed, available = TaskFactory.create_batch(3,
+                                                                  app=project)
+        completed.state = u'completed'
+        db.session.commit()
+        TaskRunFactory.create(task=answered, user=user)
+
+        for i in range(10):
+            task = pybossa.sched.get_random_task(project.id, user_id=user.id)
+            assert task.id == available.id, task
+
+        TaskRunFactory.create(task=available, user=user)
+        task = pybossa.sched.get_random_task(project.id, user_id=user.id)
+        assert task is None, task
+
+    @with_context
+    @patch('pybossa.sched.random.randint')
+    def test_get_random_tasks_starts_from_a_random_id(self, randint):
+        """Test get_random_tasks returns the candidates from a random id
+        between the ids of the open tasks, wrapping around to the lowest
+        ids"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(4, app=project)
+        others = TaskFactory.create_batch(5, app=AppFactory.create())
+        tasks += TaskFactory.create_batch(2, app=project)
+        randint.return_value = others[2].id
+
+        picked = pybossa.sched.get_random_tasks(project.id, limit=3)
+
+        randint.assert_called_with(tasks[0].id, tasks[5].id)
+        assert [t.id for t in picked] == [tasks[4].id, tasks[5].id,
+                                          tasks[0].id], picked
+
+    @with_context
+    @patch('pybossa.sched.random.randint')
+    def test_get_random_tasks_honours_the_offset(self, randint):
+        """Test get_random_tasks skips offset candidates after the random
+        id"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(3, app=project)
+        randint.return_value = tasks[1].id
+
+        picked = pybossa.sched.get_random_tasks(project.id, offset=1, limit=2)
+
+        assert [t.id for t in picked] == [tasks[2].id, tasks[0].id], picked
+
     def _test_get_random_task(self, user=None):
         task = pybossa.sched.get_random_task(app_id=1)
         assert task is not None, task
@@ -443,6 +494,34 @@ class TestGetBreadthFirst(Test):
         assert task is None, task
 
 
+    @with_context
+    def test_get_candidate_tasks_limit_and_offset(self):
+        """Test get_candidate_tasks returns the loaded tasks in order, honouring
+        limit and offset"""
+        project = AppFactory.create()
+        low = TaskFactory.create(app=project, priority_0=0.1)
+        high = TaskFactory.create(app=project, priority_0=0.9)
+        other = TaskFactory.create(app=project, priority_0=0.1)
+
+        tasks = pybossa.sched.get_candidate_tasks(project.id)
+        assert [t.id for t in tasks] == [high.id, low.id, other.id], tasks
+        assert all(isinstance(t, Task) for t in tasks), tasks
+
+        tasks = pybossa.sched.get_candidate_tasks(project.id, offset=1, limit=1)
+        assert [t.id for t in tasks] == [low.id], tasks
+
+    @with_context
+    def test_get_depth_first_task_offset(self):
+        """Test get_depth_first_task returns the task at the given offset"""
+        project = AppFactory.create()
+        first, second = TaskFactory.create_batch(2, app=project)
+
+        task = pybossa.sched.get_depth_first_task(project.id, offset=1)
+        assert task.id == second.id, task
+
+        task = pybossa.sched.get_depth_first_task(project.id, offset=2)
+        assert task is None, task
+
     def _test_get_breadth_first_task(self, user=None):
         self.del_task_runs()
         if user:
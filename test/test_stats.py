@@ -19,10 +19,14 @@
 import datetime
 import time
 from factories import AppFactory, TaskFactory, TaskRunFactory, AnonymousTaskRunFactory
-from default import Test, with_context
+from default import Test, with_context, db
+from mock import patch
 from pybossa.model.task_run import TaskRun
+from pybossa.repositories import TaskRepository
 import pybossa.cache.project_stats as stats
 
+task_repo = TaskRepository(db)
+
 
 class TestStats(Test):
     def setUp(self):
@@ -56,6 +60,120 @@ class TestStats(Test):
         assert dates_anon[today] == 4, dates_anon[today]
         assert dates_auth[today] == 5, dates_auth[today]
 
+    def test_stats_dates_completed_on_the_day_of_the_last_answer(self):
+        """Test STATS stats_dates counts a task as completed the day it gets
+        its last answer"""
+        now = datetime.datetime.utcnow()
+        yesterday = now - datetime.timedelta(days=1)
+        task = TaskFactory.create(app=self.project, n_answers=2)
+        TaskRunFactory.create(task=task, finish_time=yesterday.isoformat())
+        TaskRunFactory.create(task=task, finish_time=now.isoformat())
+
+        dates, dates_anon, dates_auth = stats.stats_dates(self.project.id)
+
+        assert dates == {now.strftime('%Y-%m-%d'): 1}, dates
+        assert dates_auth[yesterday.strftime('%Y-%m-%d')] == 1, dates_auth
+
+    def test_update_stats_folds_only_new_task_runs(self):
+        """Test STATS update_stats reads only the task runs sent since the
+        last update"""
+        state = stats.update_stats(self.project.id)
+        assert sum(state['hours'].values()) == 8, state['hours']
+        last_id = state['last_id']
+
+        new = TaskRunFactory.create(task=self.project.tasks[0])
+        with patch.object(stats, 'session', wraps=stats.session) as session:
+            state = stats.update_stats(self.project.id)
+            params = session.execute.call_args[0][1]
+
+        assert params['since_id'] == max(last_id - stats.ID_OVERLAP, 0), params
+        assert state['last_id'] == new.id, state['last_id']
+        assert sum(state['hours'].values()) == 9, state['hours']
+        assert len(state['auth_counts']) == 5, state['auth_counts']
+
+    def test_reset_stats_rebuilds_them_from_scratch(self):
+        """Test STATS reset_stats makes update_stats read all the task runs
+        again"""
+        stats.update_stats(self.project.id)
+        task_repo.delete(self.project.tasks[0].task_runs[0])
+
+        stats.reset_stats(self.project.id)
+        state = stats.update_stats(self.project.id)
+
+        assert sum(state['hours'].values()) == 7, state['hours']
+
+    def test_update_stats_folds_again_if_they_are_reset_meanwhile(self):
+        """Test STATS update_stats does not overwrite a reset that happens
+        while it folds the new task runs, and rebuilds them instead"""
+        stats.update_stats(self.project.id)
+        fold = stats._fold
+        last_ids = []
+        def reset_while_folding(state, app_id):
+            last_ids.append(state['last_id'])
+            if len(last_ids) == 1:
+                stats.reset_stats(app_id)
+            return fold(state, app_id)
+
+        with patch.object(stats, '_fold', side_effect=reset_while_folding):
+            state = stats.update_stats(self.project.id)
+
+        assert last_ids[1] == 0, last_ids
+        assert sum(state['hours'].values()) == 8, state['hours']
+
+    def test_deleting_a_task_run_resets_stats_once_committed(self):
+        """Test STATS are reset when the deletion of a task run is committed,
+        not when it is flushed"""
+        stats.update_stats(self.project.id)
+        key = stats._stats_key(self.project.id)
+
+        db.session.delete(self.project.tasks[0].task_runs[0])
+        db.session.flush()
+        assert stats.sentinel.master.exists(key)
+
+        db.session.commit()
+        assert not stats.sentinel.master.exists(key)
+
+    def test_update_stats_reads_task_runs_committed_out_of_order(self):
+        """Test STATS update_stats adds the task runs with an id lower than
+        the last one it read, once"""
+        last_id = stats.update_stats(self.project.id)['last_id']
+        task = self.project.tasks[0]
+        TaskRunFactory.create(task=task, id=last_id + 100)
+        stats.update_stats(self.project.id)
+
+        TaskRunFactory.create(task=task, id=last_id + 50)
+        stats.update_stats(self.project.id)
+        state = stats.update_stats(self.project.id)
+
+        assert state['last_id'] == last_id + 100, state['last_id']
+        assert sum(state['hours'].values()) == 10, state['hours']
+
+    def test_update_stats_expires_them(self):
+        """Test STATS update_stats stores the aggregates with a timeout"""
+        stats.update_stats(self.project.id)
+
+        ttl = stats.sentinel.master.ttl(stats._stats_key(self.project.id))
+
+        assert 0 < ttl <= stats.STATS_TIMEOUT, ttl
+
+    def test_deleting_a_task_run_resets_stats(self):
+        """Test STATS are reset when a task run is deleted"""
+        stats.update_stats(self.project.id)
+
+        task_repo.delete(self.project.tasks[0].task_runs[0])
+        state = stats.update_stats(self.project.id)
+
+        assert sum(state['hours'].values()) == 7, state['hours']
+
+    def test_deleting_a_task_resets_stats(self):
+        """Test STATS are reset when a task is deleted"""
+        stats.update_stats(self.project.id)
+
+        task_repo.delete(self.project.tasks[0])
+        state = stats.update_stats(self.project.id)
+
+        assert sum(state['hours'].values()) == 6, state['hours']
+
     def test_02_stats_hours(self):
         """Test STATS hours method works"""
         hour = unicode(datetime.datetime.utcnow().strftime('%H'))
@@ -0,0 +1,98 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, with_context, sentinel
+from factories import AppFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.task_queue import TaskQueue
+from pybossa.sched import get_depth_first_task
+
+
+class TestTaskQueue(Test):
+
+    def setUp(self):
+        super(TestTaskQueue, self).setUp()
+        self.flask_app.config['SCHED_TASK_QUEUE'] = True
+        self.queue = TaskQueue(sentinel.master)
+
+    def tearDown(self):
+        self.flask_app.config['SCHED_TASK_QUEUE'] = False
+        super(TestTaskQueue, self).tearDown()
+
+    @with_context
+    @patch('pybossa.task_queue.Queue')
+    def test_cold_queue_returns_none_and_requests_warm(self, Queue):
+        """Test TaskQueue returns None and enqueues a warm job when cold"""
+        project = AppFactory.create()
+        TaskFactory.create(app=project)
+
+        assert self.queue.get_task_ids(project.id, user_ip='127.0.0.1') is None
+        assert self.queue.get_task_ids(project.id, user_ip='127.0.0.1') is None
+        assert Queue.return_value.enqueue.call_count == 1
+
+    @with_context
+    def test_warm_queue_sorts_by_priority_and_id(self):
+        """Test TaskQueue returns tasks sorted by priority_0 DESC, id ASC"""
+        project = AppFactory.create()
+        low = TaskFactory.create(app=project, priority_0=0.1)
+        high = TaskFactory.create(app=project, priority_0=0.9)
+        other = TaskFactory.create(app=project, priority_0=0.1)
+        self.queue.warm(project.id)
+
+        task_ids = self.queue.get_task_ids(project.id, user_ip='127.0.0.1',
+                                           limit=3)
+
+        assert task_ids == [high.id, low.id, other.id], task_ids
+
+    @with_context
+    def test_queue_skips_tasks_seen_by_the_user(self):
+        """Test TaskQueue does not return tasks the user has contributed to"""
+        project = AppFactory.create()
+        user = UserFactory.create()
+        first, second = TaskFactory.create_batch(2, app=project)
+        self.queue.warm(project.id)
+        TaskRunFactory.create(task=first, user=user)
+
+        task_ids = self.queue.get_task_ids(project.id, user_id=user.id)
+
+        assert task_ids == [second.id], task_ids
+
+    @with_context
+    def test_queue_is_updated_by_event_listeners(self):
+        """Test TaskQueue gets new tasks and drops completed ones"""
+        project = AppFactory.create()
+        self.queue.warm(project.id)
+        task = TaskFactory.create(app=project, n_answers=1)
+
+        assert self.queue.get_task_ids(project.id) == [task.id]
+
+        TaskRunFactory.create(task=task)
+
+        assert self.queue.get_task_ids(project.id) == []
+
+    @with_context
+    def test_depth_first_scheduler_uses_the_queue(self):
+        """Test depth first scheduler answers from the warm TaskQueue"""
+        project = AppFactory.create()
+        TaskFactory.create(app=project, priority_0=0.1)
+        high = TaskFactory.create(app=project, priority_0=0.9)
+        self.queue.warm(project.id)
+
+        task = get_depth_first_task(project.id, user_ip='127.0.0.1')
+
+        assert task.id == high.id, task
@@ -0,0 +1,181 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from mock import patch
+from default import Test, with_context, sentinel
+from factories import AppFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.task_reservation import TaskReservation
+from pybossa.sched import get_depth_first_task, get_breadth_first_task, \
+    get_incremental_task, MAX_CANDIDATES
+
+
+class TestTaskReservation(Test):
+
+    def setUp(self):
+        super(TestTaskReservation, self).setUp()
+        self.flask_app.config['SCHED_RESERVATION'] = True
+        self.reservation = TaskReservation(sentinel.master)
+
+    def tearDown(self):
+        self.flask_app.config['SCHED_RESERVATION'] = False
+        super(TestTaskReservation, self).tearDown()
+
+    @with_context
+    def test_reserve_respects_free_slots(self):
+        """Test TaskReservation does not give more copies than free slots"""
+        assert self.reservation.reserve(1, 2, 60, user_id=1)
+        assert self.reservation.reserve(1, 2, 60, user_ip='10.0.0.1')
+        assert not self.reservation.reserve(1, 2, 60, user_id=2)
+        assert self.reservation.count(1) == 2
+
+    @with_context
+    def test_reserve_twice_for_the_same_user(self):
+        """Test TaskReservation keeps the task for a user that holds it"""
+        assert self.reservation.reserve(1, 1, 60, user_id=1)
+
+        assert self.reservation.reserve(1, 1, 60, user_id=1)
+        assert self.reservation.count(1) == 1
+
+    @with_context
+    def test_release_frees_a_slot(self):
+        """Test TaskReservation release lets another user take the task"""
+        self.reservation.reserve(1, 1, 60, user_id=1)
+        self.reservation.release(1, user_id=1)
+
+        assert self.reservation.reserve(1, 1, 60, user_id=2)
+
+    @with_context
+    @patch('pybossa.task_reservation.time')
+    def test_reservations_expire(self, fake_time):
+        """Test TaskReservation frees the slots of expired reservations"""
+        fake_time.time.return_value = time.time()
+        self.reservation.reserve(1, 1, 60, user_id=1)
+        fake_time.time.return_value += 61
+
+        assert self.reservation.count(1) == 0
+        assert self.reservation.reserve(1, 1, 60, user_id=2)
+
+    @with_context
+    def test_timeout_uses_project_time_limit(self):
+        """Test TaskReservation timeout is the time_limit or the default"""
+        default = self.flask_app.config['SCHED_RESERVATION_TIMEOUT']
+
+        assert TaskReservation.timeout(30) == 30
+        assert TaskReservation.timeout(0) == default
+
+    @with_context
+    def test_depth_first_hands_out_free_tasks(self):
+        """Test depth first scheduler skips tasks reserved by other users"""
+        project = AppFactory.create()
+        first, second = TaskFactory.create_batch(2, app=project, n_answers=1)
+        user = UserFactory.create()
+
+        task = get_depth_first_task(project.id, user_id=user.id)
+        other = get_depth_first_task(project.id, user_ip='10.0.0.1')
+
+        assert task.id == first.id, task
+        assert other.id == second.id, other
+
+    @with_context
+    def test_depth_first_offset_skips_reserved_tasks(self):
+        """Test depth first scheduler offset counts only reservable tasks"""
+        project = AppFactory.create()
+        first, second, third = TaskFactory.create_batch(3, app=project,
+                                                        n_answers=1)
+        get_depth_first_task(project.id, user_ip='10.0.0.1')
+
+        task = get_depth_first_task(project.id, user_ip='10.0.0.2')
+        preloaded = get_depth_first_task(project.id, user_ip='10.0.0.2',
+                                         offset=1)
+
+        assert task.id == second.id, task
+        assert preloaded.id == third.id, preloaded
+
+    @with_context
+    def test_breadth_first_and_incremental_reserve_tasks(self):
+        """Test breadth first and incremental schedulers reserve tasks"""
+        project = AppFactory.create()
+        first, second = TaskFactory.create_batch(2, app=project, n_answers=1)
+
+        task = get_breadth_first_task(project.id, user_ip='10.0.0.1')
+        other = get_incremental_task(project.id, user_ip='10.0.0.2')
+
+        assert task.id != other.id, (task, other)
+
+    @with_context
+    def test_all_tasks_reserved_returns_no_task(self):
+        """Test schedulers do not hand out a task that other users hold"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project, n_answers=1)
+        get_depth_first_task(project.id, user_ip='10.0.0.1')
+
+        other = get_depth_first_task(project.id, user_ip='10.0.0.2')
+
+        assert other is None, other
+        assert self.reservation.count(task.id) == 1
+
+    @with_context
+    def test_candidates_after_the_window_are_handed_out(self):
+        """Test schedulers look past MAX_CANDIDATES reserved tasks"""
+        project = AppFactory.create()
+        tasks = TaskFactory.create_batch(MAX_CANDIDATES + 1, app=project,
+                                         n_answers=1)
+        for task in tasks[:-1]:
+            self.reservation.reserve(task.id, 1, 60, user_ip='10.0.0.1')
+
+        task = get_depth_first_task(project.id, user_ip='10.0.0.2')
+
+        assert task.id == tasks[-1].id, task
+
+    @with_context
+    def test_offset_reserves_only_the_returned_task(self):
+        """Test the tasks skipped by the offset are not reserved"""
+        project = AppFactory.create()
+        first, second = TaskFactory.create_batch(2, app=project, n_answers=1)
+
+        preloaded = get_depth_first_task(project.id, user_ip='10.0.0.1',
+                                         offset=1)
+
+        assert preloaded.id == second.id, preloaded
+        assert self.reservation.count(first.id) == 0
+        assert self.reservation.count(second.id) == 1
+
+    @with_context
+    def test_is_free_does_not_reserve(self):
+        """Test TaskReservation is_free only checks the free slots"""
+        assert self.reservation.is_free(1, 1, user_id=1)
+        assert self.reservation.count(1) == 0
+        self.reservation.reserve(1, 1, 60, user_id=1)
+
+        assert self.reservation.is_free(1, 1, user_id=1)
+        assert not self.reservation.is_free(1, 1, user_id=2)
+
+    @with_context
+    def test_task_run_releases_the_reservation(self):
+        """Test a TaskRun releases the reservation of its user"""
+        project = AppFactory.create()
+        task = TaskFactory.create(app=project, n_answers=2)
+        user = UserFactory.create()
+        get_depth_first_task(project.id, user_id=user.id)
+        assert self.reservation.count(task.id) == 1
+
+        TaskRunFactory.create(task=task, user=user)
+
+        assert self.reservation.count(task.id) == 0
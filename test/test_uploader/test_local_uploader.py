@@ -153,3 +153,32 @@ class TestLocalUploader(Test):
         err_msg = "Delete should return False"
         assert u.delete_file('file', 'container') is False, err_msg
 
+
+    @with_context
+    def test_local_open_file_writes_in_place(self):
+        """Test LOCAL UPLOADER open_file writes the file in the container."""
+        u = LocalUploader()
+        u.upload_folder = tempfile.mkdtemp()
+        with u.open_file('test.zip', 'mycontainer') as out:
+            out.write('content')
+        path = os.path.join(u.upload_folder, 'mycontainer', 'test.zip')
+        assert open(path).read() == 'content'
+        assert os.listdir(os.path.dirname(path)) == ['test.zip']
+
+    @with_context
+    def test_local_open_file_keeps_the_old_file_on_errors(self):
+        """Test LOCAL UPLOADER open_file does not replace the file if writing
+        it fails."""
+        u = LocalUploader()
+        u.upload_folder = tempfile.mkdtemp()
+        with u.open_file('test.zip', 'mycontainer') as out:
+            out.write('old')
+        try:
+            with u.open_file('test.zip', 'mycontainer') as out:
+                out.write('new')
+                raise IOError
+        except IOError:
+            pass
+        folder = os.path.join(u.upload_folder, 'mycontainer')
+        assert open(os.path.join(folder, 'test.zip')).read() == 'old'
+        assert os.listdir(folder) == ['test.zip']
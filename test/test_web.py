@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
 import json
 import os
 import shutil
@@ -2322,6 +2323,28 @@ class TestWeb(web.Helper):
         content_disposition = 'attachment; filename=%d_test-app_task_run_json.zip' % app.id
         assert res.headers.get('Content-Disposition') == content_disposition, res.headers
 
+    @with_context
+    def test_51_export_taskruns_ndjson(self):
+        """Test WEB export Task Runs to gzipped NDJSON works"""
+        Fixtures.create()
+        self.clear_temp_container(1)   # App ID 1 is assumed here. See app.id below.
+        uri = "/app/%s/tasks/export?type=wrong&format=ndjson" % Fixtures.app_short_name
+        res = self.app.get(uri, follow_redirects=True)
+        assert res.status == '404 NOT FOUND', res.status
+
+        uri = "/app/%s/tasks/export?type=task_run&format=ndjson" % Fixtures.app_short_name
+        res = self.app.get(uri, follow_redirects=True)
+        lines = gzip.GzipFile(fileobj=StringIO(res.data)).read().splitlines()
+        exported_task_runs = [json.loads(line) for line in lines]
+        app = db.session.query(App)\
+                .filter_by(short_name=Fixtures.app_short_name)\
+                .first()
+        err_msg = "The exported task runs are different from the App ones"
+        assert [tr['id'] for tr in exported_task_runs] == \
+            sorted(tr.id for tr in app.task_runs), err_msg
+        content_disposition = 'attachment; filename=%d_test-app_task_run_ndjson.gz' % app.id
+        assert res.headers.get('Content-Disposition') == content_disposition, res.headers
+
     @with_context
     def test_52_export_task_csv(self):
         """Test WEB export Tasks to CSV works"""
@@ -2876,7 +2899,9 @@ class TestWeb(web.Helper):
     @patch('pybossa.view.applications.importer.count_tasks_to_import')
     def test_import_tasks_as_background_job(self, count_tasks, queue):
         """Test WEB importing a big amount of tasks is done in the background"""
-        from pybossa.view.applications import MAX_NUM_SYNCHRONOUS_TASKS_IMPORT
+        from pybossa.view.applications import (
+            MAX_NUM_SYNCHRONOUS_TASKS_IMPORT, IMPORT_TIMEOUT)
+        from pybossa.importers import ImportProgress
         count_tasks.return_value = MAX_NUM_SYNCHRONOUS_TASKS_IMPORT + 1
         self.register()
         self.new_application()
@@ -2889,7 +2914,11 @@ class TestWeb(web.Helper):
 
         assert tasks == [], "Tasks should not be immediately added"
         data = {'type': 'csv', 'csv_url': 'http://myfakecsvurl.com'}
-        queue.enqueue.assert_called_once_with(import_tasks, app.id, **data)
+        queue.enqueue_call.assert_called_once_with(
+            func=import_tasks, args=(app.id,), kwargs=data,
+            timeout=IMPORT_TIMEOUT)
+        progress = ImportProgress(sentinel.master, app.id).get()
+        assert progress['state'] == 'queued', progress
         msg = "You're trying to import a large amount of tasks, so please be patient.\
             You will receive an email when the tasks are ready."
         assert msg in res.data
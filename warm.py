@@ -44,12 +44,7 @@ def warm_cache():
         def warm_app(id, short_name, featured=False):
             if id not in apps_cached:
                 cached_apps.get_app(short_name)
-                cached_apps.n_tasks(id)
-                n_task_runs = cached_apps.n_task_runs(id)
-                cached_apps.overall_progress(id)
-                cached_apps.last_activity(id)
-                cached_apps.n_completed_tasks(id)
-                cached_apps.n_volunteers(id)
+                n_task_runs = cached_apps.summary(id)['n_task_runs']
                 if n_task_runs >= 1000 or featured:
                     print "Getting stats for %s as it has %s task runs" % (short_name, n_task_runs)
                     stats.get_stats(id, app.config.get('GEO'))